@@ -104,6 +104,15 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/ref/settings/#caches
+# The default is per process. Features that share state between workers, such as the listing cache, need a
+# shared backend, e.g. CACHE_URL=redis://redis:6379/1.
+
+CACHES = {
+    'default': env.cache_url('CACHE_URL', default='locmemcache://'),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -178,6 +187,79 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 S3_ENDPOINT_URL = env.str('S3_ENDPOINT_URL')
 S3_ACCESS_KEY_ID = env.str('S3_ACCESS_KEY_ID')
 S3_SECRET_ACCESS_KEY = env.str('S3_SECRET_ACCESS_KEY')
+S3_MULTIPART_CHUNK_SIZE = env.int('S3_MULTIPART_CHUNK_SIZE', default=8 * 1024 * 1024)
+S3_CHUNK_BUCKET = env.str('S3_CHUNK_BUCKET', default='azin-chunk-store')
+S3_STAGING_PREFIX = env.str('S3_STAGING_PREFIX', default='.staging/')
+S3_TRASH_PREFIX = env.str('S3_TRASH_PREFIX', default='.trash/')
+S3_COPY_MULTIPART_THRESHOLD = env.int('S3_COPY_MULTIPART_THRESHOLD', default=1024 * 1024 * 1024)
+S3_COPY_PART_SIZE = env.int('S3_COPY_PART_SIZE', default=256 * 1024 * 1024)
+S3_COPY_WORKERS = env.int('S3_COPY_WORKERS', default=8)
+S3_DERIVATIVE_BUCKET = env.str('S3_DERIVATIVE_BUCKET', default='azin-derivatives')
+S3_DERIVATIVE_PREFIX = env.str('S3_DERIVATIVE_PREFIX', default='derivatives/')
+S3_STAGING_UPLOAD_EXPIRATION = env.int('S3_STAGING_UPLOAD_EXPIRATION', default=3600)
+S3_STAGING_MAX_UPLOAD_SIZE = env.int('S3_STAGING_MAX_UPLOAD_SIZE', default=5 * 1024 * 1024 * 1024)
+S3_DOWNLOAD_LINK_EXPIRATION = env.int('S3_DOWNLOAD_LINK_EXPIRATION', default=3600)
+S3_DOWNLOAD_LINK_MIN_REMAINING = env.int('S3_DOWNLOAD_LINK_MIN_REMAINING', default=600)
+S3_DOWNLOAD_LINK_CACHE_SIZE = env.int('S3_DOWNLOAD_LINK_CACHE_SIZE', default=10_000)
+STAGING_FINALIZE_TIMEOUT = env.int('STAGING_FINALIZE_TIMEOUT', default=600)
+RESUMABLE_UPLOAD_EXPIRATION = env.int('RESUMABLE_UPLOAD_EXPIRATION', default=24 * 3600)
+
+STORAGE_CHUNKED_MODE = env.bool('STORAGE_CHUNKED_MODE', default=False)
+STORAGE_CHUNKED_MIN_FILE_SIZE = env.int('STORAGE_CHUNKED_MIN_FILE_SIZE', default=8 * 1024 * 1024)
+CDC_MIN_CHUNK_SIZE = env.int('CDC_MIN_CHUNK_SIZE', default=256 * 1024)
+CDC_AVG_CHUNK_SIZE = env.int('CDC_AVG_CHUNK_SIZE', default=1024 * 1024)
+CDC_MAX_CHUNK_SIZE = env.int('CDC_MAX_CHUNK_SIZE', default=4 * 1024 * 1024)
+
+STORAGE_LIST_PAGE_SIZE = env.int('STORAGE_LIST_PAGE_SIZE', default=100)
+STORAGE_LIST_MAX_PAGE_SIZE = env.int('STORAGE_LIST_MAX_PAGE_SIZE', default=1000)
+STORAGE_BROWSE_FROM_INDEX = env.bool('STORAGE_BROWSE_FROM_INDEX', default=False)
+STORAGE_BROWSE_CONSISTENT = env.bool('STORAGE_BROWSE_CONSISTENT', default=True)
+STORAGE_BROWSE_MAX_SUBFOLDERS = env.int('STORAGE_BROWSE_MAX_SUBFOLDERS', default=1000)
+
+# Requires LISTING_CACHE_ALIAS to name a cache shared by every web worker and management command; writes made
+# in one process must invalidate the listings cached by all the others.
+LISTING_CACHE_ENABLED = env.bool('LISTING_CACHE_ENABLED', default=False)
+LISTING_CACHE_ALIAS = env.str('LISTING_CACHE_ALIAS', default='default')
+LISTING_CACHE_TTL = env.int('LISTING_CACHE_TTL', default=30)
+LISTING_CACHE_STALE_TTL = env.int('LISTING_CACHE_STALE_TTL', default=300)
+
+STORAGE_DOWNLOAD_PROXY = env.bool('STORAGE_DOWNLOAD_PROXY', default=False)
+STORAGE_DOWNLOAD_CHUNK_SIZE = env.int('STORAGE_DOWNLOAD_CHUNK_SIZE', default=256 * 1024)
+STORAGE_ZIP_MAX_ENTRIES = env.int('STORAGE_ZIP_MAX_ENTRIES', default=10_000)
+STORAGE_ZIP_STAT_WORKERS = env.int('STORAGE_ZIP_STAT_WORKERS', default=16)
+STORAGE_ZIP_PREFETCH_DEPTH = env.int('STORAGE_ZIP_PREFETCH_DEPTH', default=4)
+STORAGE_ZIP_SPOOL_MEMORY = env.int('STORAGE_ZIP_SPOOL_MEMORY', default=8 * 1024 * 1024)
+
+STORAGE_COMPRESSION_ENABLED = env.bool('STORAGE_COMPRESSION_ENABLED', default=False)
+STORAGE_COMPRESSION_LEVEL = env.int('STORAGE_COMPRESSION_LEVEL', default=3)
+STORAGE_COMPRESSION_MIN_SIZE = env.int('STORAGE_COMPRESSION_MIN_SIZE', default=4 * 1024)
+STORAGE_COMPRESSION_MIN_SAVING = env.float('STORAGE_COMPRESSION_MIN_SAVING', default=0.1)
+
+STORAGE_DERIVATIVES_ENABLED = env.bool('STORAGE_DERIVATIVES_ENABLED', default=False)
+STORAGE_DERIVATIVE_MAX_SOURCE_SIZE = env.int('STORAGE_DERIVATIVE_MAX_SOURCE_SIZE', default=64 * 1024 * 1024)
+STORAGE_DERIVATIVE_QUALITY = env.int('STORAGE_DERIVATIVE_QUALITY', default=80)
+STORAGE_DERIVATIVE_RETRY_BACKOFF = env.int('STORAGE_DERIVATIVE_RETRY_BACKOFF', default=15 * 60)
+
+STORAGE_MOVE_WORKERS = env.int('STORAGE_MOVE_WORKERS', default=32)
+STORAGE_TRASH_ENABLED = env.bool('STORAGE_TRASH_ENABLED', default=True)
+STORAGE_TRASH_RETENTION = env.int('STORAGE_TRASH_RETENTION', default=30 * 24 * 3600)
+STORAGE_GC_OPERATIONS_PER_SECOND = env.int('STORAGE_GC_OPERATIONS_PER_SECOND', default=200)
+STORAGE_CHUNK_GC_GRACE = env.int('STORAGE_CHUNK_GC_GRACE', default=24 * 3600)
+STORAGE_DELETE_JOB_WORKERS = env.int('STORAGE_DELETE_JOB_WORKERS', default=2)
+STORAGE_DELETE_JOB_TIMEOUT = env.int('STORAGE_DELETE_JOB_TIMEOUT', default=300)
+STORAGE_DELETE_BATCH_SIZE = env.int('STORAGE_DELETE_BATCH_SIZE', default=1000)
+STORAGE_BATCH_UPLOAD_WORKERS = env.int('STORAGE_BATCH_UPLOAD_WORKERS', default=8)
+STORAGE_ASYNC_FINALIZATION = env.bool('STORAGE_ASYNC_FINALIZATION', default=False)
+TASK_CLAIM_TIMEOUT = env.int('TASK_CLAIM_TIMEOUT', default=300)
+TASK_FENCE_TIMEOUT = env.int('TASK_FENCE_TIMEOUT', default=30)
+
+HASH_CACHE_ENABLED = env.bool('HASH_CACHE_ENABLED', default=True)
+HASH_BLOOM_CAPACITY = env.int('HASH_BLOOM_CAPACITY', default=5_000_000)
+HASH_BLOOM_ERROR_RATE = env.float('HASH_BLOOM_ERROR_RATE', default=0.01)
+HASH_LRU_SIZE = env.int('HASH_LRU_SIZE', default=50_000)
+HASH_CACHE_TTL = env.int('HASH_CACHE_TTL', default=60)
+HASH_CACHE_SYNC_INTERVAL = env.int('HASH_CACHE_SYNC_INTERVAL', default=30)
+HASH_CACHE_SYNC_OVERLAP = env.int('HASH_CACHE_SYNC_OVERLAP', default=60)
 
 ES_HOST = env.str('ES_HOST')
 ES_PORT = env.str('ES_PORT')
@@ -185,6 +267,13 @@ ES_AUDIT_LOG_INDEX = 'audit-logs'
 ES_ERROR_LOG_INDEX = 'error-logs'
 ES_USER_USAGE_INDEX = 'usage_index'
 ES_FILE_HASH_INDEX = 'hash_index'
+ES_BLOB_INDEX = 'blob_index'
+ES_CHUNK_INDEX = 'chunk_index'
+ES_DERIVATIVE_INDEX = 'derivative_index'
+ES_UPLOAD_SESSION_INDEX = 'upload_sessions'
+ES_STAGED_UPLOAD_INDEX = 'staged_uploads'
+ES_TASK_INDEX = 'storage_tasks'
+ES_FOLDER_DELETE_JOB_INDEX = 'folder_delete_jobs'
 
 LOGGING = {
     'version': 1,
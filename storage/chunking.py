@@ -0,0 +1,107 @@
+import random
+
+from django.conf import settings
+
+CHUNK_MANIFEST_VERSION = '1'
+
+_HASH_MASK = (1 << 64) - 1
+# The gear table must never change: chunk boundaries, and therefore chunk-level dedup, depend on it.
+_GEAR_RANDOM = random.Random(0x617a696e)
+_GEAR = tuple(_GEAR_RANDOM.getrandbits(64) for _ in range(256))
+
+
+class ContentDefinedChunker:
+    """
+    Splits a byte stream into content-defined chunks using a Gear rolling hash.
+
+    A boundary is placed wherever the rolling hash matches the mask, so inserting or removing bytes
+    only moves the boundaries around the edit and the remaining chunks keep their hashes.
+    """
+
+    def __init__(self, min_size=None, avg_size=None, max_size=None):
+        self.min_size = min_size or settings.CDC_MIN_CHUNK_SIZE
+        self.avg_size = avg_size or settings.CDC_AVG_CHUNK_SIZE
+        self.max_size = max_size or settings.CDC_MAX_CHUNK_SIZE
+        mask_bits = max(self.avg_size.bit_length() - 1, 1)
+        self.mask = ((1 << mask_bits) - 1) << (64 - mask_bits)
+        self.buffer = bytearray()
+        self._reset_scan()
+
+    def _reset_scan(self):
+        self._scan_pos = 0
+        self._rolling_hash = 0
+
+    def _find_cut_point(self):
+        buffer_length = len(self.buffer)
+        if buffer_length <= self.min_size:
+            return None
+
+        rolling_hash = self._rolling_hash
+        mask = self.mask
+        gear = _GEAR
+        buffer = self.buffer
+        end = min(buffer_length, self.max_size)
+        for position in range(max(self._scan_pos, self.min_size), end):
+            rolling_hash = ((rolling_hash << 1) + gear[buffer[position]]) & _HASH_MASK
+            if not rolling_hash & mask:
+                return position + 1
+
+        if end == self.max_size:
+            return self.max_size
+
+        self._scan_pos = end
+        self._rolling_hash = rolling_hash
+        return None
+
+    def feed(self, data):
+        """Adds data to the stream and yields every chunk whose boundary is now known."""
+        self.buffer.extend(data)
+        while True:
+            cut_point = self._find_cut_point()
+            if cut_point is None:
+                return
+            chunk = bytes(self.buffer[:cut_point])
+            del self.buffer[:cut_point]
+            self._reset_scan()
+            yield chunk
+
+    def flush(self):
+        """Yields the trailing chunk once the stream has ended."""
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            self._reset_scan()
+            yield chunk
+
+
+class ChunkedObjectWriter:
+    """Feeds a stream through the chunker and stores the chunks in small batches to keep memory bounded."""
+
+    batch_size = 16
+
+    def __init__(self, storage_facade):
+        self.storage_facade = storage_facade
+        self.chunker = ContentDefinedChunker()
+        self.pending = []
+        self.chunk_refs = []
+        self.stored_size = 0
+
+    def write(self, data):
+        for chunk in self.chunker.feed(data):
+            self.pending.append(chunk)
+            if len(self.pending) >= self.batch_size:
+                self._store_pending()
+
+    def close(self):
+        """Stores the remaining chunks and returns the ordered chunk references for the manifest."""
+        self.pending.extend(self.chunker.flush())
+        self._store_pending()
+        return self.chunk_refs
+
+    def _store_pending(self):
+        if not self.pending:
+            return
+        chunk_refs, stored_size = self.storage_facade.store_chunks(self.pending)
+        self.chunk_refs.extend(chunk_refs)
+        self.stored_size += stored_size
+        self.pending = []
@@ -0,0 +1,77 @@
+import codecs
+import gzip
+import mimetypes
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_ZSTD = 'zstd'
+CODEC_GZIP = 'gzip'
+
+COMPRESSIBLE_EXTENSIONS = {
+    'txt', 'csv', 'tsv', 'json', 'jsonl', 'ndjson', 'log', 'xml', 'html', 'htm', 'md', 'yaml', 'yml', 'sql',
+    'js', 'css', 'svg', 'ini', 'conf', 'cfg', 'py', 'java', 'c', 'h', 'cpp', 'go', 'rs', 'sh', 'tex'
+}
+COMPRESSIBLE_CONTENT_TYPES = {
+    'application/json', 'application/xml', 'application/javascript', 'application/sql', 'image/svg+xml'
+}
+
+SNIFF_SIZE = 8 * 1024
+
+
+def default_codec():
+    return CODEC_ZSTD if zstandard is not None else CODEC_GZIP
+
+
+def is_compressible(file_path, content):
+    """Decides by extension, then by guessed content type, then by sniffing the first bytes for plain text."""
+    filename = file_path.rsplit('/', 1)[-1]
+    file_type = filename.split('.')[-1].lower() if '.' in filename else 'unknown'
+    if file_type in COMPRESSIBLE_EXTENSIONS:
+        return True
+
+    content_type, _ = mimetypes.guess_type(filename)
+    if content_type:
+        return content_type.startswith('text/') or content_type in COMPRESSIBLE_CONTENT_TYPES
+
+    sample = bytes(content[:SNIFF_SIZE])
+    if b'\x00' in sample:
+        return False
+    try:
+        # An incremental decoder tolerates a multi-byte character cut off at the end of the sample.
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def compress(content, codec, level):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception("The zstandard package is required for zstd compression.")
+        return zstandard.ZstdCompressor(level=level).compress(content)
+    if codec == CODEC_GZIP:
+        return gzip.compress(content, compresslevel=min(level, 9))
+    raise Exception(f"Unknown compression codec {codec}.")
+
+
+def iter_decompressed(body, codec, block_size=1024 * 1024):
+    """Decompresses an S3 streaming body block by block, so whole objects are never held in memory."""
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception("The zstandard package is required to read zstd compressed objects.")
+        yield from zstandard.ZstdDecompressor().read_to_iter(body, read_size=block_size, write_size=block_size)
+    elif codec == CODEC_GZIP:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        for block in body.iter_chunks(chunk_size=block_size):
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+    else:
+        raise Exception(f"Unknown compression codec {codec}.")
@@ -0,0 +1,238 @@
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+from elasticsearch import ConflictError, NotFoundError
+
+from storage.es_mappings import FOLDER_DELETE_JOB_MAPPING
+from storage.models import UserStorageState
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class FolderDeleteJobNotFound(Exception):
+    pass
+
+
+class FolderDeleteJobConflict(Exception):
+    pass
+
+
+class FolderDeleteJobFacade:
+    """
+    Folder deletes run as background jobs instead of inside the HTTP request.
+
+    A job is a document holding the folder, its status and the progress of the delete: the phase, the last
+    key handled and the running counts. The progress is saved after every listing page, so a job whose worker
+    stopped resumes right after the last saved key. Jobs run on a bounded thread pool in the process that
+    submitted them; the run_folder_delete_jobs command picks up queued jobs and reclaims the ones whose worker
+    has been silent for longer than STORAGE_DELETE_JOB_TIMEOUT. Every save is conditional on the sequence
+    number read before it, so a job is never advanced by two workers at once.
+    """
+
+    progress_fields = ("phase", "cursor", "processed_count", "deleted_count", "failed_count")
+
+    def __init__(self, storage_facade, workers=None):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "init",
+            "resource": "FolderDeleteJobFacade",
+            "message": "Initializing FolderDeleteJobFacade",
+            "details": {}
+        })
+        self.storage_facade = storage_facade
+        self.es_facade = storage_facade.es_facade
+        self.job_index = settings.ES_FOLDER_DELETE_JOB_INDEX
+        workers = settings.STORAGE_DELETE_JOB_WORKERS if workers is None else workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='folder-delete') \
+            if workers > 0 else None
+        self.es_facade.create_index(self.job_index, FOLDER_DELETE_JOB_MAPPING)
+
+    def submit_job(self, user_id, folder_path):
+        """Queues the delete of a folder and returns the job ID; an unfinished job for the same folder is reused."""
+        folder_path = folder_path.strip('/')
+        active_jobs = self.list_jobs(user_id, folder_path=folder_path, active_only=True, size=1)
+        if active_jobs:
+            return active_jobs[0]["id"]
+
+        job_id = uuid.uuid4().hex
+        now = int(datetime.now().timestamp() * 1000)
+        self.es_facade.index_document(self.job_index, job_id, {
+            "user_id": user_id,
+            "folder_path": folder_path,
+            "status": "queued",
+            "phase": "links",
+            "cursor": None,
+            "processed_count": 0,
+            "deleted_count": 0,
+            "failed_count": 0,
+            "result": None,
+            "creation_date": now,
+            "last_activity_date": now
+        }, refresh='wait_for')
+        # Cached listings must revalidate so the folder shows the pending delete.
+        UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "folder_delete_job_submitted",
+            "resource": folder_path,
+            "message": f"Folder delete job {job_id} submitted for {folder_path}.",
+            "details": {"job_id": job_id}
+        })
+
+        if self.executor is not None:
+            self.executor.submit(self.run_job, job_id)
+        return job_id
+
+    def get_job(self, user_id, job_id):
+        try:
+            job = self.es_facade.get_document(self.job_index, job_id)
+        except NotFoundError:
+            raise FolderDeleteJobNotFound(f"Folder delete job {job_id} does not exist.")
+
+        if job["user_id"] != user_id:
+            raise FolderDeleteJobNotFound(f"Folder delete job {job_id} does not exist.")
+        return job
+
+    def list_jobs(self, user_id, folder_path=None, active_only=True, size=20):
+        filters = [{"term": {"user_id": user_id}}]
+        if folder_path is not None:
+            filters.append({"term": {"folder_path": folder_path}})
+        if active_only:
+            filters.append({"terms": {"status": ["queued", "running"]}})
+        response = self.es_facade.search(self.job_index, {
+            "query": {"bool": {"filter": filters}},
+            "sort": [{"creation_date": {"order": "desc"}}],
+            "size": size
+        })
+        return [{"id": hit['_id'], **hit['_source']} for hit in response['hits']['hits']]
+
+    def run_job(self, job_id):
+        """Runs a job unless another worker holds it; returns whether this worker ran it."""
+        try:
+            job, seq_no, primary_term = self.es_facade.get_versioned_document(self.job_index, job_id)
+        except NotFoundError:
+            return False
+
+        if job["status"] == "running" and job["last_activity_date"] >= self._stale_before():
+            return False
+        if job["status"] not in ("queued", "running"):
+            return False
+        return self._run(job_id, job, seq_no, primary_term)
+
+    def resume_jobs(self, batch_size=20):
+        """Runs queued jobs and reclaims running ones whose worker went silent, using the pool when there is one."""
+        response = self.es_facade.es_client.search(index=self.job_index, body={
+            "query": {
+                "bool": {
+                    "should": [
+                        {"term": {"status": "queued"}},
+                        {"bool": {"filter": [
+                            {"term": {"status": "running"}},
+                            {"range": {"last_activity_date": {"lt": self._stale_before()}}}
+                        ]}}
+                    ],
+                    "minimum_should_match": 1
+                }
+            },
+            "sort": [{"creation_date": {"order": "asc"}}],
+            "size": batch_size,
+            "seq_no_primary_term": True
+        })
+
+        def run_hit(hit):
+            return self._run(hit['_id'], hit['_source'], hit['_seq_no'], hit['_primary_term'])
+
+        hits = response['hits']['hits']
+        if self.executor is None:
+            return sum(run_hit(hit) for hit in hits)
+        return sum(self.executor.map(run_hit, hits))
+
+    @staticmethod
+    def _stale_before():
+        return int(datetime.now().timestamp() * 1000) - settings.STORAGE_DELETE_JOB_TIMEOUT * 1000
+
+    def _run(self, job_id, job, seq_no, primary_term):
+        user_id = job["user_id"]
+        job["status"] = "running"
+        job["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        try:
+            seq_no, primary_term = self._save_job(job_id, job, seq_no, primary_term)
+        except FolderDeleteJobConflict:
+            return False
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "folder_delete_job_started",
+            "resource": job["folder_path"],
+            "message": f"Folder delete job {job_id} started in phase {job['phase']}.",
+            "details": {"job_id": job_id, "cursor": job["cursor"], "processed_count": job["processed_count"]}
+        })
+
+        progress = {field: job[field] for field in self.progress_fields}
+        try:
+            for progress in self.storage_facade.iter_delete_folder(user_id, job["folder_path"], progress):
+                job.update(progress)
+                job["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+                seq_no, primary_term = self._save_job(job_id, job, seq_no, primary_term)
+                # Cached listings show the job's progress, so every saved page must revalidate them.
+                UserStorageState.bump(user_id)
+
+            if job["failed_count"]:
+                job["status"] = "failed"
+                job["result"] = f"{job['failed_count']} objects in folder {job['folder_path']} could not be deleted."
+            else:
+                job["status"] = "completed"
+                job["result"] = f"Folder {job['folder_path']} and its contents deleted successfully."
+        except FolderDeleteJobConflict:
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "folder_delete_job_taken_over",
+                "resource": job["folder_path"],
+                "message": f"Folder delete job {job_id} was taken over by another worker.",
+                "details": {"job_id": job_id}
+            })
+            return True
+        except Exception as e:
+            job["status"] = "failed"
+            job["result"] = str(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error running folder delete job {job_id}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "job_id": job_id, "folder_path": job["folder_path"],
+                            "phase": job["phase"], "cursor": job["cursor"]}
+            })
+
+        job["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        try:
+            self._save_job(job_id, job, seq_no, primary_term, refresh='wait_for')
+        except FolderDeleteJobConflict:
+            return True
+        UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "folder_delete_job_finished",
+            "resource": job["folder_path"],
+            "message": f"Folder delete job {job_id} finished with status {job['status']}.",
+            "details": {"job_id": job_id, "status": job["status"], "deleted_count": job["deleted_count"],
+                        "failed_count": job["failed_count"]}
+        })
+        return True
+
+    def _save_job(self, job_id, job, seq_no, primary_term, refresh=None):
+        try:
+            return self.es_facade.index_document(self.job_index, job_id, job,
+                                                 if_seq_no=seq_no, if_primary_term=primary_term, refresh=refresh)
+        except ConflictError:
+            raise FolderDeleteJobConflict(f"Folder delete job {job_id} was modified by another worker.")
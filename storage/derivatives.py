@@ -0,0 +1,67 @@
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+DERIVATIVE_CONTENT_TYPE = 'image/jpeg'
+DERIVATIVE_VARIANTS = {
+    'thumbnail': 256,
+    'preview': 1024
+}
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tif', 'tiff'}
+PDF_EXTENSIONS = {'pdf'}
+
+
+def source_kind(file_path):
+    """Tells which renderer can read a file, judging by its extension, or None when none is available."""
+    filename = file_path.rsplit('/', 1)[-1]
+    file_type = filename.split('.')[-1].lower() if '.' in filename else 'unknown'
+    if Image is None:
+        return None
+    if file_type in IMAGE_EXTENSIONS:
+        return 'image'
+    if file_type in PDF_EXTENSIONS and fitz is not None:
+        return 'pdf'
+    return None
+
+
+def generate_derivative_key(prefix, file_hash, variant):
+    return f"{prefix}{file_hash[:2]}/{file_hash}/{variant}.jpg"
+
+
+def render_derivatives(content, kind, quality=80):
+    """Renders every variant of an image, or of the first page of a PDF, as a JPEG no larger than its box."""
+    largest_box = max(DERIVATIVE_VARIANTS.values())
+    if kind == 'pdf':
+        document = fitz.open(stream=content, filetype='pdf')
+        try:
+            page = document[0]
+            scale = largest_box / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        finally:
+            document.close()
+    else:
+        image = Image.open(io.BytesIO(content))
+        # JPEG sources are decoded at a reduced scale straight away, which skips most of the decoding work.
+        image.draft('RGB', (largest_box, largest_box))
+        image = ImageOps.exif_transpose(image)
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    derivatives = {}
+    for variant, box in sorted(DERIVATIVE_VARIANTS.items(), key=lambda item: -item[1]):
+        image.thumbnail((box, box))
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        derivatives[variant] = (output.getvalue(), image.width, image.height)
+    return derivatives
@@ -24,12 +24,104 @@ HASH_INDEX_MAPPING = {
     "properties": {
         "hash": {"type": "keyword", "index": True},
         "original_key": {"type": "text", "index": True},
-        "user_id": {"type": "text", "index": True},
+        "user_id": {"type": "text", "index": True, "fields": {"keyword": {"type": "keyword"}}},
         "filename": {"type": "keyword", "index": True},
-        "folder_path": {"type": "text"},
+        "folder_path": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+        "object_key": {"type": "keyword"},
         "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
         "size": {"type": "long"},
-        "file_type": {"type": "keyword"}
+        "file_type": {"type": "keyword"},
+        "storage_mode": {"type": "keyword"},
+        "codec": {"type": "keyword"},
+        "stored_size": {"type": "long"},
+        "trashed_at": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "trashed_path": {"type": "keyword"}
+    }
+}
+
+BLOB_INDEX_MAPPING = {
+    "properties": {
+        "hash": {"type": "keyword", "index": True},
+        "original_key": {"type": "keyword"},
+        "storage_mode": {"type": "keyword"},
+        "codec": {"type": "keyword"},
+        "size": {"type": "long"},
+        "ref_count": {"type": "long"},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    }
+}
+
+CHUNK_INDEX_MAPPING = {
+    "properties": {
+        "hash": {"type": "keyword", "index": True},
+        "chunk_key": {"type": "keyword"},
+        "size": {"type": "long"},
+        "ref_count": {"type": "long"},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "unreferenced_since": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    }
+}
+
+DERIVATIVE_INDEX_MAPPING = {
+    "properties": {
+        "hash": {"type": "keyword", "index": True},
+        "status": {"type": "keyword"},
+        "kind": {"type": "keyword"},
+        "source_key": {"type": "keyword"},
+        "variants": {"type": "object", "enabled": False},
+        "error": {"type": "text", "index": False},
+        "attempts": {"type": "integer"},
+        "retry_after": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "last_activity_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    }
+}
+
+UPLOAD_SESSION_MAPPING = {
+    "properties": {
+        "user_id": {"type": "keyword"},
+        "file_path": {"type": "keyword"},
+        "upload_id": {"type": "keyword"},
+        "upload_length": {"type": "long"},
+        "offset": {"type": "long"},
+        "part_size": {"type": "long"},
+        "parts": {"type": "object", "enabled": False},
+        "tail_key": {"type": "keyword", "index": False},
+        "tail_size": {"type": "long"},
+        "hash_state": {"type": "binary"},
+        "status": {"type": "keyword"},
+        "result": {"type": "text", "index": False},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "last_activity_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    }
+}
+
+STAGED_UPLOAD_MAPPING = {
+    "properties": {
+        "user_id": {"type": "keyword"},
+        "file_path": {"type": "keyword"},
+        "staging_key": {"type": "keyword"},
+        "declared_size": {"type": "long"},
+        "status": {"type": "keyword"},
+        "result": {"type": "text", "index": False},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "last_activity_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    }
+}
+
+FOLDER_DELETE_JOB_MAPPING = {
+    "properties": {
+        "user_id": {"type": "keyword"},
+        "folder_path": {"type": "keyword"},
+        "status": {"type": "keyword"},
+        "phase": {"type": "keyword"},
+        "cursor": {"type": "keyword", "index": False},
+        "processed_count": {"type": "long"},
+        "deleted_count": {"type": "long"},
+        "failed_count": {"type": "long"},
+        "result": {"type": "text", "index": False},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "last_activity_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
     }
 }
 
@@ -38,11 +130,28 @@ USER_USAGE_INDEX_MAPPING = {
         "user_id": {"type": "keyword", "index": True},
         "bucket_name": {"type": "keyword", "index": True},
         "total_size": {"type": "long"},
+        "stored_size": {"type": "long"},
         "file_count": {"type": "long"},
         "upload_count": {"type": "long"},
         "delete_count": {"type": "long"},
         "last_activity_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
-        "storage_limit": {"type": "long"}
+        "storage_limit": {"type": "long"},
+        "applied_batches": {"type": "keyword", "index": False}
+    }
+}
+
+STORAGE_TASK_MAPPING = {
+    "properties": {
+        "task_type": {"type": "keyword"},
+        "user_id": {"type": "keyword"},
+        "keys": {"type": "keyword"},
+        "payload": {"type": "object", "enabled": False},
+        "status": {"type": "keyword"},
+        "batch_id": {"type": "keyword"},
+        "claim_token": {"type": "keyword"},
+        "claimed_at": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "attempts": {"type": "integer"},
+        "creation_date": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
     }
 }
 
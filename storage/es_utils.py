@@ -1,6 +1,6 @@
 import logging
 from django.conf import settings
-from elasticsearch import Elasticsearch, helpers, ApiError
+from elasticsearch import Elasticsearch, helpers, ApiError, ConflictError, NotFoundError
 from storage.es_mappings import ES_SETTINGS
 from datetime import datetime
 
@@ -56,6 +56,29 @@ class ESFacade:
             })
             raise
 
+    def put_mapping(self, index_name, es_mappings):
+        """Adds new fields and sub-fields of a mapping to an existing Elasticsearch index."""
+        try:
+            self.es_client.indices.put_mapping(index=index_name, body=es_mappings)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "put_mapping",
+                "resource": index_name,
+                "message": f"Mapping of index {index_name} updated successfully.",
+                "details": es_mappings
+            })
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error updating mapping of index {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name}
+            })
+            raise
+
     def delete_index(self, index_name):
         """Deletes an Elasticsearch index."""
         try:
@@ -89,10 +112,11 @@ class ESFacade:
             })
             raise
 
-    def index_document(self, index_name, doc_id, document):
-        """Indexes a single document into the specified index."""
+    def index_document(self, index_name, doc_id, document, if_seq_no=None, if_primary_term=None, refresh=None):
+        """Indexes a document, optionally only if still at the given sequence number, and returns the new one."""
         try:
-            self.es_client.index(index=index_name, id=doc_id, body=document)
+            response = self.es_client.index(index=index_name, id=doc_id, body=document,
+                                            if_seq_no=if_seq_no, if_primary_term=if_primary_term, refresh=refresh)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -101,6 +125,7 @@ class ESFacade:
                 "message": f"Document {doc_id} indexed successfully.",
                 "details": {"doc_id": doc_id}
             })
+            return response['_seq_no'], response['_primary_term']
         except ApiError as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
@@ -112,6 +137,40 @@ class ESFacade:
             })
             raise
 
+    def create_document(self, index_name, doc_id, document):
+        """Indexes a document only if no document with that ID exists yet; returns False when one does."""
+        try:
+            self.es_client.create(index=index_name, id=doc_id, document=document)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "create_document",
+                "resource": index_name,
+                "message": f"Document {doc_id} created successfully.",
+                "details": {"doc_id": doc_id}
+            })
+            return True
+        except ConflictError:
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "create_document",
+                "resource": index_name,
+                "message": f"Document {doc_id} already exists.",
+                "details": {"doc_id": doc_id}
+            })
+            return False
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error creating document in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "doc_id": doc_id}
+            })
+            raise
+
     def get_document(self, index_name, doc_id):
         """Retrieves a document by ID from the specified index."""
         try:
@@ -136,6 +195,55 @@ class ESFacade:
             })
             raise
 
+    def get_versioned_document(self, index_name, doc_id):
+        """Retrieves a document together with the sequence number and primary term needed for optimistic writes."""
+        try:
+            response = self.es_client.get(index=index_name, id=doc_id)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "get_versioned_document",
+                "resource": index_name,
+                "message": f"Document {doc_id} retrieved successfully.",
+                "details": {"doc_id": doc_id, "seq_no": response['_seq_no']}
+            })
+            return response['_source'], response['_seq_no'], response['_primary_term']
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error retrieving document {doc_id} from {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "doc_id": doc_id}
+            })
+            raise
+
+    def get_documents(self, index_name, doc_ids):
+        """Retrieves several documents by ID in one round-trip and returns the found ones keyed by ID."""
+        try:
+            response = self.es_client.mget(index=index_name, ids=list(doc_ids))
+            documents = {doc['_id']: doc['_source'] for doc in response['docs'] if doc.get('found')}
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "get_documents",
+                "resource": index_name,
+                "message": f"Retrieved {len(documents)} of {len(doc_ids)} documents from {index_name}.",
+                "details": {"requested_count": len(doc_ids), "found_count": len(documents)}
+            })
+            return documents
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error retrieving documents from {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "doc_ids_count": len(doc_ids)}
+            })
+            raise
+
     def search_documents(self, index_name, user_id, search_term, fields=None):
         """Searches documents in the specified Elasticsearch index using the provided search term."""
         try:
@@ -175,6 +283,13 @@ class ESFacade:
                                     ]
                                 }
                             }
+                        ],
+                        "must_not": [
+                            {
+                                "exists": {
+                                    "field": "trashed_at"
+                                }
+                            }
                         ]
                     }
                 }
@@ -202,10 +317,34 @@ class ESFacade:
             })
             raise
 
-    def update_document(self, index_name, doc_id, update_fields):
+    def search(self, index_name, body):
+        """Runs a raw search body against an index and returns the full response, aggregations included."""
+        try:
+            response = self.es_client.search(index=index_name, body=body)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "search",
+                "resource": index_name,
+                "message": f"Search executed on index {index_name}.",
+                "details": {"hits_count": len(response['hits']['hits'])}
+            })
+            return response
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error searching in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name}
+            })
+            raise
+
+    def update_document(self, index_name, doc_id, update_fields, refresh=None):
         """Updates specific fields of a document in the specified index."""
         try:
-            self.es_client.update(index=index_name, id=doc_id, body={'doc': update_fields})
+            self.es_client.update(index=index_name, id=doc_id, body={'doc': update_fields}, refresh=refresh)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -225,10 +364,45 @@ class ESFacade:
             })
             raise
 
-    def delete_document(self, index_name, doc_id):
+    def script_update_document(self, index_name, doc_id, script, retry_on_conflict=3, source=True):
+        """Runs a script against a document and returns the update result with the resulting source, if asked for."""
+        try:
+            response = self.es_client.update(index=index_name, id=doc_id, script=script,
+                                             retry_on_conflict=retry_on_conflict, source=source)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "script_update_document",
+                "resource": index_name,
+                "message": f"Document {doc_id} script update finished with result {response['result']}.",
+                "details": {"doc_id": doc_id, "result": response['result']}
+            })
+            return response['result'], response.get('get', {}).get('_source')
+        except NotFoundError:
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "script_update_document",
+                "resource": index_name,
+                "message": f"Document {doc_id} does not exist.",
+                "details": {"doc_id": doc_id}
+            })
+            return 'not_found', None
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error running script update on document {doc_id} in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "doc_id": doc_id}
+            })
+            raise
+
+    def delete_document(self, index_name, doc_id, refresh=None):
         """Deletes a document by ID from the specified index."""
         try:
-            self.es_client.delete(index=index_name, id=doc_id)
+            self.es_client.delete(index=index_name, id=doc_id, refresh=refresh)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -248,18 +422,18 @@ class ESFacade:
             })
             raise
 
-    def bulk_index_documents(self, index_name, documents):
-        """Performs a bulk index operation for multiple documents."""
+    def bulk_index_documents(self, index_name, documents, refresh=None, op_type='index'):
+        """Performs a bulk index operation for multiple documents; with op_type create, existing ones are kept."""
         try:
             actions = [
                 {
-                    '_op_type': 'index',
+                    '_op_type': op_type,
                     '_index': index_name,
                     '_id': doc['id'],
                     '_source': doc['body']
                 } for doc in documents
             ]
-            helpers.bulk(self.es_client, actions)
+            helpers.bulk(self.es_client, actions, refresh=refresh, ignore_status=(409,) if op_type == 'create' else ())
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -268,6 +442,16 @@ class ESFacade:
                 "message": f"Bulk index operation completed successfully for {index_name}.",
                 "details": {"documents_count": len(documents)}
             })
+        except helpers.BulkIndexError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"{len(e.errors)} documents failed in bulk index operation in {index_name}.",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "errors": e.errors}
+            })
+            raise
         except ApiError as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
@@ -279,18 +463,24 @@ class ESFacade:
             })
             raise
 
-    def bulk_update_documents(self, index_name, documents):
-        """Performs a bulk update operation for multiple documents."""
+    def bulk_update_documents(self, index_name, documents, refresh=None):
+        """Performs a bulk update operation for multiple documents, each given as a partial body or a script."""
         try:
-            actions = [
-                {
+            actions = []
+            for doc in documents:
+                action = {
                     '_op_type': 'update',
                     '_index': index_name,
-                    '_id': doc['id'],
-                    'doc': doc['body']
-                } for doc in documents
-            ]
-            helpers.bulk(self.es_client, actions)
+                    '_id': doc['id']
+                }
+                if 'script' in doc:
+                    action['script'] = doc['script']
+                else:
+                    action['doc'] = doc['body']
+                if 'retry_on_conflict' in doc:
+                    action['retry_on_conflict'] = doc['retry_on_conflict']
+                actions.append(action)
+            helpers.bulk(self.es_client, actions, refresh=refresh)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -299,6 +489,16 @@ class ESFacade:
                 "message": f"Bulk update operation completed successfully for {index_name}.",
                 "details": {"documents_count": len(documents)}
             })
+        except helpers.BulkIndexError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"{len(e.errors)} documents failed in bulk update operation in {index_name}.",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "errors": e.errors}
+            })
+            raise
         except ApiError as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
@@ -310,7 +510,79 @@ class ESFacade:
             })
             raise
 
-    def bulk_delete_documents(self, index_name, doc_ids):
+    def bulk_script_update_documents(self, index_name, scripts, retry_on_conflict=3, source=False):
+        """Applies one script per document in one bulk request; returns each result by ID, with its source if asked."""
+        try:
+            operations = []
+            for doc_id, script in scripts.items():
+                operations.append({"update": {"_index": index_name, "_id": doc_id,
+                                              "retry_on_conflict": retry_on_conflict}})
+                operations.append({"script": script, "_source": True} if source else {"script": script})
+            response = self.es_client.bulk(operations=operations)
+            results = {}
+            for item in response['items']:
+                update = item['update']
+                result = 'not_found' if update['status'] == 404 else update.get('result', 'error')
+                results[update['_id']] = (result, update.get('get', {}).get('_source')) if source else result
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "bulk_script_update_documents",
+                "resource": index_name,
+                "message": f"Bulk scripted update of {len(scripts)} documents completed for {index_name}.",
+                "details": {"documents_count": len(scripts), "errors": response['errors']}
+            })
+            return results
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error performing bulk scripted update in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name}
+            })
+            raise
+
+    def bulk_script_update_and_delete_documents(self, script_index_name, scripts, index_name, doc_ids,
+                                                retry_on_conflict=3, refresh=None):
+        """Applies scripts to documents of one index, then deletes documents of another, in one bulk request."""
+        try:
+            operations = []
+            for doc_id, script in scripts.items():
+                operations.append({"update": {"_index": script_index_name, "_id": doc_id,
+                                              "retry_on_conflict": retry_on_conflict}})
+                operations.append({"script": script})
+            for doc_id in doc_ids:
+                operations.append({"delete": {"_index": index_name, "_id": doc_id}})
+            response = self.es_client.bulk(operations=operations, refresh=refresh)
+            results = {}
+            for item in response['items']:
+                if 'update' in item:
+                    update = item['update']
+                    results[update['_id']] = 'not_found' if update['status'] == 404 else update.get('result', 'error')
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "bulk_script_update_and_delete_documents",
+                "resource": index_name,
+                "message": f"Bulk scripted update of {len(scripts)} documents in {script_index_name} and delete of "
+                           f"{len(doc_ids)} documents in {index_name} completed.",
+                "details": {"updated_count": len(scripts), "deleted_count": len(doc_ids), "errors": response['errors']}
+            })
+            return results
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error performing bulk scripted update and delete in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "script_index_name": script_index_name}
+            })
+            raise
+
+    def bulk_delete_documents(self, index_name, doc_ids, refresh=None):
         """Performs a bulk delete operation for multiple documents."""
         try:
             actions = [
@@ -320,7 +592,7 @@ class ESFacade:
                     '_id': doc_id
                 } for doc_id in doc_ids
             ]
-            helpers.bulk(self.es_client, actions)
+            helpers.bulk(self.es_client, actions, refresh=refresh)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -329,6 +601,16 @@ class ESFacade:
                 "message": f"Bulk delete operation completed successfully for {index_name}.",
                 "details": {"documents_count": len(doc_ids)}
             })
+        except helpers.BulkIndexError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"{len(e.errors)} documents failed in bulk delete operation in {index_name}.",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name, "errors": e.errors}
+            })
+            raise
         except ApiError as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
@@ -340,6 +622,74 @@ class ESFacade:
             })
             raise
 
+    def update_by_query(self, index_name, query, script, max_docs=None):
+        """Updates every document matching the query with a script, skipping documents changed concurrently."""
+        try:
+            response = self.es_client.update_by_query(
+                index=index_name,
+                body={"query": query, "script": script},
+                max_docs=max_docs,
+                conflicts='proceed',
+                refresh=True
+            )
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "update_by_query",
+                "resource": index_name,
+                "message": f"Update by query updated {response['updated']} documents in {index_name}.",
+                "details": {"updated": response['updated'], "version_conflicts": response['version_conflicts']}
+            })
+            return response['updated']
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error running update by query in {index_name}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name}
+            })
+            raise
+
+    def iter_point_in_time(self, index_name, query, sort, page_size=1000, keep_alive='5m'):
+        """Pages through every document matching a query in one point-in-time view, with search_after on sort."""
+        pit_id = self.es_client.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "open_point_in_time",
+            "resource": index_name,
+            "message": f"Point in time opened on index {index_name}.",
+            "details": {"query": query, "sort": sort}
+        })
+        try:
+            search_after = None
+            while True:
+                body = {"query": query, "sort": sort, "size": page_size,
+                        "pit": {"id": pit_id, "keep_alive": keep_alive}}
+                if search_after is not None:
+                    body["search_after"] = search_after
+                response = self.es_client.search(body=body)
+                pit_id = response.get('pit_id', pit_id)
+                hits = response['hits']['hits']
+                if not hits:
+                    return
+                yield hits
+                search_after = hits[-1]['sort']
+        except ApiError as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error scanning index {index_name} at a point in time: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"index_name": index_name}
+            })
+            raise
+        finally:
+            self.es_client.close_point_in_time(id=pit_id)
+
     def refresh_index(self, index_name):
         """Refreshes an Elasticsearch index to make recent changes searchable."""
         try:
@@ -0,0 +1,194 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from elasticsearch import helpers
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class BloomFilter:
+    """
+    Bloom filter over SHA-256 hex digests; the digests are already uniform, so they are sliced instead of
+    re-hashed.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.bit_count = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.bit_count / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.item_count = 0
+
+    def _positions(self, file_hash):
+        first, second = int(file_hash[:16], 16), int(file_hash[16:32], 16) | 1
+        return ((first + index * second) % self.bit_count for index in range(self.hash_count))
+
+    def add(self, file_hash):
+        for position in self._positions(file_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.item_count += 1
+
+    def __contains__(self, file_hash):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(file_hash))
+
+
+class LRUCache:
+    """Thread-safe LRU mapping with a per-entry time to live."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class HashLookupCache:
+    """
+    Per-worker Bloom filter and LRU in front of the blob registry.
+
+    The filter is filled by a background scroll of the blob index and kept current by this worker's own
+    registrations plus a periodic pull of recently created blobs from other workers. A definite miss skips
+    Elasticsearch entirely; anything else goes to the registry, which is authoritative. Until the first load
+    finishes every hash counts as possibly known, so the filter never hides a duplicate it has not seen yet.
+    The loader starts with the first lookup, so processes that never deduplicate, such as most management
+    commands, never scan the index, and a pre-forking server starts it in each worker rather than the parent.
+    The LRU keeps the blobs this worker saw recently, so taking a reference to one of them does not read its
+    source back; the reference is taken against the cached original key, and a blob that moved elsewhere
+    since is read again.
+    """
+
+    source_fields = ["original_key", "storage_mode", "size", "codec"]
+
+    def __init__(self, es_facade, index_name):
+        self.es_facade = es_facade
+        self.index_name = index_name
+        self.bloom_filter = BloomFilter(settings.HASH_BLOOM_CAPACITY, settings.HASH_BLOOM_ERROR_RATE)
+        self.lru_cache = LRUCache(settings.HASH_LRU_SIZE, settings.HASH_CACHE_TTL)
+        self.sync_interval = settings.HASH_CACHE_SYNC_INTERVAL
+        self.sync_overlap = settings.HASH_CACHE_SYNC_OVERLAP
+        self.loaded = False
+        self.watermark = None
+        self.counters = {
+            "bloom_negatives": 0,
+            "bloom_positives": 0,
+            "bloom_false_positives": 0,
+            "lru_hits": 0,
+            "lru_misses": 0
+        }
+        self.loader = None
+        self.loader_lock = threading.Lock()
+
+    def might_contain(self, file_hash):
+        if self.loader is None:
+            self._start_loader()
+        if not self.loaded:
+            return True
+        if file_hash in self.bloom_filter:
+            self.counters["bloom_positives"] += 1
+            return True
+        self.counters["bloom_negatives"] += 1
+        return False
+
+    def get(self, file_hash):
+        blob = self.lru_cache.get(file_hash)
+        self.counters["lru_hits" if blob else "lru_misses"] += 1
+        return blob
+
+    def remember(self, file_hash, blob):
+        self.bloom_filter.add(file_hash)
+        self.lru_cache.put(file_hash, {field: blob.get(field) for field in self.source_fields})
+
+    def record_false_positive(self):
+        self.counters["bloom_false_positives"] += 1
+
+    def discard(self, file_hash):
+        self.lru_cache.discard(file_hash)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "loaded": self.loaded,
+            "bloom_insertions": self.bloom_filter.item_count,
+            "bloom_bits": self.bloom_filter.bit_count,
+            "bloom_hash_count": self.bloom_filter.hash_count,
+            "lru_size": len(self.lru_cache),
+            "lru_max_size": self.lru_cache.max_size
+        }
+
+    def _start_loader(self):
+        with self.loader_lock:
+            if self.loader is None:
+                loader = threading.Thread(target=self._load_forever, name='hash-cache-loader', daemon=True)
+                loader.start()
+                self.loader = loader
+
+    def _load_forever(self):
+        while True:
+            try:
+                self._sync()
+            except Exception as e:
+                error_logger.error({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "level": "ERROR",
+                    "message": f"Error loading hash cache from {self.index_name}: {str(e)}",
+                    "exception": str(e),
+                    "stack_trace": None,
+                    "context": {"index_name": self.index_name, "loaded": self.loaded}
+                })
+            time.sleep(self.sync_interval)
+
+    def _sync(self):
+        started_at = int(datetime.now().timestamp() * 1000)
+        query = {"match_all": {}}
+        if self.watermark is not None:
+            # Re-read an overlap window so blobs registered while the previous scan ran are not missed.
+            query = {"range": {"creation_date": {"gte": self.watermark - self.sync_overlap * 1000}}}
+
+        loaded_count = 0
+        for hit in helpers.scan(self.es_facade.es_client, index=self.index_name,
+                                query={"query": query, "_source": False}, size=5000):
+            self.bloom_filter.add(hit['_id'])
+            loaded_count += 1
+
+        self.watermark = started_at
+        if not self.loaded:
+            self.loaded = True
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "hash_cache_loaded",
+                "resource": self.index_name,
+                "message": f"Hash cache loaded {loaded_count} hashes from {self.index_name}.",
+                "details": self.stats()
+            })
@@ -0,0 +1,93 @@
+import ctypes
+import ctypes.util
+import hashlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+_libcrypto = None
+_libcrypto_version = None
+
+
+class HashStateMismatch(Exception):
+    pass
+
+
+def _load_libcrypto():
+    global _libcrypto, _libcrypto_version
+    if _libcrypto is None:
+        library_path = ctypes.util.find_library('crypto')
+        if library_path is None:
+            raise ImproperlyConfigured("libcrypto is required for resumable SHA-256 hashing.")
+        library = ctypes.CDLL(library_path)
+        try:
+            library.SHA256_Init.argtypes = [ctypes.c_void_p]
+            library.SHA256_Update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+            library.SHA256_Final.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+            version_num = getattr(library, 'OpenSSL_version_num', None) or library.SSLeay
+        except AttributeError:
+            raise ImproperlyConfigured(
+                f"{library_path} does not export the SHA256_* functions needed for resumable SHA-256 hashing."
+            )
+        version_num.restype = ctypes.c_ulong
+        _libcrypto_version = version_num()
+        _libcrypto = library
+    return _libcrypto
+
+
+class ResumableSHA256:
+    """
+    SHA-256 whose intermediate state can be exported and restored in another process.
+
+    hashlib cannot serialize a running hash, so this wraps OpenSSL's deprecated SHA256_CTX API directly. The
+    context holds no pointers, so its raw bytes are a snapshot, but its layout belongs to the libcrypto ABI:
+    states are only portable between workers running the same libcrypto. Every state therefore carries the
+    libcrypto version it was taken with, and restoring one under another version raises HashStateMismatch
+    instead of producing a wrong digest; the upload has to start over. check() verifies at startup that the
+    loaded library exports the API and that a snapshot taken mid-hash restores to the digest hashlib gives.
+    """
+
+    state_size = 112
+    version_size = 8
+
+    def __init__(self, state=None):
+        self._library = _load_libcrypto()
+        if state:
+            # States saved before the version prefix existed are the bare context.
+            if len(state) > self.state_size:
+                version = int.from_bytes(state[:self.version_size], 'big')
+                if version != _libcrypto_version:
+                    raise HashStateMismatch(
+                        f"The hash state was saved with libcrypto {version:#x}, but {_libcrypto_version:#x} is loaded."
+                    )
+                state = state[self.version_size:]
+            self._context = ctypes.create_string_buffer(state, self.state_size)
+        else:
+            self._context = ctypes.create_string_buffer(self.state_size)
+            self._library.SHA256_Init(self._context)
+
+    @classmethod
+    def check(cls):
+        """Raises ImproperlyConfigured unless hash states survive a round trip on the loaded libcrypto."""
+        data = bytes(range(256)) * 3
+        hasher = cls()
+        hasher.update(data[:100])
+        restored = cls(hasher.state())
+        restored.update(data[100:])
+        if restored.hexdigest() != hashlib.sha256(data).hexdigest():
+            raise ImproperlyConfigured(
+                "The SHA256_CTX layout of the loaded libcrypto does not match the one resumable hashing expects."
+            )
+
+    def update(self, data):
+        data = bytes(data)
+        self._library.SHA256_Update(self._context, data, len(data))
+
+    def state(self):
+        return _libcrypto_version.to_bytes(self.version_size, 'big') + self._context.raw
+
+    def hexdigest(self):
+        # Finalizing destroys the context, so work on a copy and keep this hash resumable.
+        context = ctypes.create_string_buffer(self._context.raw, self.state_size)
+        digest = ctypes.create_string_buffer(32)
+        self._library.SHA256_Final(digest, context)
+        return digest.raw.hex()
@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PresignedUrlCache:
+    """
+    Bounded LRU of presigned download URLs, one entry per (bucket, key).
+
+    An entry is reused only for the same object version and only while at least min_remaining seconds of
+    its validity are left, so a handed-out URL never expires mid-download. Handing out the same URL for
+    an unchanged object also lets browsers and CDNs cache the download.
+    """
+
+    def __init__(self, max_size, min_remaining):
+        self.max_size = max_size
+        self.min_remaining = min_remaining
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket_name, key, version):
+        with self.lock:
+            entry = self.entries.get((bucket_name, key))
+            if entry is None or entry[0] != version or entry[2] - time.time() < self.min_remaining:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((bucket_name, key))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, bucket_name, key, version, url, expiration):
+        with self.lock:
+            self.entries[(bucket_name, key)] = (version, url, time.time() + expiration)
+            self.entries.move_to_end((bucket_name, key))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, bucket_name, key):
+        with self.lock:
+            self.entries.pop((bucket_name, key), None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "max_size": self.max_size}
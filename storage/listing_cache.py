@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class FolderListingCache:
+    """
+    Folder listings cached in a Django cache, keyed by user and folder prefix.
+
+    Every folder has a generation token that is part of its listing keys. A write replaces the token of the
+    folder it touches and of all its parents, which makes their cached pages unreachable at once without
+    scanning the cache. Entries stay fresh for `ttl` seconds and may then be served stale for up to
+    `stale_ttl` more while a background refresh reloads them.
+
+    Generation tokens only work if every process writing to storage sees the same cache, so a per-process
+    backend is refused.
+    """
+
+    refresh_lock_timeout = 30
+
+    def __init__(self, cache_alias, ttl, stale_ttl, refresh_workers=2):
+        self.cache = caches[cache_alias]
+        if isinstance(self.cache, (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured(
+                f"The listing cache needs a cache shared by all processes, but cache {cache_alias!r} is "
+                f"{type(self.cache).__name__}; configure a shared backend or disable LISTING_CACHE_ENABLED."
+            )
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                                   thread_name_prefix='listing-cache-refresh')
+        self.counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "invalidations": 0
+        }
+
+    @staticmethod
+    def normalize_folder(folder_path):
+        return folder_path.strip('/')
+
+    def get_or_load(self, user_id, folder_path, variant, loader):
+        folder_path = self.normalize_folder(folder_path)
+        entry_key = self._entry_key(user_id, folder_path, variant)
+        entry = self.cache.get(entry_key)
+
+        if entry is None:
+            self.counters["misses"] += 1
+            value = loader()
+            self._store(entry_key, value)
+            return value
+
+        if entry['fresh_until'] > time.time():
+            self.counters["hits"] += 1
+        else:
+            self.counters["stale_hits"] += 1
+            if self.cache.add(f"{entry_key}:refreshing", 1, self.refresh_lock_timeout):
+                self.refresh_executor.submit(self._refresh, entry_key, loader)
+        return entry['value']
+
+    def invalidate_key(self, user_id, key):
+        """Invalidates the folder holding an object key and every folder above it."""
+        self.invalidate_keys(user_id, [key])
+
+    def invalidate_keys(self, user_id, keys):
+        """Invalidates the folders holding any of the keys, and their parents, with a single cache write."""
+        folders = set()
+        for key in keys:
+            folder_path = os.path.dirname(self.normalize_folder(key))
+            while folder_path not in folders:
+                folders.add(folder_path)
+                if not folder_path:
+                    break
+                folder_path = os.path.dirname(folder_path)
+
+        self.cache.set_many({self._generation_key(user_id, folder): uuid.uuid4().hex for folder in folders},
+                            timeout=None)
+        self.counters["invalidations"] += 1
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["stale_hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": (self.counters["hits"] + self.counters["stale_hits"]) / lookups if lookups else None
+        }
+
+    @staticmethod
+    def _digest(*parts):
+        # Folder names may hold characters or lengths that cache backends such as memcached reject.
+        return hashlib.sha1('\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def _generation_key(self, user_id, folder_path):
+        return f"folder-listing-generation:{self._digest(user_id, folder_path)}"
+
+    def _entry_key(self, user_id, folder_path, variant):
+        generation_key = self._generation_key(user_id, folder_path)
+        generation = self.cache.get(generation_key)
+        if generation is None:
+            # A generation is never reused, so an evicted token cannot revive listings cached under it.
+            self.cache.add(generation_key, uuid.uuid4().hex, timeout=None)
+            generation = self.cache.get(generation_key)
+        return f"folder-listing:{self._digest(user_id, folder_path, generation, variant)}"
+
+    def _store(self, entry_key, value):
+        self.cache.set(entry_key, {'value': value, 'fresh_until': time.time() + self.ttl},
+                       timeout=self.ttl + self.stale_ttl)
+
+    def _refresh(self, entry_key, loader):
+        try:
+            self._store(entry_key, loader())
+            self.counters["refreshes"] += 1
+        except Exception as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error refreshing folder listing {entry_key}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"entry_key": entry_key}
+            })
+        finally:
+            self.cache.delete(f"{entry_key}:refreshing")
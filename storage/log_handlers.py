@@ -1,23 +1,37 @@
+import atexit
 import logging
+import queue
+import threading
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 
 from azin.settings import ES_HOST, ES_PORT
 from storage.es_mappings import AUDIT_LOG_MAPPING, ERROR_LOG_MAPPING
 
 
 class AuditLogElasticsearchHandler(logging.Handler):
+    """Buffers audit records and ships them with bulk requests from a background thread, off the request path."""
+
     def __init__(
             self,
             hosts=f'http://{ES_HOST}:{ES_PORT}',
             index_name='audit-logs',
-            mapping=AUDIT_LOG_MAPPING
+            mapping=AUDIT_LOG_MAPPING,
+            batch_size=500,
+            flush_interval=1.0,
+            max_buffer_size=10000
     ):
         logging.Handler.__init__(self)
         self.client = Elasticsearch(hosts=hosts)
         self.index_name = index_name
         self.mapping = mapping
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = queue.Queue(maxsize=max_buffer_size)
         self.ensure_index()
+        self.flusher = threading.Thread(target=self._flush_forever, name='audit-log-flusher', daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
 
     def ensure_index(self):
         if not self.client.indices.exists(index=self.index_name):
@@ -26,7 +40,44 @@ class AuditLogElasticsearchHandler(logging.Handler):
     def emit(self, record):
         if not isinstance(record.msg, dict):
             return
-        self.client.index(index=self.index_name, body=record.msg)
+        try:
+            self.buffer.put_nowait(record.msg)
+        except queue.Full:
+            self.handleError(record)
+
+    def flush(self):
+        records = []
+        while True:
+            try:
+                records.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+            if len(records) >= self.batch_size:
+                self._ship(records)
+                records = []
+        self._ship(records)
+
+    def _flush_forever(self):
+        while True:
+            try:
+                records = [self.buffer.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            self._ship(records)
+
+    def _ship(self, records):
+        if not records:
+            return
+        try:
+            helpers.bulk(self.client, ({'_index': self.index_name, '_source': record} for record in records))
+        except Exception:
+            # Logging must never take the request down; dropped audit batches are reported on stderr.
+            logging.getLogger('django').exception("Failed to ship %d audit log records.", len(records))
 
 
 class ErrorLogElasticsearchHandler(logging.Handler):
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from storage.reconcile_utils import ReconcileFacade
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = ('Registers blobs for originals indexed before the blob registry existed, '
+            'so that later uploads of their content are deduplicated again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the originals without a blob.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Originals checked against the registry per request.')
+
+    def handle(self, *args, **options):
+        reconcile_facade = ReconcileFacade(StorageFacade(), dry_run=options['dry_run'])
+        registered_count = reconcile_facade.backfill_blobs(batch_size=options['batch_size'])
+        if options['dry_run']:
+            self.stdout.write(f"{registered_count} originals have no blob.")
+        else:
+            self.stdout.write(f"Registered {registered_count} blobs.")
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Removes chunks that no file manifest has referenced for STORAGE_CHUNK_GC_GRACE seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Maximum number of chunks collected per pass.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between passes; 0 runs a single pass and exits.')
+
+    def handle(self, *args, **options):
+        storage_facade = StorageFacade()
+
+        while True:
+            collected_count = storage_facade.collect_chunks(batch_size=options['batch_size'])
+            self.stdout.write(f"Collected {collected_count} unreferenced chunks.")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
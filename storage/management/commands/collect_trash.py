@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Purges trash entries past their retention period and removes content no longer referenced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Maximum number of trash entries purged per batch.')
+        parser.add_argument('--max-operations', type=int, default=10_000,
+                            help='Maximum number of S3 object operations per pass.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between passes; 0 runs a single pass and exits.')
+
+    def handle(self, *args, **options):
+        storage_facade = StorageFacade()
+
+        while True:
+            result = storage_facade.collect_trash(batch_size=options['batch_size'],
+                                                  max_operations=options['max_operations'])
+            self.stdout.write(f"Purged {result['purged_count']} trash entries, {result['failed_count']} failed.")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
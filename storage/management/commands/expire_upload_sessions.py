@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.resumable_utils import ResumableUploadFacade
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Aborts the multipart uploads of resumable upload sessions abandoned by their clients.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Maximum number of sessions expired per pass.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between passes; 0 runs a single pass and exits.')
+
+    def handle(self, *args, **options):
+        resumable_upload_facade = ResumableUploadFacade(StorageFacade())
+
+        while True:
+            expired_count = resumable_upload_facade.expire_sessions(batch_size=options['batch_size'])
+            self.stdout.write(f"Expired {expired_count} upload sessions.")
+            if not options['interval']:
+                break
+            if expired_count < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.staging_utils import StagedUploadFacade
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Hashes and promotes direct-to-S3 uploads that clients have marked as uploaded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Maximum number of staged uploads finalized per pass.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between passes; 0 runs a single pass and exits.')
+
+    def handle(self, *args, **options):
+        staged_upload_facade = StagedUploadFacade(StorageFacade())
+
+        while True:
+            finalized_count = staged_upload_facade.finalize_uploaded(batch_size=options['batch_size'])
+            self.stdout.write(f"Finalized {finalized_count} staged uploads.")
+            if not options['interval']:
+                break
+            if finalized_count < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Generates queued thumbnails and previews, once per content hash.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help='Maximum number of tasks claimed per batch.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds to wait when the queue is empty; 0 drains once and exits.')
+
+    def handle(self, *args, **options):
+        storage_facade = StorageFacade()
+
+        while True:
+            processed_count = storage_facade.process_derivative_tasks(batch_size=options['batch_size'])
+            self.stdout.write(f"Processed {processed_count} derivative tasks.")
+            if processed_count:
+                continue
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from storage.reconcile_utils import ReconcileFacade
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = ('Compares the user buckets with the hash index and reports, or repairs, orphaned entries, '
+            'missing entries, broken links and drifted usage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='user_ids',
+                            help='Reconcile only this user; may be repeated. Defaults to every user.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be repaired.')
+        parser.add_argument('--grace', type=int, default=900,
+                            help='Seconds during which new objects and entries are left alone.')
+        parser.add_argument('--page-size', type=int, default=1000,
+                            help='Keys listed and entries scanned per request, at most 1000.')
+
+    def handle(self, *args, **options):
+        reconcile_facade = ReconcileFacade(StorageFacade(), dry_run=options['dry_run'], grace=options['grace'],
+                                           page_size=options['page_size'])
+
+        # Entries indexed before object_key existed cannot take part in the merge join until they have it.
+        backfilled_count = reconcile_facade.backfill_object_keys()
+        if backfilled_count:
+            self.stdout.write(f"Added object_key to {backfilled_count} entries.")
+
+        for user_id in options['user_ids'] or reconcile_facade.iter_user_ids():
+            report = reconcile_facade.reconcile_user(user_id)
+            counts = report['counts']
+            self.stdout.write(
+                f"{user_id}: {report['objects_count']} objects, {report['entries_count']} entries, "
+                f"{counts['missing_entries']} missing entries, {counts['orphans']} orphans, "
+                f"{counts['broken_links']} broken links, {counts['repaired']} repaired, "
+                f"{counts['repair_failed'] + counts['unrepairable']} not repaired."
+            )
+            for kind in ('missing_entries', 'orphans', 'broken_links'):
+                for key in report[kind]:
+                    self.stdout.write(f"  {kind}: {key}")
+            if report['usage']:
+                self.stdout.write(f"  usage recorded {report['usage']['recorded']}, "
+                                  f"actual {report['usage']['actual']}")
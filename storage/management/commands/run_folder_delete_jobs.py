@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.delete_job_utils import FolderDeleteJobFacade
+from storage.storage_utils import StorageFacade
+
+
+class Command(BaseCommand):
+    help = 'Runs queued folder delete jobs and resumes the ones whose worker stopped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help='Maximum number of jobs claimed per pass.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Jobs run in parallel; defaults to STORAGE_DELETE_JOB_WORKERS.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between passes; 0 runs a single pass and exits.')
+
+    def handle(self, *args, **options):
+        folder_delete_job_facade = FolderDeleteJobFacade(StorageFacade(), workers=options['workers'])
+
+        while True:
+            run_count = folder_delete_job_facade.resume_jobs(batch_size=options['batch_size'])
+            self.stdout.write(f"Ran {run_count} folder delete jobs.")
+            if not options['interval']:
+                break
+            if run_count < options['batch_size']:
+                time.sleep(options['interval'])
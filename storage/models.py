@@ -1,3 +1,32 @@
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 
-# Create your models here.
+
+class UserStorageState(models.Model):
+    """
+    Generation counter of a user's stored files, folders and usage.
+
+    Every write through StorageFacade bumps it, so read views can answer conditional requests from this one
+    row instead of asking S3 or Elasticsearch whether anything changed.
+    """
+
+    user_id = models.CharField(max_length=150, unique=True)
+    generation = models.BigIntegerField(default=0)
+    modified_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def bump(cls, user_id):
+        updated = cls.objects.filter(user_id=user_id).update(generation=F('generation') + 1,
+                                                             modified_at=timezone.now())
+        if not updated:
+            _, created = cls.objects.get_or_create(user_id=user_id, defaults={'generation': 1})
+            if not created:
+                # Another writer created the row first; its generation may already have been served.
+                cls.objects.filter(user_id=user_id).update(generation=F('generation') + 1,
+                                                           modified_at=timezone.now())
+
+    @classmethod
+    def current(cls, user_id):
+        state, _ = cls.objects.get_or_create(user_id=user_id)
+        return state
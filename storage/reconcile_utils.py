@@ -0,0 +1,337 @@
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+
+from django.conf import settings
+from elasticsearch import NotFoundError, helpers
+
+from storage.models import UserStorageState
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class ReconcileFacade:
+    """
+    Finds and repairs drift between the user buckets and the hash index.
+
+    For each user, the bucket listing and a point-in-time scan of the user's index entries, sorted by
+    object_key, are walked side by side like a merge join. Both arrive in key order, so only one page of
+    each is held at a time. Any key present on one side only is reported:
+    - an S3 object without an entry is a missing entry;
+    - an entry without an S3 object is an orphan.
+    Links whose original is gone are reported as broken. In repair mode:
+    - missing entries are indexed from the object metadata, and their blob is registered;
+    - orphans are removed and their blob references released;
+    - broken links are re-pointed at the current holder of their content when one is left;
+    - usage is reset to the totals of the entries, for users without writes in flight.
+    Objects and entries younger than `grace` seconds are skipped, since their writes may still be in flight.
+    """
+
+    object_key_script = """
+        String folder = ctx._source.folder_path;
+        ctx._source.object_key = folder == null || folder == '' ? ctx._source.filename
+                                                                 : folder + '/' + ctx._source.filename;
+    """
+    sample_size = 20
+
+    def __init__(self, storage_facade, dry_run=True, grace=900, page_size=1000):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "init",
+            "resource": "ReconcileFacade",
+            "message": "Initializing ReconcileFacade",
+            "details": {"dry_run": dry_run, "grace": grace}
+        })
+        self.storage_facade = storage_facade
+        self.s3_facade = storage_facade.s3_facade
+        self.es_facade = storage_facade.es_facade
+        self.file_hash_index = storage_facade.file_hash_index
+        self.staging_prefix = settings.S3_STAGING_PREFIX
+        self.dry_run = dry_run
+        self.grace = grace
+        self.page_size = min(page_size, 1000)
+
+    def backfill_object_keys(self):
+        """Adds object_key to entries indexed before it existed; the merge join sorts on it."""
+        backfilled_count = 0
+        while True:
+            updated_count = self.es_facade.update_by_query(
+                self.file_hash_index, {"bool": {"must_not": [{"exists": {"field": "object_key"}}]}},
+                {"source": self.object_key_script, "lang": "painless"}, max_docs=10_000
+            )
+            backfilled_count += updated_count
+            if not updated_count:
+                return backfilled_count
+
+    def backfill_blobs(self, batch_size=1000):
+        """
+        Registers a blob for every original indexed before the blob registry existed. Without one its content
+        is never found again, so every later upload of it is stored as a new original. Returns the number of
+        blobs registered, or that would be in a dry run.
+        """
+        registered_count = 0
+        originals = {}
+        for hit in helpers.scan(self.es_facade.es_client, index=self.file_hash_index, query={
+            "_source": ["hash", "original_key", "size", "storage_mode", "codec"]
+        }, size=batch_size):
+            if hit['_source'].get('original_key', hit['_id']) == hit['_id']:
+                originals.setdefault(hit['_source']['hash'], {**hit['_source'], "original_key": hit['_id']})
+            if len(originals) >= batch_size:
+                registered_count += self._register_missing_blobs(originals)
+                originals = {}
+        if originals:
+            registered_count += self._register_missing_blobs(originals)
+        return registered_count
+
+    def _register_missing_blobs(self, originals):
+        registered_blobs = self.es_facade.get_documents(self.storage_facade.blob_index, list(originals))
+        missing = {file_hash: document for file_hash, document in originals.items()
+                   if file_hash not in registered_blobs}
+        if self.dry_run or not missing:
+            return len(missing)
+
+        # The original and each of its links hold one reference, as if they had been stored with the registry.
+        response = self.es_facade.search(self.file_hash_index, {
+            "size": 0,
+            "query": {"terms": {"hash": list(missing)}},
+            "aggs": {"references": {"terms": {"field": "hash", "size": len(missing)}}}
+        })
+        ref_counts = {bucket['key']: bucket['doc_count']
+                      for bucket in response['aggregations']['references']['buckets']}
+
+        registered_count = 0
+        for file_hash, document in missing.items():
+            blob = {
+                "hash": file_hash,
+                "original_key": document['original_key'],
+                "size": document.get('size', 0),
+                "ref_count": ref_counts.get(file_hash, 1),
+                "creation_date": int(datetime.now().timestamp() * 1000)
+            }
+            if document.get('storage_mode'):
+                blob["storage_mode"] = document['storage_mode']
+            if document.get('codec'):
+                blob["codec"] = document['codec']
+            # A blob registered concurrently by a new upload of the same content is left as it is.
+            registered_count += self.es_facade.create_document(self.storage_facade.blob_index, file_hash, blob)
+        return registered_count
+
+    def iter_user_ids(self):
+        """Yields every user with a bucket or a usage entry, each once."""
+        seen_user_ids = set()
+        for user_id in self.s3_facade.iter_user_ids():
+            seen_user_ids.add(user_id)
+            yield user_id
+        for hit in helpers.scan(self.es_facade.es_client, index=self.storage_facade.user_usage_index,
+                                query={"_source": False}, size=1000):
+            if hit['_id'] not in seen_user_ids:
+                yield hit['_id']
+
+    def reconcile_user(self, user_id):
+        report = {
+            "user_id": user_id,
+            "objects_count": 0,
+            "entries_count": 0,
+            "missing_entries": [],
+            "orphans": [],
+            "broken_links": [],
+            "counts": Counter(),
+            "usage": None
+        }
+        self.cutoff = int(datetime.now().timestamp() * 1000) - self.grace * 1000
+        self.usage = {"total_size": 0, "stored_size": 0, "file_count": 0}
+        self.orphans, self.links = [], []
+
+        objects = self._iter_objects(user_id, report)
+        entries = self._iter_entries(user_id, report)
+        item, hit = next(objects, None), next(entries, None)
+        while item is not None or hit is not None:
+            entry_key = hit['_source']['object_key'] if hit is not None else None
+            if hit is None or (item is not None and item['key'] < entry_key):
+                self._missing_entry(user_id, item, report)
+                item = next(objects, None)
+            elif item is None or entry_key < item['key']:
+                self._orphan(user_id, hit, report)
+                hit = next(entries, None)
+            else:
+                self._matched(user_id, hit, report)
+                item, hit = next(objects, None), next(entries, None)
+        self._flush_orphans(user_id, report)
+        self._flush_links(user_id, report)
+        self._check_usage(user_id, report)
+
+        if not self.dry_run and (report["counts"]["repaired"] or report["usage"]):
+            UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "storage_reconciled",
+            "resource": self.s3_facade.generate_bucket_name(user_id),
+            "message": f"Reconciled storage of user {user_id}{' (dry run)' if self.dry_run else ''}.",
+            "details": {"objects_count": report["objects_count"], "entries_count": report["entries_count"],
+                        "counts": dict(report["counts"]), "usage": report["usage"]}
+        })
+        return report
+
+    def _iter_objects(self, user_id, report):
+        for page in self.s3_facade.iter_prefix_pages(user_id, '', page_size=self.page_size):
+            for item in page:
+                if item['key'].endswith('/') or item['key'].startswith(self.staging_prefix):
+                    continue
+                report["objects_count"] += 1
+                yield item
+
+    def _iter_entries(self, user_id, report):
+        for hits in self.es_facade.iter_point_in_time(self.file_hash_index,
+                                                      {"term": {"user_id.keyword": user_id}},
+                                                      [{"object_key": "asc"}], page_size=self.page_size):
+            for hit in hits:
+                report["entries_count"] += 1
+                yield hit
+
+    def _record(self, report, kind, sample):
+        report["counts"][kind] += 1
+        if len(report[kind]) < self.sample_size:
+            report[kind].append(sample)
+
+    def _count_usage(self, document):
+        self.usage["total_size"] += document.get('size', 0)
+        self.usage["stored_size"] += document.get('stored_size', document.get('size', 0))
+        self.usage["file_count"] += 1
+
+    def _missing_entry(self, user_id, item, report):
+        last_modified = item.get('last_modified')
+        if last_modified is not None and last_modified.astimezone(timezone.utc).timestamp() * 1000 > self.cutoff:
+            report["counts"]["in_flight"] += 1
+            return
+        self._record(report, "missing_entries", item['key'])
+        if self.dry_run:
+            return
+
+        file_path = item['key']
+        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+        try:
+            metadata = self.s3_facade.stat_object(user_id, file_path)['metadata']
+            storage_mode = 'chunked' if 'chunk-manifest' in metadata else None
+            if 'original-key' in metadata:
+                content_hash = metadata.get('content-hash') or self.es_facade.get_document(
+                    self.file_hash_index, metadata['original-key'])['hash']
+                result, _ = self.storage_facade._acquire_blob(content_hash)
+                if result != 'updated':
+                    self._record(report, "broken_links", file_path)
+                    return
+                file_size, stored_size, original_key = 0, 0, metadata['original-key']
+            else:
+                content_hash = self.storage_facade._stored_content_hash(user_id, file_path,
+                                                                        f"{bucket_name}/{file_path}", metadata)
+                file_size = int(metadata.get('logical-size', item['size']))
+                stored_size = file_size if storage_mode else item['size']
+                original_key = f"{bucket_name}/{file_path}"
+                # Content that already has a holder gains a reference, which this copy keeps as a duplicate.
+                self.storage_facade._register_blob(content_hash, original_key, file_size, storage_mode,
+                                                   metadata.get('codec'))
+
+            self.storage_facade._index_file_hash(file_path, content_hash, user_id, file_size,
+                                                 original_key=original_key, storage_mode=storage_mode,
+                                                 codec=metadata.get('codec'), stored_size=stored_size)
+            self._count_usage({"size": file_size, "stored_size": stored_size})
+            report["counts"]["repaired"] += 1
+        except Exception as e:
+            report["counts"]["repair_failed"] += 1
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error indexing {file_path} of user {user_id} during reconciliation: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+
+    def _orphan(self, user_id, hit, report):
+        document = hit['_source']
+        if document.get('creation_date', 0) > self.cutoff:
+            report["counts"]["in_flight"] += 1
+            self._count_usage(document)
+            return
+        self._record(report, "orphans", document['object_key'])
+        if self.dry_run:
+            return
+        self.orphans.append(hit)
+        if len(self.orphans) >= self.page_size:
+            self._flush_orphans(user_id, report)
+
+    def _matched(self, user_id, hit, report):
+        self._count_usage(hit['_source'])
+        if hit['_source'].get('original_key') != hit['_id']:
+            self.links.append(hit)
+            if len(self.links) >= self.page_size:
+                self._flush_links(user_id, report)
+
+    def _flush_orphans(self, user_id, report):
+        if not self.orphans:
+            return
+        self.storage_facade._delete_and_release(self.file_hash_index, [hit['_id'] for hit in self.orphans],
+                                                Counter(hit['_source']['hash'] for hit in self.orphans))
+        report["counts"]["repaired"] += len(self.orphans)
+        self.orphans = []
+
+    def _flush_links(self, user_id, report):
+        """Checks a batch of links against their originals with one multi-get, then S3 for the ones not found."""
+        if not self.links:
+            return
+        links, self.links = self.links, []
+        originals = self.es_facade.get_documents(self.file_hash_index,
+                                                 list({hit['_source']['original_key'] for hit in links}))
+
+        for hit in links:
+            original_key = hit['_source']['original_key']
+            if original_key in originals or self._object_exists(original_key):
+                continue
+            self._record(report, "broken_links", hit['_source']['object_key'])
+            if not self.dry_run:
+                self._repoint_link(user_id, hit, report)
+
+    def _object_exists(self, original_key):
+        bucket_name, file_path = original_key.split('/', 1)
+        try:
+            self.s3_facade.stat_object(bucket_name.split('-')[1], file_path)
+            return True
+        except Exception:
+            return False
+
+    def _repoint_link(self, user_id, hit, report):
+        document = hit['_source']
+        try:
+            blob = self.es_facade.get_document(self.storage_facade.blob_index, document['hash'])
+        except NotFoundError:
+            blob = None
+        if blob is None or blob['original_key'] == document['original_key'] \
+                or not self._object_exists(blob['original_key']):
+            # No copy of the content is left; the link is reported but kept, so nothing more is lost.
+            report["counts"]["unrepairable"] += 1
+            return
+
+        self.s3_facade.upload_file(user_id, document['object_key'], b'', self.storage_facade._link_metadata(
+            blob['original_key'], blob.get('storage_mode'), document['hash'], blob.get('codec')
+        ))
+        self.es_facade.update_document(self.file_hash_index, hit['_id'], {"original_key": blob['original_key']})
+        report["counts"]["repaired"] += 1
+
+    def _check_usage(self, user_id, report):
+        # Usage moves with writes that are still in flight, so it is only compared for a quiet user.
+        if report["counts"]["in_flight"] or self.storage_facade.task_queue.pending_count('finalize_object', user_id):
+            return
+        try:
+            usage = self.es_facade.get_document(self.storage_facade.user_usage_index, user_id)
+        except NotFoundError:
+            return
+        recorded = {field: usage.get(field, usage['total_size'] if field == 'stored_size' else 0)
+                    for field in self.usage}
+        if recorded == self.usage:
+            return
+
+        report["usage"] = {"recorded": recorded, "actual": dict(self.usage)}
+        if not self.dry_run:
+            self.es_facade.update_document(self.storage_facade.user_usage_index, user_id, dict(self.usage))
@@ -163,6 +163,8 @@ class ReportFacade:
     def get_user_usage(self, user_id):
         try:
             usage_data = self.client.get(index=self.user_usage_index, id=user_id)['_source']
+            # Usage recorded before stored sizes were tracked has none; the template shows the logical size.
+            usage_data.setdefault('stored_size', None)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": "system",
@@ -193,6 +195,8 @@ class ReportFacade:
             total_records = response['hits']['total']['value']
             response = self.client.search(index=self.user_usage_index, body=query, size=total_records)
             usage_data = [hit['_source'] for hit in response['hits']['hits']]
+            for user_usage in usage_data:
+                user_usage.setdefault('stored_size', None)
 
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
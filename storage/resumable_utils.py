@@ -0,0 +1,298 @@
+import base64
+import hashlib
+import logging
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from elasticsearch import ConflictError, NotFoundError
+
+from storage.es_mappings import UPLOAD_SESSION_MAPPING
+from storage.hash_utils import HashStateMismatch, ResumableSHA256
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class UploadSessionNotFound(Exception):
+    pass
+
+
+class UploadSessionConflict(Exception):
+    pass
+
+
+class ResumableUploadFacade:
+    """
+    Resumable uploads in the style of the tus protocol.
+
+    Each session maps to one S3 multipart upload. Its offset, uploaded parts and SHA-256 state are kept
+    in Elasticsearch, so any worker can accept the next chunk. The session is saved after each whole part;
+    bytes past the last part boundary are kept in a staged tail object that leads the next part, so clients
+    may send chunks of any size. Sessions left without activity for longer than
+    RESUMABLE_UPLOAD_EXPIRATION are expired by the expire_upload_sessions command, which aborts their
+    multipart uploads.
+    """
+
+    read_block_size = 64 * 1024
+
+    def __init__(self, storage_facade):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "init",
+            "resource": "ResumableUploadFacade",
+            "message": "Initializing ResumableUploadFacade",
+            "details": {}
+        })
+        self.storage_facade = storage_facade
+        self.s3_facade = storage_facade.s3_facade
+        self.es_facade = storage_facade.es_facade
+        self.session_index = settings.ES_UPLOAD_SESSION_INDEX
+        self.part_size = settings.S3_MULTIPART_CHUNK_SIZE
+        self.expiration = settings.RESUMABLE_UPLOAD_EXPIRATION
+        ResumableSHA256.check()
+        self.es_facade.create_index(self.session_index, UPLOAD_SESSION_MAPPING)
+        self.es_facade.put_mapping(self.session_index, UPLOAD_SESSION_MAPPING)
+
+    def create_session(self, user_id, file_path, upload_length):
+        session_id = uuid.uuid4().hex
+        now = int(datetime.now().timestamp() * 1000)
+        session = {
+            "user_id": user_id,
+            "file_path": file_path,
+            "upload_id": None,
+            "upload_length": upload_length,
+            "offset": 0,
+            "part_size": self.part_size,
+            "parts": [],
+            "tail_key": None,
+            "tail_size": 0,
+            "hash_state": base64.b64encode(ResumableSHA256().state()).decode(),
+            "status": "active",
+            "result": None,
+            "creation_date": now,
+            "last_activity_date": now
+        }
+
+        if upload_length == 0:
+            session["status"] = "completed"
+            session["result"] = self.storage_facade.create_object(user_id, file_path, b'')
+        else:
+            session["upload_id"] = self.s3_facade.create_multipart_upload(user_id, file_path)
+
+        self.es_facade.index_document(self.session_index, session_id, session)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "upload_session_created",
+            "resource": file_path,
+            "message": f"Resumable upload session {session_id} created for {file_path}.",
+            "details": {"session_id": session_id, "upload_length": upload_length}
+        })
+        return session_id, session
+
+    def get_session(self, user_id, session_id):
+        session, _, _ = self._get_session(user_id, session_id)
+        return session
+
+    def append_chunk(self, user_id, session_id, offset, stream):
+        session, seq_no, primary_term = self._get_session(user_id, session_id)
+
+        if session["status"] != "active":
+            raise UploadSessionConflict(f"Upload session {session_id} is {session['status']}.")
+        if offset != session["offset"]:
+            raise UploadSessionConflict(f"Upload offset {offset} does not match the stored offset {session['offset']}.")
+
+        try:
+            hasher = ResumableSHA256(base64.b64decode(session["hash_state"]))
+        except HashStateMismatch as e:
+            # The session cannot be finished with a trustworthy hash; a tus client starts over on a 404.
+            self.terminate_session(user_id, session_id)
+            raise UploadSessionNotFound(f"Upload session {session_id} can no longer be resumed: {str(e)}")
+        upload_length = session["upload_length"]
+        part_size = session["part_size"]
+        # Bytes received after the last whole part wait in a staged tail object and lead the next part.
+        previous_tail_key = session.get("tail_key")
+        buffer = bytearray()
+        if previous_tail_key:
+            buffer.extend(self.s3_facade.get_object(user_id, previous_tail_key)[0])
+        received = 0
+
+        while True:
+            to_read = min(self.read_block_size, upload_length - offset - received)
+            if to_read <= 0:
+                break
+            block = stream.read(to_read)
+            if not block:
+                break
+            buffer.extend(block)
+            received += len(block)
+            if len(buffer) >= part_size:
+                seq_no, primary_term = self._store_part(session_id, session, hasher, bytes(buffer[:part_size]),
+                                                        seq_no, primary_term)
+                del buffer[:part_size]
+
+        if buffer and offset + received == upload_length:
+            seq_no, primary_term = self._store_part(session_id, session, hasher, bytes(buffer), seq_no, primary_term)
+        elif buffer and received:
+            seq_no, primary_term = self._store_tail(session_id, session, bytes(buffer), seq_no, primary_term)
+        if previous_tail_key and session.get("tail_key") != previous_tail_key:
+            self._delete_tails(user_id, session_id, keep=session.get("tail_key"))
+
+        # A session saved with every part stored but not completed, because its worker stopped, completes on
+        # the next request, which carries no data.
+        if session["offset"] == upload_length:
+            session["result"] = self._complete(user_id, session, hasher.hexdigest())
+            session["status"] = "completed"
+            session["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+            self._save_session(session_id, session, seq_no, primary_term)
+        return session
+
+    def _complete(self, user_id, session, file_hash):
+        file_path = session["file_path"]
+        if self.s3_facade.multipart_upload_exists(user_id, file_path, session["upload_id"]):
+            return self.storage_facade.complete_multipart_object(user_id, file_path, session["upload_id"],
+                                                                 session["parts"], file_hash,
+                                                                 session["upload_length"])
+
+        # The upload was completed, or linked and aborted, by a request whose worker stopped before it could
+        # save the session. A completed upload left an object with the ETag of its parts, a linked one a link
+        # to the same content.
+        try:
+            object_stat = self.s3_facade.stat_object(user_id, file_path)
+        except Exception:
+            object_stat = {'etag': None, 'metadata': {}}
+        if object_stat['etag'] != self._multipart_etag(session["parts"]) \
+                and object_stat['metadata'].get('content-hash') != file_hash:
+            raise UploadSessionConflict(f"The multipart upload of {file_path} is gone; upload the file again.")
+        return f"File {file_path} uploaded successfully."
+
+    @staticmethod
+    def _multipart_etag(parts):
+        part_digests = b''.join(bytes.fromhex(part["ETag"].strip('"'))
+                                for part in sorted(parts, key=lambda part: part["PartNumber"]))
+        return f"{hashlib.md5(part_digests).hexdigest()}-{len(parts)}"
+
+    def terminate_session(self, user_id, session_id):
+        session, seq_no, primary_term = self._get_session(user_id, session_id)
+
+        if session["status"] in ("active", "expired"):
+            self.s3_facade.abort_multipart_upload(user_id, session["file_path"], session["upload_id"])
+            self._delete_tails(user_id, session_id)
+        self.es_facade.delete_document(self.session_index, session_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "upload_session_terminated",
+            "resource": session["file_path"],
+            "message": f"Resumable upload session {session_id} terminated.",
+            "details": {"session_id": session_id, "offset": session["offset"]}
+        })
+
+    def expire_sessions(self, batch_size=100):
+        """
+        Aborts the multipart uploads of active sessions without recent activity and deletes the sessions. A
+        session whose abort failed stays expired and is retried once the expiration has passed again.
+        """
+        expired_before = int(datetime.now().timestamp() * 1000) - self.expiration * 1000
+        search_result = self.es_facade.es_client.search(index=self.session_index, body={
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"status": ["active", "expired"]}},
+                        {"range": {"last_activity_date": {"lt": expired_before}}}
+                    ]
+                }
+            },
+            "sort": [{"last_activity_date": {"order": "asc"}}],
+            "size": batch_size,
+            "seq_no_primary_term": True
+        })
+
+        expired_count = 0
+        for hit in search_result['hits']['hits']:
+            session_id, session = hit['_id'], hit['_source']
+            # Marked first, so a chunk arriving meanwhile is refused instead of landing in an aborted upload.
+            session["status"] = "expired"
+            session["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+            try:
+                self._save_session(session_id, session, hit['_seq_no'], hit['_primary_term'])
+            except UploadSessionConflict:
+                continue
+
+            try:
+                self.s3_facade.abort_multipart_upload(session["user_id"], session["file_path"], session["upload_id"])
+                self._delete_tails(session["user_id"], session_id)
+            except Exception:
+                continue
+            self.es_facade.delete_document(self.session_index, session_id)
+            expired_count += 1
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": session["user_id"],
+                "action": "upload_session_expired",
+                "resource": session["file_path"],
+                "message": f"Resumable upload session {session_id} expired at offset {session['offset']}.",
+                "details": {"session_id": session_id, "offset": session["offset"]}
+            })
+        return expired_count
+
+    def _get_session(self, user_id, session_id):
+        try:
+            session, seq_no, primary_term = self.es_facade.get_versioned_document(self.session_index, session_id)
+        except NotFoundError:
+            raise UploadSessionNotFound(f"Upload session {session_id} does not exist.")
+
+        if session["user_id"] != user_id:
+            raise UploadSessionNotFound(f"Upload session {session_id} does not exist.")
+        return session, seq_no, primary_term
+
+    def _store_part(self, session_id, session, hasher, body, seq_no, primary_term):
+        # Part numbers follow from the stored offset, so a part re-sent after a lost response overwrites itself.
+        stored_offset = session["offset"] - session.get("tail_size", 0)
+        part_number = stored_offset // session["part_size"] + 1
+        part = self.s3_facade.upload_part(session["user_id"], session["file_path"], session["upload_id"],
+                                          part_number, body)
+        hasher.update(body)
+        session["parts"] = [p for p in session["parts"] if p["PartNumber"] != part_number] + [part]
+        # The tail, if any, is the start of this part.
+        session["offset"] = stored_offset + len(body)
+        session["tail_key"], session["tail_size"] = None, 0
+        session["hash_state"] = base64.b64encode(hasher.state()).decode()
+        session["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        return self._save_session(session_id, session, seq_no, primary_term)
+
+    def _store_tail(self, session_id, session, body, seq_no, primary_term):
+        # Each tail gets a key of its own, so the one the saved session points at is never overwritten.
+        tail_key = f"{self._tail_prefix(session_id)}{uuid.uuid4().hex}"
+        stored_offset = session["offset"] - session.get("tail_size", 0)
+        self.s3_facade.upload_file(session["user_id"], tail_key, body)
+        session["tail_key"], session["tail_size"] = tail_key, len(body)
+        session["offset"] = stored_offset + len(body)
+        session["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        return self._save_session(session_id, session, seq_no, primary_term)
+
+    def _tail_prefix(self, session_id):
+        return f"{self.s3_facade.staging_prefix}resumable/{session_id}/"
+
+    def _delete_tails(self, user_id, session_id, keep=None):
+        tail_keys = [item['key'] for page in self.s3_facade.iter_prefix_pages(user_id, self._tail_prefix(session_id))
+                     for item in page if item['key'] != keep]
+        if tail_keys:
+            self.s3_facade.delete_objects(user_id, tail_keys)
+
+    def _save_session(self, session_id, session, seq_no, primary_term):
+        try:
+            return self.es_facade.index_document(self.session_index, session_id, session,
+                                                 if_seq_no=seq_no, if_primary_term=primary_term)
+        except ConflictError:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Upload session {session_id} was modified concurrently.",
+                "exception": "ConflictError",
+                "stack_trace": None,
+                "context": {"session_id": session_id, "user_id": session["user_id"]}
+            })
+            raise UploadSessionConflict(f"Upload session {session_id} was modified by another request.")
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
@@ -6,6 +7,8 @@ import logging
 from django.conf import settings
 
 from storage.error_map import ERROR_MAP, DEFAULT_ERROR_MESSAGE
+from storage.link_cache import PresignedUrlCache
+from storage.listing_cache import FolderListingCache
 
 audit_logger = logging.getLogger('audit_logger')
 error_logger = logging.getLogger('error_logger')
@@ -28,6 +31,20 @@ class S3Facade:
             aws_access_key_id=settings.S3_ACCESS_KEY_ID,
             aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY
         )
+        self.chunk_bucket_name = settings.S3_CHUNK_BUCKET
+        self.staging_prefix = settings.S3_STAGING_PREFIX
+        self.trash_prefix = settings.S3_TRASH_PREFIX
+        self.derivative_bucket_name = settings.S3_DERIVATIVE_BUCKET
+        self.derivative_prefix = settings.S3_DERIVATIVE_PREFIX
+        self.copy_multipart_threshold = settings.S3_COPY_MULTIPART_THRESHOLD
+        self.copy_part_size = settings.S3_COPY_PART_SIZE
+        self.copy_workers = settings.S3_COPY_WORKERS
+        self.download_link_expiration = settings.S3_DOWNLOAD_LINK_EXPIRATION
+        self.download_link_cache = PresignedUrlCache(settings.S3_DOWNLOAD_LINK_CACHE_SIZE,
+                                                     settings.S3_DOWNLOAD_LINK_MIN_REMAINING)
+        self.listing_cache = FolderListingCache(
+            settings.LISTING_CACHE_ALIAS, settings.LISTING_CACHE_TTL, settings.LISTING_CACHE_STALE_TTL
+        ) if settings.LISTING_CACHE_ENABLED else None
 
     def generate_bucket_name(self, user_id):
         """Generates a bucket name based on the user_id."""
@@ -41,6 +58,12 @@ class S3Facade:
         })
         return f"user-{user_id}-bucket"
 
+    def _object_changed(self, user_id, file_path):
+        """Drops cached download links and folder listings that a write to the given key made outdated."""
+        self.download_link_cache.invalidate(self.generate_bucket_name(user_id), file_path)
+        if self.listing_cache is not None:
+            self.listing_cache.invalidate_key(user_id, file_path)
+
     def _convert_error_code_to_message(self, error):
         """Converts an AWS error code to a user-friendly error message."""
         try:
@@ -84,6 +107,7 @@ class S3Facade:
                 Body=file_content,
                 Metadata=metadata or {}
             )
+            self._object_changed(user_id, file_path)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
@@ -111,6 +135,7 @@ class S3Facade:
             if not folder_path.endswith('/'):
                 folder_path += '/'
             self.s3_client.put_object(Bucket=bucket_name, Key=folder_path)
+            self._object_changed(user_id, folder_path)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
@@ -136,6 +161,7 @@ class S3Facade:
         bucket_name = self.generate_bucket_name(user_id)
         try:
             self.s3_client.delete_object(Bucket=bucket_name, Key=file_path)
+            self._object_changed(user_id, file_path)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
@@ -156,13 +182,99 @@ class S3Facade:
             })
             raise Exception(error_message)
 
-    def list_folder_contents(self, user_id, folder_path='', only_name=False):
-        """Lists the contents of a folder in the user's bucket."""
+    def delete_objects(self, user_id, file_paths):
+        """Deletes up to 1000 keys from the user's bucket in one request and returns the keys that failed."""
+        bucket_name = self.generate_bucket_name(user_id)
+        if not file_paths:
+            return []
+        try:
+            response = self.s3_client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': file_path} for file_path in file_paths],
+                'Quiet': True
+            })
+            failed_paths = [error['Key'] for error in response.get('Errors', [])]
+            deleted_paths = set(file_paths) - set(failed_paths)
+            for file_path in deleted_paths:
+                self.download_link_cache.invalidate(bucket_name, file_path)
+            if self.listing_cache is not None:
+                self.listing_cache.invalidate_keys(user_id, deleted_paths)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "delete_objects",
+                "resource": bucket_name,
+                "message": f"Deleted {len(deleted_paths)} of {len(file_paths)} objects from bucket {bucket_name} "
+                           f"for user {user_id}",
+                "details": {"errors": response.get('Errors', [])[:10]}
+            })
+            return failed_paths
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error deleting {len(file_paths)} objects for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "objects_count": len(file_paths)}
+            })
+            raise Exception(error_message)
+
+    def iter_prefix_pages(self, user_id, prefix, page_size=1000, start_after=None):
+        """Walks every key under a prefix, subfolders included, and yields them one listing page at a time."""
+        bucket_name = self.generate_bucket_name(user_id)
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pagination_args = {'StartAfter': start_after} if start_after else {}
+        for response in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **pagination_args,
+                                           PaginationConfig={'PageSize': page_size}):
+            yield [{'key': item['Key'], 'size': item.get('Size', 0), 'last_modified': item.get('LastModified')}
+                   for item in response.get('Contents', [])]
+
+    def iter_user_ids(self):
+        """Yields the ID of every user that has a bucket."""
+        response = self.s3_client.list_buckets()
+        for bucket in response.get('Buckets', []):
+            bucket_name = bucket['Name']
+            if bucket_name.startswith('user-') and bucket_name.endswith('-bucket'):
+                yield bucket_name[len('user-'):-len('-bucket')]
+
+    def list_folder_contents(self, user_id, folder_path='', only_name=False, use_cache=False):
+        """Lists the full contents of a folder in the user's bucket, following every continuation token."""
+        if use_cache and self.listing_cache is not None:
+            return self.listing_cache.get_or_load(
+                user_id, folder_path, ('all', only_name),
+                lambda: list(self.iter_folder_contents(user_id, folder_path, only_name=only_name))
+            )
+        return list(self.iter_folder_contents(user_id, folder_path, only_name=only_name))
+
+    def iter_folder_contents(self, user_id, folder_path='', only_name=False, page_size=1000):
+        """Lazily yields the contents of a folder page by page, so large folders are never listed at once."""
+        continuation_token = None
+        while True:
+            contents, continuation_token = self.list_folder_page(user_id, folder_path, page_size=page_size,
+                                                                 continuation_token=continuation_token,
+                                                                 only_name=only_name)
+            yield from contents
+            if continuation_token is None:
+                break
+
+    def list_folder_page(self, user_id, folder_path='', page_size=1000, continuation_token=None, only_name=False,
+                         use_cache=False):
+        """Lists one page of a folder and returns it with the token of the next page, or None on the last page."""
+        if use_cache and self.listing_cache is not None:
+            return self.listing_cache.get_or_load(
+                user_id, folder_path, ('page', page_size, continuation_token, only_name),
+                lambda: self.list_folder_page(user_id, folder_path, page_size, continuation_token, only_name)
+            )
+
         bucket_name = self.generate_bucket_name(user_id)
         if folder_path != '' and not folder_path.endswith('/'):
             folder_path += '/'
         try:
-            response = self.s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_path, Delimiter='/')
+            list_arguments = {'Bucket': bucket_name, 'Prefix': folder_path, 'Delimiter': '/', 'MaxKeys': page_size}
+            if continuation_token:
+                list_arguments['ContinuationToken'] = continuation_token
+            response = self.s3_client.list_objects_v2(**list_arguments)
             contents = []
             for item in response.get('Contents', []):
                 key = item['Key']
@@ -176,6 +288,8 @@ class S3Facade:
                             'size': item.get('Size', 0) if item.get('Size', 0) else "Linked"
                         })
             for prefix in response.get('CommonPrefixes', []):
+                if prefix['Prefix'] in (self.staging_prefix, self.trash_prefix):
+                    continue
                 folder_name = prefix['Prefix'][len(folder_path):].rstrip('/')
                 if only_name:
                     contents.append(prefix['Prefix'][len(folder_path):])
@@ -185,16 +299,17 @@ class S3Facade:
                         'type': 'folder',
                         'size': 'N/A'
                     })
+            next_token = response.get('NextContinuationToken') if response.get('IsTruncated') else None
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
                 "action": "list_folder_contents",
                 "resource": folder_path,
                 "message": f"Listed contents of folder {folder_path} in bucket {bucket_name} for user {user_id}",
-                "details": {"only_name": only_name}
+                "details": {"only_name": only_name, "page_size": page_size, "truncated": next_token is not None}
             })
-            return contents
-        except ClientError as e:
+            return contents, next_token
+        except (ClientError, BotoCoreError) as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "level": "ERROR",
@@ -203,6 +318,7 @@ class S3Facade:
                 "stack_trace": None,
                 "context": {"user_id": user_id, "folder_path": folder_path}
             })
+            # Re-raised as is, so callers can tell a rejected continuation token from other failures.
             raise
 
     def get_object(self, user_id, file_path):
@@ -231,22 +347,229 @@ class S3Facade:
             })
             raise Exception(error_message)
 
-    def generate_download_link(self, user_id, file_path, expiration=3600):
-        """Generates a presigned URL for downloading a file."""
+    def stat_object(self, user_id, file_path):
+        """Retrieves the size, ETag, content type, modification time and metadata of a file without its body."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            response = self.s3_client.head_object(Bucket=bucket_name, Key=file_path)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "stat_object",
+                "resource": file_path,
+                "message": f"Object {file_path} metadata retrieved from bucket {bucket_name} for user {user_id}",
+                "details": {"content_length": response.get('ContentLength')}
+            })
+            return {
+                'size': response.get('ContentLength', 0),
+                'etag': response.get('ETag', '').strip('"'),
+                'content_type': response.get('ContentType'),
+                'last_modified': response.get('LastModified'),
+                'metadata': response.get('Metadata', {})
+            }
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error retrieving metadata of object {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(error_message)
+
+    def object_exists(self, user_id, file_path):
+        """Tells whether a key exists in the user's bucket; errors other than a missing key are raised."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            self.s3_client.head_object(Bucket=bucket_name, Key=file_path)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def get_object_stream(self, user_id, file_path, byte_range=None):
+        """Opens a file, or an inclusive (start, end) byte range of it as a stream without reading it into memory."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            get_arguments = {'Bucket': bucket_name, 'Key': file_path}
+            if byte_range is not None:
+                get_arguments['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+            response = self.s3_client.get_object(**get_arguments)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "get_object_stream",
+                "resource": file_path,
+                "message": f"Object {file_path} opened for streaming from bucket {bucket_name} for user {user_id}",
+                "details": {"content_length": response.get('ContentLength'), "byte_range": byte_range}
+            })
+            return response['Body'], response.get('Metadata', {})
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error opening object {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(error_message)
+
+    def copy_object(self, source_user_id, source_path, user_id, file_path, metadata=None, size=None):
+        """
+        Copies an object server-side; metadata, when given, replaces the source metadata.
+
+        Objects of at least copy_multipart_threshold bytes are copied as parallel upload_part_copy ranges,
+        which is also the only way to copy objects larger than 5 GB. The data never leaves S3 either way.
+        """
+        source_bucket_name = self.generate_bucket_name(source_user_id)
+        bucket_name = self.generate_bucket_name(user_id)
+        if size is not None and size >= self.copy_multipart_threshold:
+            return self._copy_object_multipart(source_user_id, source_path, user_id, file_path, metadata, size)
+        try:
+            copy_arguments = {
+                'Bucket': bucket_name,
+                'Key': file_path,
+                'CopySource': {'Bucket': source_bucket_name, 'Key': source_path}
+            }
+            if metadata is not None:
+                copy_arguments['Metadata'] = metadata
+                copy_arguments['MetadataDirective'] = 'REPLACE'
+            self.s3_client.copy_object(**copy_arguments)
+            self._object_changed(user_id, file_path)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "copy_object",
+                "resource": file_path,
+                "message": f"Object {source_bucket_name}/{source_path} copied to {bucket_name}/{file_path}",
+                "details": {"metadata": metadata}
+            })
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": (
+                    f"Error copying {source_bucket_name}/{source_path} to {bucket_name}/{file_path}: {error_message}"
+                ),
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "source_path": source_path}
+            })
+            raise Exception(error_message)
+
+    def _copy_object_multipart(self, source_user_id, source_path, user_id, file_path, metadata, size):
+        source_bucket_name = self.generate_bucket_name(source_user_id)
+        bucket_name = self.generate_bucket_name(user_id)
+        if metadata is None:
+            metadata = self.stat_object(source_user_id, source_path)['metadata']
+        upload_id = self.create_multipart_upload(user_id, file_path, metadata)
+
+        def copy_part(part_number):
+            start = (part_number - 1) * self.copy_part_size
+            end = min(start + self.copy_part_size, size) - 1
+            response = self.s3_client.upload_part_copy(
+                Bucket=bucket_name,
+                Key=file_path,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                CopySource={'Bucket': source_bucket_name, 'Key': source_path},
+                CopySourceRange=f"bytes={start}-{end}"
+            )
+            return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+        part_count = (size + self.copy_part_size - 1) // self.copy_part_size
+        try:
+            with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+                parts = list(executor.map(copy_part, range(1, part_count + 1)))
+        except (ClientError, BotoCoreError) as e:
+            self.abort_multipart_upload(user_id, file_path, upload_id)
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error copying {source_bucket_name}/{source_path} to {bucket_name}/{file_path} "
+                           f"in parts: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "source_path": source_path}
+            })
+            raise Exception(error_message)
+
+        self.complete_multipart_upload(user_id, file_path, upload_id, parts)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "copy_object",
+            "resource": file_path,
+            "message": f"Object {source_bucket_name}/{source_path} copied to {bucket_name}/{file_path} "
+                       f"in {part_count} parts",
+            "details": {"metadata": metadata, "size": size}
+        })
+
+    def generate_upload_post(self, user_id, file_path, max_size, expiration=3600):
+        """Generates a presigned POST that lets a client upload up to max_size bytes straight to the bucket."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            upload_post = self.s3_client.generate_presigned_post(
+                Bucket=bucket_name,
+                Key=file_path,
+                Conditions=[["content-length-range", 0, max_size]],
+                ExpiresIn=expiration
+            )
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "generate_upload_post",
+                "resource": file_path,
+                "message": f"Generated presigned upload for {file_path} in bucket {bucket_name} for user {user_id}",
+                "details": {"expiration": expiration, "max_size": max_size}
+            })
+            return upload_post
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error generating presigned upload for {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(error_message)
+
+    def generate_download_link(self, user_id, file_path, expiration=None, version=None):
+        """
+        Generates a presigned URL for downloading a file, reusing a cached one for the same object version.
+        A caller asking for an explicit expiration always gets a fresh URL valid for that long.
+        """
         bucket_name = self.generate_bucket_name(user_id)
+        use_cache = version is not None and expiration is None
+        expiration = expiration or self.download_link_expiration
+        if use_cache:
+            download_url = self.download_link_cache.get(bucket_name, file_path, version)
+            if download_url is not None:
+                return download_url
         try:
             download_url = self.s3_client.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': bucket_name, 'Key': file_path},
                 ExpiresIn=expiration
             )
+            if use_cache:
+                self.download_link_cache.put(bucket_name, file_path, version, download_url, expiration)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
                 "action": "generate_download_link",
                 "resource": file_path,
                 "message": f"Generated download link for {file_path} in bucket {bucket_name} for user {user_id}",
-                "details": {"expiration": expiration}
+                "details": {"expiration": expiration, "version": version}
             })
             return download_url
         except (ClientError, BotoCoreError) as e:
@@ -260,3 +583,300 @@ class S3Facade:
                 "context": {"user_id": user_id, "file_path": file_path}
             })
             raise Exception(error_message)
+
+    def create_multipart_upload(self, user_id, file_path, metadata=None):
+        """Starts a multipart upload in the user's bucket and returns its upload id."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=bucket_name,
+                Key=file_path,
+                Metadata=metadata or {}
+            )
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "create_multipart_upload",
+                "resource": file_path,
+                "message": f"Multipart upload started for {file_path} in bucket {bucket_name} for user {user_id}",
+                "details": {"upload_id": response['UploadId'], "metadata": metadata}
+            })
+            return response['UploadId']
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error starting multipart upload for {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(error_message)
+
+    def upload_part(self, user_id, file_path, upload_id, part_number, body):
+        """Uploads a single part of a multipart upload and returns its part descriptor."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=bucket_name,
+                Key=file_path,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body
+            )
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "upload_part",
+                "resource": file_path,
+                "message": f"Part {part_number} of {file_path} uploaded to bucket {bucket_name} for user {user_id}",
+                "details": {"upload_id": upload_id, "part_number": part_number, "part_size": len(body)}
+            })
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error uploading part {part_number} of {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "upload_id": upload_id}
+            })
+            raise Exception(error_message)
+
+    def complete_multipart_upload(self, user_id, file_path, upload_id, parts):
+        """Completes a multipart upload from the ordered list of uploaded parts."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            self.s3_client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=file_path,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            self._object_changed(user_id, file_path)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "complete_multipart_upload",
+                "resource": file_path,
+                "message": f"Multipart upload of {file_path} completed in bucket {bucket_name} for user {user_id}",
+                "details": {"upload_id": upload_id, "parts_count": len(parts)}
+            })
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error completing multipart upload of {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "upload_id": upload_id}
+            })
+            raise Exception(error_message)
+
+    def abort_multipart_upload(self, user_id, file_path, upload_id):
+        """Aborts a multipart upload and releases the parts stored so far."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=bucket_name, Key=file_path, UploadId=upload_id)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "abort_multipart_upload",
+                "resource": file_path,
+                "message": f"Multipart upload of {file_path} aborted in bucket {bucket_name} for user {user_id}",
+                "details": {"upload_id": upload_id}
+            })
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error aborting multipart upload of {file_path} for user {user_id}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "upload_id": upload_id}
+            })
+            raise Exception(error_message)
+
+    def multipart_upload_exists(self, user_id, file_path, upload_id):
+        """Tells whether a multipart upload is still open; errors other than a missing upload are raised."""
+        bucket_name = self.generate_bucket_name(user_id)
+        try:
+            self.s3_client.list_parts(Bucket=bucket_name, Key=file_path, UploadId=upload_id, MaxParts=1)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                return False
+            raise
+
+    @staticmethod
+    def generate_chunk_key(chunk_hash):
+        """Generates the content-addressed key of a chunk in the shared chunk bucket."""
+        return f"{chunk_hash[:2]}/{chunk_hash}"
+
+    def create_chunk_bucket(self):
+        """Creates the shared chunk bucket if it does not already exist."""
+        self.create_shared_bucket(self.chunk_bucket_name)
+
+    def create_derivative_bucket(self):
+        """Creates the shared bucket of thumbnails and previews if it does not already exist."""
+        self.create_shared_bucket(self.derivative_bucket_name)
+
+    def create_shared_bucket(self, bucket_name):
+        """Creates a bucket shared by all users if it does not already exist."""
+        try:
+            self.s3_client.head_bucket(Bucket=bucket_name)
+        except ClientError:
+            try:
+                self.s3_client.create_bucket(Bucket=bucket_name)
+                audit_logger.info({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "user": "system",
+                    "action": "create_shared_bucket",
+                    "resource": bucket_name,
+                    "message": f"Shared bucket {bucket_name} created",
+                    "details": {}
+                })
+            except (ClientError, BotoCoreError, Exception) as e:
+                error_message = self._convert_error_code_to_message(e)
+                error_logger.error({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "level": "ERROR",
+                    "message": f"Error creating shared bucket {bucket_name}: {error_message}",
+                    "exception": str(e),
+                    "stack_trace": None,
+                    "context": {"bucket_name": bucket_name}
+                })
+                raise Exception(error_message)
+
+    def upload_derivative(self, derivative_key, content, content_type):
+        """Uploads a thumbnail or preview to the shared derivative bucket."""
+        try:
+            self.s3_client.put_object(Bucket=self.derivative_bucket_name, Key=derivative_key, Body=content,
+                                      ContentType=content_type, CacheControl='private, max-age=31536000, immutable')
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "upload_derivative",
+                "resource": derivative_key,
+                "message": f"Derivative {derivative_key} uploaded to bucket {self.derivative_bucket_name}",
+                "details": {"size": len(content)}
+            })
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error uploading derivative {derivative_key}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"derivative_key": derivative_key}
+            })
+            raise Exception(error_message)
+
+    def generate_derivative_link(self, derivative_key):
+        """Generates a presigned URL of a derivative; keys are content-addressed, so cached URLs never go stale."""
+        download_url = self.download_link_cache.get(self.derivative_bucket_name, derivative_key, derivative_key)
+        if download_url is not None:
+            return download_url
+        try:
+            download_url = self.s3_client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.derivative_bucket_name, 'Key': derivative_key},
+                ExpiresIn=self.download_link_expiration
+            )
+            self.download_link_cache.put(self.derivative_bucket_name, derivative_key, derivative_key, download_url,
+                                         self.download_link_expiration)
+            return download_url
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error generating link for derivative {derivative_key}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"derivative_key": derivative_key}
+            })
+            raise Exception(error_message)
+
+    def upload_chunk(self, chunk_hash, chunk_content):
+        """Uploads a chunk to the shared chunk bucket under its content hash."""
+        chunk_key = self.generate_chunk_key(chunk_hash)
+        try:
+            self.s3_client.put_object(Bucket=self.chunk_bucket_name, Key=chunk_key, Body=chunk_content)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "upload_chunk",
+                "resource": chunk_key,
+                "message": f"Chunk {chunk_hash} uploaded to bucket {self.chunk_bucket_name}",
+                "details": {"chunk_size": len(chunk_content)}
+            })
+            return f"{self.chunk_bucket_name}/{chunk_key}"
+        except (ClientError, BotoCoreError, Exception) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error uploading chunk {chunk_hash}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"chunk_hash": chunk_hash}
+            })
+            raise Exception(error_message)
+
+    def delete_chunks(self, chunk_hashes):
+        """Deletes up to 1000 chunks from the shared chunk bucket in one request and returns the hashes that failed."""
+        if not chunk_hashes:
+            return []
+        keys = {self.generate_chunk_key(chunk_hash): chunk_hash for chunk_hash in chunk_hashes}
+        try:
+            response = self.s3_client.delete_objects(Bucket=self.chunk_bucket_name, Delete={
+                'Objects': [{'Key': chunk_key} for chunk_key in keys],
+                'Quiet': True
+            })
+            failed_hashes = [keys[error['Key']] for error in response.get('Errors', [])]
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": "system",
+                "action": "delete_chunks",
+                "resource": self.chunk_bucket_name,
+                "message": f"Deleted {len(keys) - len(failed_hashes)} of {len(keys)} chunks from bucket "
+                           f"{self.chunk_bucket_name}",
+                "details": {"errors": response.get('Errors', [])[:10]}
+            })
+            return failed_hashes
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error deleting {len(keys)} chunks: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"chunks_count": len(keys)}
+            })
+            raise Exception(error_message)
+
+    def get_chunk(self, chunk_hash):
+        """Retrieves a chunk from the shared chunk bucket."""
+        chunk_key = self.generate_chunk_key(chunk_hash)
+        try:
+            response = self.s3_client.get_object(Bucket=self.chunk_bucket_name, Key=chunk_key)
+            return response['Body'].read()
+        except (ClientError, BotoCoreError) as e:
+            error_message = self._convert_error_code_to_message(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error retrieving chunk {chunk_hash}: {error_message}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"chunk_hash": chunk_hash}
+            })
+            raise Exception(error_message)
@@ -37,6 +37,7 @@ def create_bucket_and_usage_record_for_new_user(sender, instance, created, **kwa
                 "user_id": instance.username,
                 "date_joined": instance.date_joined.isoformat(),
                 "total_size": 0,
+                "stored_size": 0,
                 "file_count": 0,
                 "upload_count": 0,
                 "delete_count": 0,
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from elasticsearch import ConflictError, NotFoundError
+
+from storage.es_mappings import STAGED_UPLOAD_MAPPING
+from storage.resumable_utils import UploadSessionConflict, UploadSessionNotFound
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class StagedUploadFacade:
+    """
+    Direct-to-S3 uploads through presigned POSTs into the user's staging prefix.
+
+    The client uploads straight to object storage and then marks the upload as done. A background
+    finalizer (the finalize_staged_uploads command) hashes the staged object, promotes it or turns it
+    into a dedup link, and removes it from staging. Any S3-compatible endpoint such as MinIO works
+    through S3_ENDPOINT_URL.
+    """
+
+    read_block_size = 1024 * 1024
+
+    def __init__(self, storage_facade):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "init",
+            "resource": "StagedUploadFacade",
+            "message": "Initializing StagedUploadFacade",
+            "details": {}
+        })
+        self.storage_facade = storage_facade
+        self.s3_facade = storage_facade.s3_facade
+        self.es_facade = storage_facade.es_facade
+        self.staged_upload_index = settings.ES_STAGED_UPLOAD_INDEX
+        self.staging_prefix = settings.S3_STAGING_PREFIX
+        self.es_facade.create_index(self.staged_upload_index, STAGED_UPLOAD_MAPPING)
+
+    def create_staged_upload(self, user_id, file_path, file_size):
+        staged_id = uuid.uuid4().hex
+        staging_key = f"{self.staging_prefix}{staged_id}/{os.path.basename(file_path)}"
+        upload_post = self.s3_facade.generate_upload_post(user_id, staging_key, file_size,
+                                                          expiration=settings.S3_STAGING_UPLOAD_EXPIRATION)
+        now = int(datetime.now().timestamp() * 1000)
+        self.es_facade.index_document(self.staged_upload_index, staged_id, {
+            "user_id": user_id,
+            "file_path": file_path,
+            "staging_key": staging_key,
+            "declared_size": file_size,
+            "status": "pending",
+            "result": None,
+            "creation_date": now,
+            "last_activity_date": now
+        })
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "staged_upload_created",
+            "resource": file_path,
+            "message": f"Staged upload {staged_id} created for {file_path}.",
+            "details": {"staged_id": staged_id, "staging_key": staging_key}
+        })
+        return staged_id, upload_post
+
+    def get_staged_upload(self, user_id, staged_id):
+        staged_upload, _, _ = self._get_staged_upload(user_id, staged_id)
+        return staged_upload
+
+    def mark_uploaded(self, user_id, staged_id):
+        staged_upload, seq_no, primary_term = self._get_staged_upload(user_id, staged_id)
+
+        if staged_upload["status"] != "pending":
+            raise UploadSessionConflict(f"Staged upload {staged_id} is already {staged_upload['status']}.")
+
+        staged_upload["status"] = "uploaded"
+        staged_upload["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        self._save_staged_upload(staged_id, staged_upload, seq_no, primary_term)
+        return staged_upload
+
+    def finalize_uploaded(self, batch_size=100):
+        """Finalizes uploaded staged objects, reclaiming ones whose finalizer stopped mid-way."""
+        stale_before = int(datetime.now().timestamp() * 1000) - settings.STAGING_FINALIZE_TIMEOUT * 1000
+        query = {
+            "query": {
+                "bool": {
+                    "should": [
+                        {"term": {"status": "uploaded"}},
+                        {"bool": {"filter": [
+                            {"term": {"status": "finalizing"}},
+                            {"range": {"last_activity_date": {"lt": stale_before}}}
+                        ]}}
+                    ],
+                    "minimum_should_match": 1
+                }
+            },
+            "sort": [{"creation_date": {"order": "asc"}}],
+            "size": batch_size,
+            "seq_no_primary_term": True
+        }
+        search_result = self.es_facade.es_client.search(index=self.staged_upload_index, body=query)
+
+        finalized_count = 0
+        for hit in search_result['hits']['hits']:
+            staged_id, staged_upload = hit['_id'], hit['_source']
+            staged_upload["status"] = "finalizing"
+            staged_upload["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+            try:
+                self._save_staged_upload(staged_id, staged_upload, hit['_seq_no'], hit['_primary_term'])
+            except UploadSessionConflict:
+                continue
+
+            self._finalize(staged_id, staged_upload)
+            finalized_count += 1
+        return finalized_count
+
+    def _finalize(self, staged_id, staged_upload):
+        user_id = staged_upload["user_id"]
+        try:
+            body, _ = self.s3_facade.get_object_stream(user_id, staged_upload["staging_key"])
+            hasher = hashlib.sha256()
+            file_size = 0
+            for block in body.iter_chunks(chunk_size=self.read_block_size):
+                hasher.update(block)
+                file_size += len(block)
+
+            staged_upload["result"] = self.storage_facade.promote_staged_object(
+                user_id, staged_upload["staging_key"], staged_upload["file_path"], hasher.hexdigest(), file_size
+            )
+            staged_upload["status"] = "finalized"
+        except Exception as e:
+            staged_upload["result"] = str(e)
+            staged_upload["status"] = "failed"
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error finalizing staged upload {staged_id}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "staged_id": staged_id, "file_path": staged_upload["file_path"]}
+            })
+
+        staged_upload["last_activity_date"] = int(datetime.now().timestamp() * 1000)
+        self.es_facade.index_document(self.staged_upload_index, staged_id, staged_upload)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "staged_upload_finalized",
+            "resource": staged_upload["file_path"],
+            "message": f"Staged upload {staged_id} finished with status {staged_upload['status']}.",
+            "details": {"staged_id": staged_id, "status": staged_upload["status"]}
+        })
+
+    def _get_staged_upload(self, user_id, staged_id):
+        try:
+            staged_upload, seq_no, primary_term = self.es_facade.get_versioned_document(self.staged_upload_index,
+                                                                                        staged_id)
+        except NotFoundError:
+            raise UploadSessionNotFound(f"Staged upload {staged_id} does not exist.")
+
+        if staged_upload["user_id"] != user_id:
+            raise UploadSessionNotFound(f"Staged upload {staged_id} does not exist.")
+        return staged_upload, seq_no, primary_term
+
+    def _save_staged_upload(self, staged_id, staged_upload, seq_no, primary_term):
+        try:
+            self.es_facade.index_document(self.staged_upload_index, staged_id, staged_upload,
+                                          if_seq_no=seq_no, if_primary_term=primary_term)
+        except ConflictError:
+            raise UploadSessionConflict(f"Staged upload {staged_id} was modified by another request.")
@@ -1,11 +1,28 @@
+import base64
 import hashlib
+import json
 import os.path
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlencode
 from django.conf import settings
-from storage.es_mappings import USER_USAGE_INDEX_MAPPING, HASH_INDEX_MAPPING
+from django.urls import reverse
+from storage.chunking import CHUNK_MANIFEST_VERSION, ChunkedObjectWriter
+from storage.compression import compress, default_codec, is_compressible, iter_decompressed
+from storage.derivatives import DERIVATIVE_CONTENT_TYPE, generate_derivative_key, render_derivatives, source_kind
+from storage.es_mappings import (USER_USAGE_INDEX_MAPPING, HASH_INDEX_MAPPING, CHUNK_INDEX_MAPPING, BLOB_INDEX_MAPPING,
+                                 DERIVATIVE_INDEX_MAPPING)
+from storage.models import UserStorageState
 from storage.s3_utils import S3Facade
+from storage.task_queue import TaskQueueFacade
+from storage.zip_stream import ZipEntry, ZipStreamWriter
 from storage.es_utils import ESFacade
+from storage.hash_cache import HashLookupCache
 from botocore.exceptions import ClientError, BotoCoreError
+from elasticsearch import ApiError, NotFoundError, helpers
 import logging
 
 audit_logger = logging.getLogger('audit_logger')
@@ -13,6 +30,97 @@ error_logger = logging.getLogger('error_logger')
 
 
 class StorageFacade:
+    usage_batch_history = 100
+    usage_change_script = """
+        if (ctx._source.stored_size == null) { ctx._source.stored_size = ctx._source.total_size; }
+        ctx._source.total_size += params.size_change;
+        ctx._source.stored_size += params.stored_size_change;
+        ctx._source.file_count += params.file_count_change;
+    """
+    usage_batch_script = """
+        if (ctx._source.applied_batches == null) { ctx._source.applied_batches = []; }
+        if (ctx._source.applied_batches.contains(params.batch_id)) {
+            ctx.op = 'noop';
+        } else {
+            if (ctx._source.stored_size == null) { ctx._source.stored_size = ctx._source.total_size; }
+            ctx._source.total_size += params.size_change;
+            ctx._source.stored_size += params.stored_size_change;
+            ctx._source.file_count += params.file_count_change;
+            ctx._source.applied_batches.add(params.batch_id);
+            if (ctx._source.applied_batches.size() > params.history) { ctx._source.applied_batches.remove(0); }
+        }
+    """
+    blob_register_attempts = 3
+    blob_acquire_script = """
+        if ((params.size != null && ctx._source.size != params.size)
+                || (params.original_key != null && ctx._source.original_key != params.original_key)) {
+            ctx.op = 'noop';
+        } else {
+            ctx._source.ref_count += params.getOrDefault('count', 1);
+        }
+    """
+    blob_release_script = """
+        ctx._source.ref_count -= params.getOrDefault('count', 1);
+        if (ctx._source.ref_count <= 0) { ctx.op = 'delete'; }
+    """
+    # Chunks stored before reference counting have no ref_count; they are left alone by both scripts and by
+    # collect_chunks. A ref_count of -1 marks a chunk that collect_chunks is removing.
+    chunk_acquire_script = """
+        if (ctx._source.ref_count != null) {
+            if (ctx._source.ref_count < 0) {
+                ctx.op = 'noop';
+            } else {
+                ctx._source.ref_count += params.count;
+            }
+        }
+    """
+    chunk_release_script = """
+        if (ctx._source.ref_count == null || ctx._source.ref_count < 0) {
+            ctx.op = 'noop';
+        } else {
+            ctx._source.ref_count -= params.count;
+            if (ctx._source.ref_count <= 0) {
+                ctx._source.ref_count = 0;
+                ctx._source.unreferenced_since = params.now;
+            }
+        }
+    """
+    chunk_tombstone_script = """
+        if (ctx._source.ref_count == 0 && ctx._source.unreferenced_since < params.before) {
+            ctx._source.ref_count = -1;
+        } else {
+            ctx.op = 'noop';
+        }
+    """
+    # A failed or abandoned claim on a derivative may be taken again once retry_after passes; every attempt
+    # doubles the wait, up to 64 times STORAGE_DERIVATIVE_RETRY_BACKOFF.
+    derivative_reclaim_script = """
+        if ((ctx._source.status == 'failed' || ctx._source.status == 'pending')
+                && (ctx._source.retry_after == null || ctx._source.retry_after < params.now)) {
+            int attempts = ctx._source.attempts == null ? 1 : ctx._source.attempts;
+            ctx._source.attempts = attempts + 1;
+            ctx._source.retry_after = params.now + params.backoff * (1L << Math.min(attempts, 6));
+            ctx._source.status = 'pending';
+            ctx._source.kind = params.kind;
+            ctx._source.source_key = params.source_key;
+            ctx._source.last_activity_date = params.now;
+            ctx._source.remove('error');
+        } else {
+            ctx.op = 'noop';
+        }
+    """
+    subfolder_script = """
+        if (doc['folder_path.keyword'].size() == 0) { return; }
+        String folder = doc['folder_path.keyword'].value;
+        if (folder.length() > params.prefix.length() && folder.startsWith(params.prefix)) {
+            String rest = folder.substring(params.prefix.length());
+            int slash = rest.indexOf('/');
+            emit(slash < 0 ? rest : rest.substring(0, slash));
+        }
+    """
+    browse_sort_fields = {'name': 'filename', 'size': 'size', 'date': 'creation_date'}
+    index_page_token_prefix = 'index:'
+
     def __init__(self):
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
@@ -27,7 +135,42 @@ class StorageFacade:
         self.es_facade = ESFacade()
         self.user_usage_index = settings.ES_USER_USAGE_INDEX
         self.file_hash_index = settings.ES_FILE_HASH_INDEX
+        self.blob_index = settings.ES_BLOB_INDEX
+        self.chunk_index = settings.ES_CHUNK_INDEX
+        self.derivative_index = settings.ES_DERIVATIVE_INDEX
+        self.chunked_mode = settings.STORAGE_CHUNKED_MODE
+        self.chunked_min_file_size = settings.STORAGE_CHUNKED_MIN_FILE_SIZE
+        self.batch_upload_workers = settings.STORAGE_BATCH_UPLOAD_WORKERS
+        self.async_finalization = settings.STORAGE_ASYNC_FINALIZATION
+        self.delete_batch_size = min(settings.STORAGE_DELETE_BATCH_SIZE, 1000)
+        self.move_workers = settings.STORAGE_MOVE_WORKERS
+        self.trash_enabled = settings.STORAGE_TRASH_ENABLED
+        self.trash_retention = settings.STORAGE_TRASH_RETENTION
+        self.gc_operations_per_second = settings.STORAGE_GC_OPERATIONS_PER_SECOND
+        self.chunk_gc_grace = settings.STORAGE_CHUNK_GC_GRACE
+        self.browse_from_index = settings.STORAGE_BROWSE_FROM_INDEX
+        self.browse_consistent = settings.STORAGE_BROWSE_CONSISTENT
+        self.browse_max_subfolders = settings.STORAGE_BROWSE_MAX_SUBFOLDERS
+        self.download_chunk_size = settings.STORAGE_DOWNLOAD_CHUNK_SIZE
+        self.zip_max_entries = settings.STORAGE_ZIP_MAX_ENTRIES
+        self.zip_stat_workers = settings.STORAGE_ZIP_STAT_WORKERS
+        self.zip_prefetch_depth = settings.STORAGE_ZIP_PREFETCH_DEPTH
+        self.zip_spool_memory = settings.STORAGE_ZIP_SPOOL_MEMORY
+        self.derivatives_enabled = settings.STORAGE_DERIVATIVES_ENABLED
+        self.derivative_max_source_size = settings.STORAGE_DERIVATIVE_MAX_SOURCE_SIZE
+        self.derivative_quality = settings.STORAGE_DERIVATIVE_QUALITY
+        self.derivative_retry_backoff = settings.STORAGE_DERIVATIVE_RETRY_BACKOFF
+        self.compression_enabled = settings.STORAGE_COMPRESSION_ENABLED
+        self.compression_level = settings.STORAGE_COMPRESSION_LEVEL
+        self.compression_min_size = settings.STORAGE_COMPRESSION_MIN_SIZE
+        self.compression_min_saving = settings.STORAGE_COMPRESSION_MIN_SAVING
         self.create_indices()
+        self.task_queue = TaskQueueFacade(self.es_facade)
+        self.hash_cache = HashLookupCache(self.es_facade, self.blob_index) if settings.HASH_CACHE_ENABLED else None
+        if self.chunked_mode:
+            self.s3_facade.create_chunk_bucket()
+        if self.derivatives_enabled:
+            self.s3_facade.create_derivative_bucket()
 
     def create_indices(self):
         audit_logger.info({
@@ -39,8 +182,10 @@ class StorageFacade:
             "details": {}
         })
 
-        indices = [self.user_usage_index, self.file_hash_index]
-        mappings = [USER_USAGE_INDEX_MAPPING, HASH_INDEX_MAPPING]
+        indices = [self.user_usage_index, self.file_hash_index, self.blob_index, self.chunk_index,
+                   self.derivative_index]
+        mappings = [USER_USAGE_INDEX_MAPPING, HASH_INDEX_MAPPING, BLOB_INDEX_MAPPING, CHUNK_INDEX_MAPPING,
+                    DERIVATIVE_INDEX_MAPPING]
 
         for index, mapping in zip(indices, mappings):
             self.es_facade.create_index(index, mapping)
@@ -53,6 +198,12 @@ class StorageFacade:
                 "details": mapping
             })
 
+        # Indices created before the keyword sub-fields existed gain them here; documents written earlier are
+        # picked up once they are re-indexed.
+        self.es_facade.put_mapping(self.file_hash_index, HASH_INDEX_MAPPING)
+        self.es_facade.put_mapping(self.chunk_index, CHUNK_INDEX_MAPPING)
+        self.es_facade.put_mapping(self.derivative_index, DERIVATIVE_INDEX_MAPPING)
+
     @staticmethod
     def create_file_hash(file_content):
         audit_logger.info({
@@ -65,7 +216,7 @@ class StorageFacade:
         })
         return hashlib.sha256(file_content).hexdigest()
 
-    def create_object(self, user_id, file_path, file_content):
+    def create_object(self, user_id, file_path, file_content, file_hash=None, read_your_writes=False):
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
             "user": user_id,
@@ -75,39 +226,74 @@ class StorageFacade:
             "details": {"file_size": len(file_content)}
         })
 
-        file_hash = self.create_file_hash(file_content)
-        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+        file_hash = file_hash or self.create_file_hash(file_content)
 
         try:
-            es_query = {"query": {"term": {"hash": file_hash}}}
-            search_result = self.es_facade.es_client.search(index=self.file_hash_index, body=es_query)
+            original_doc = self._acquire_original(file_hash)
 
-            if search_result['hits']['total']['value'] > 0:
-                original_doc = search_result['hits']['hits'][0]['_source']
-                original_file_key = original_doc['original_key']
-
-                metadata = {'original-key': original_file_key}
-                self.s3_facade.upload_file(user_id, file_path, b'', metadata)
+            if original_doc:
+                return self._link_object(user_id, file_path, file_hash, original_doc, read_your_writes)
+            elif self.chunked_mode and len(file_content) >= self.chunked_min_file_size:
+                chunk_writer = ChunkedObjectWriter(self)
+                chunk_writer.write(file_content)
+                chunk_refs = chunk_writer.close()
+                return self._store_chunk_manifest(user_id, file_path, file_hash, len(file_content), chunk_refs,
+                                                  chunk_writer.stored_size, read_your_writes)
+            else:
+                body, metadata = self._prepare_content(file_path, file_content, file_hash)
+                self.s3_facade.upload_file(user_id, file_path, body, metadata)
 
-                self._update_user_usage(user_id, 0)
-                self._index_file_hash(file_path, file_hash, user_id, file_size=0, original_key=original_file_key)
+                link_result = self._store_original(user_id, file_path, file_hash, len(file_content),
+                                                   codec=metadata.get('codec'), stored_size=len(body),
+                                                   read_your_writes=read_your_writes)
+                if link_result:
+                    return link_result
 
                 audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
                     "user": user_id,
-                    "action": "file_linked",
+                    "action": "file_uploaded",
                     "resource": file_path,
-                    "message": f"File {file_path} linked to existing object with key {original_file_key}.",
-                    "details": {"original_key": original_file_key}
+                    "message": f"File {file_path} uploaded successfully.",
+                    "details": {"file_size": len(file_content), "stored_size": len(body),
+                                "codec": metadata.get('codec')}
                 })
-                return f"File {file_path} linked to existing object with key {original_file_key}."
+                return f"File {file_path} uploaded successfully."
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error during object creation: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(f"Error during object creation: {str(e)}")
+
+    def complete_multipart_object(self, user_id, file_path, upload_id, parts, file_hash, file_size,
+                                  read_your_writes=False):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "complete_multipart_object",
+            "resource": file_path,
+            "message": "Completing streamed multipart object in S3",
+            "details": {"file_size": file_size, "upload_id": upload_id, "parts_count": len(parts)}
+        })
+
+        try:
+            original_doc = self._acquire_original(file_hash)
+
+            if original_doc:
+                self.s3_facade.abort_multipart_upload(user_id, file_path, upload_id)
+                return self._link_object(user_id, file_path, file_hash, original_doc, read_your_writes)
             else:
-                self.s3_facade.upload_file(user_id, file_path, file_content)
-                full_original_key = os.path.join(bucket_name, file_path)
+                self.s3_facade.complete_multipart_upload(user_id, file_path, upload_id, parts)
 
-                self._index_file_hash(file_path, file_hash, user_id, file_size=len(file_content),
-                                      original_key=full_original_key)
-                self._update_user_usage(user_id, len(file_content))
+                link_result = self._store_original(user_id, file_path, file_hash, file_size,
+                                                   read_your_writes=read_your_writes)
+                if link_result:
+                    return link_result
 
                 audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
@@ -115,19 +301,419 @@ class StorageFacade:
                     "action": "file_uploaded",
                     "resource": file_path,
                     "message": f"File {file_path} uploaded successfully.",
-                    "details": {"file_size": len(file_content)}
+                    "details": {"file_size": file_size, "upload_id": upload_id}
                 })
                 return f"File {file_path} uploaded successfully."
         except (ClientError, BotoCoreError) as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "level": "ERROR",
-                "message": f"Error during object creation: {str(e)}",
+                "message": f"Error during multipart object completion: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "upload_id": upload_id}
+            })
+            raise Exception(f"Error during multipart object completion: {str(e)}")
+
+    def promote_staged_object(self, user_id, staging_key, file_path, file_hash, file_size):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "promote_staged_object",
+            "resource": file_path,
+            "message": "Promoting staged object in S3",
+            "details": {"file_size": file_size, "staging_key": staging_key}
+        })
+
+        try:
+            original_doc = self._acquire_original(file_hash)
+
+            if original_doc:
+                result = self._link_object(user_id, file_path, file_hash, original_doc)
+            else:
+                self.s3_facade.copy_object(user_id, staging_key, user_id, file_path,
+                                           metadata={'content-hash': file_hash}, size=file_size)
+                result = self._store_original(user_id, file_path, file_hash, file_size)
+
+            if not result:
+                audit_logger.info({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "user": user_id,
+                    "action": "file_uploaded",
+                    "resource": file_path,
+                    "message": f"File {file_path} uploaded successfully.",
+                    "details": {"file_size": file_size, "staging_key": staging_key}
+                })
+                result = f"File {file_path} uploaded successfully."
+
+            self.s3_facade.delete_object(user_id, staging_key)
+            return result
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error during staged object promotion: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "staging_key": staging_key}
+            })
+            raise Exception(f"Error during staged object promotion: {str(e)}")
+
+    def probe_object(self, user_id, file_path, file_hash, file_size, read_your_writes=False):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "probe_object",
+            "resource": file_path,
+            "message": "Probing for existing content before upload",
+            "details": {"file_hash": file_hash, "file_size": file_size}
+        })
+
+        try:
+            # A hash and a size are no proof of holding the content, so only content the caller already has an
+            # entry for is linked; anything else must be uploaded, and may still be deduplicated then.
+            original_doc = self._acquire_original(file_hash, file_size=file_size) \
+                if self._references_content(user_id, file_hash) else None
+
+            if original_doc:
+                return {
+                    'exists': True,
+                    'message': self._link_object(user_id, file_path, file_hash, original_doc, read_your_writes)
+                }
+
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "probe_missed",
+                "resource": file_path,
+                "message": f"No stored content matches {file_path}; full upload required.",
+                "details": {"file_hash": file_hash, "file_size": file_size}
+            })
+            return {'exists': False, 'message': f"Content for {file_path} must be uploaded."}
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error probing object {file_path}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "file_hash": file_hash}
+            })
+            raise Exception(f"Error probing object {file_path}: {str(e)}")
+
+    def _references_content(self, user_id, file_hash):
+        response = self.es_facade.search(self.file_hash_index, {
+            "query": {"bool": {"filter": [
+                {"term": {"user_id.keyword": user_id}},
+                {"term": {"hash": file_hash}}
+            ]}},
+            "size": 0,
+            "terminate_after": 1
+        })
+        return response['hits']['total']['value'] > 0
+
+    def create_objects(self, user_id, files):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "create_objects",
+            "resource": "batch",
+            "message": "Creating a batch of objects in S3",
+            "details": {"files_count": len(files)}
+        })
+
+        entries = []
+        for file_path, file_obj in files:
+            hasher = hashlib.sha256()
+            file_size = 0
+            for block in iter(lambda: file_obj.read(1024 * 1024), b''):
+                hasher.update(block)
+                file_size += len(block)
+            file_obj.seek(0)
+            entries.append({
+                'user_id': user_id,
+                'file_path': file_path,
+                'file': file_obj,
+                'hash': hasher.hexdigest(),
+                'size': file_size,
+                'status': None,
+                'message': None
+            })
+
+        # Every copy of content that is already stored takes its reference in one bulk request.
+        stored_blobs = self._acquire_originals(Counter(entry['hash'] for entry in entries))
+        first_entries, duplicate_entries, seen_hashes = [], [], set()
+        for entry in entries:
+            entry['original_doc'] = stored_blobs.get(entry['hash'])
+            if entry['original_doc'] or entry['hash'] not in seen_hashes:
+                first_entries.append(entry)
+            else:
+                duplicate_entries.append(entry)
+            seen_hashes.add(entry['hash'])
+
+        # Duplicates of new content run after the first copy has registered its blob, so they link to it.
+        with ThreadPoolExecutor(max_workers=self.batch_upload_workers) as executor:
+            list(executor.map(self._store_batch_entry, first_entries))
+            new_blobs = self._acquire_originals(Counter(entry['hash'] for entry in duplicate_entries))
+            for entry in duplicate_entries:
+                entry['original_doc'] = new_blobs.get(entry['hash'])
+            list(executor.map(self._store_batch_entry, duplicate_entries))
+
+        indexed_entries = [entry for entry in entries if entry.get('document')]
+        if indexed_entries:
+            self.es_facade.bulk_index_documents(self.file_hash_index, [entry['document'] for entry in indexed_entries])
+            for entry in indexed_entries:
+                self._request_derivatives(user_id, entry['file_path'], entry['hash'])
+            self._update_user_usage(user_id, sum(entry['usage_size'] for entry in indexed_entries),
+                                    file_count_change=len(indexed_entries),
+                                    stored_size_change=sum(entry['stored_size'] for entry in indexed_entries))
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "objects_created",
+            "resource": "batch",
+            "message": f"Batch of {len(entries)} files processed for user {user_id}.",
+            "details": {
+                "uploaded_count": sum(1 for entry in entries if entry['status'] == 'uploaded'),
+                "linked_count": sum(1 for entry in entries if entry['status'] == 'linked'),
+                "error_count": sum(1 for entry in entries if entry['status'] == 'error')
+            }
+        })
+        return [
+            {'name': entry['file_path'], 'status': entry['status'], 'message': entry['message']}
+            for entry in entries
+        ]
+
+    def _store_batch_entry(self, entry):
+        user_id, file_path, file_hash = entry['user_id'], entry['file_path'], entry['hash']
+        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+
+        try:
+            original_doc = entry['original_doc']
+
+            if not original_doc and self.chunked_mode and entry['size'] >= self.chunked_min_file_size:
+                # Chunked objects are registered, indexed and accounted by create_object itself.
+                entry['message'] = self.create_object(user_id, file_path, entry['file'].read(), file_hash=file_hash)
+                entry['status'] = 'uploaded'
+                return
+
+            if not original_doc:
+                body, metadata = self._prepare_content(file_path, entry['file'].read(), file_hash)
+                self.s3_facade.upload_file(user_id, file_path, body, metadata)
+                full_original_key = os.path.join(bucket_name, file_path)
+                original_doc = entry['original_doc'] = self._register_blob(file_hash, full_original_key,
+                                                                           entry['size'], codec=metadata.get('codec'))
+                if not original_doc:
+                    doc_id, document = self._build_file_hash_document(file_path, file_hash, user_id, entry['size'],
+                                                                      full_original_key, codec=metadata.get('codec'),
+                                                                      stored_size=len(body))
+                    entry.update({
+                        'document': {'id': doc_id, 'body': document},
+                        'usage_size': entry['size'],
+                        'stored_size': len(body),
+                        'status': 'uploaded',
+                        'message': f"File {file_path} uploaded successfully."
+                    })
+                    return
+
+            original_file_key = original_doc['original_key']
+            storage_mode = original_doc.get('storage_mode')
+            self.s3_facade.upload_file(user_id, file_path, b'',
+                                       self._link_metadata(original_file_key, storage_mode, file_hash,
+                                                           original_doc.get('codec')))
+            doc_id, document = self._build_file_hash_document(file_path, file_hash, user_id, 0,
+                                                              original_file_key, storage_mode)
+            entry.update({
+                'document': {'id': doc_id, 'body': document},
+                'usage_size': 0,
+                'stored_size': 0,
+                'status': 'linked',
+                'message': f"File {file_path} linked to existing object with key {original_file_key}."
+            })
+        except Exception as e:
+            entry['document'] = None
+            entry['status'] = 'error'
+            entry['message'] = str(e)
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error storing batch file {file_path}: {str(e)}",
                 "exception": str(e),
                 "stack_trace": None,
                 "context": {"user_id": user_id, "file_path": file_path}
             })
-            raise Exception(f"Error during object creation: {str(e)}")
+            if entry['original_doc']:
+                # The reference taken for the link that was not written.
+                self._release_blob(file_hash)
+
+    def create_chunked_object(self, user_id, file_path, file_hash, file_size, chunk_refs, stored_size,
+                              read_your_writes=False):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "create_chunked_object",
+            "resource": file_path,
+            "message": "Creating chunked object in S3",
+            "details": {"file_size": file_size, "chunks_count": len(chunk_refs)}
+        })
+
+        try:
+            original_doc = self._acquire_original(file_hash)
+
+            if original_doc:
+                return self._link_object(user_id, file_path, file_hash, original_doc, read_your_writes)
+            return self._store_chunk_manifest(user_id, file_path, file_hash, file_size, chunk_refs, stored_size,
+                                              read_your_writes)
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error during chunked object creation: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(f"Error during chunked object creation: {str(e)}")
+
+    def store_chunks(self, chunks):
+        chunk_refs = [{'hash': self.create_file_hash(chunk), 'size': len(chunk)} for chunk in chunks]
+        existing_chunks = self.es_facade.get_documents(self.chunk_index, {ref['hash'] for ref in chunk_refs})
+
+        new_chunk_docs = {}
+        for chunk_ref, chunk in zip(chunk_refs, chunks):
+            chunk_hash = chunk_ref['hash']
+            if chunk_hash in existing_chunks or chunk_hash in new_chunk_docs:
+                continue
+            chunk_key = self.s3_facade.upload_chunk(chunk_hash, chunk)
+            now = int(datetime.now().timestamp() * 1000)
+            # Unreferenced until the manifest that uses it is stored; see collect_chunks.
+            new_chunk_docs[chunk_hash] = {
+                'id': chunk_hash,
+                'body': {
+                    "hash": chunk_hash,
+                    "chunk_key": chunk_key,
+                    "size": chunk_ref['size'],
+                    "ref_count": 0,
+                    "creation_date": now,
+                    "unreferenced_since": now
+                }
+            }
+
+        if new_chunk_docs:
+            # A concurrent upload of the same chunk may have indexed it already, with references of its own.
+            self.es_facade.bulk_index_documents(self.chunk_index, list(new_chunk_docs.values()), op_type='create')
+
+        stored_size = sum(doc['body']['size'] for doc in new_chunk_docs.values())
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "chunks_stored",
+            "resource": self.chunk_index,
+            "message": f"Stored {len(new_chunk_docs)} new chunks out of {len(chunk_refs)}.",
+            "details": {"chunks_count": len(chunk_refs), "new_chunks_count": len(new_chunk_docs),
+                        "stored_size": stored_size}
+        })
+        return chunk_refs, stored_size
+
+    def iter_chunks(self, manifest, byte_range=None):
+        chunk_start = 0
+        for chunk_ref in manifest['chunks']:
+            chunk_end = chunk_start + chunk_ref['size'] - 1
+            if byte_range is None:
+                yield self.s3_facade.get_chunk(chunk_ref['hash'])
+            elif chunk_start > byte_range[1]:
+                break
+            elif chunk_end >= byte_range[0]:
+                chunk = self.s3_facade.get_chunk(chunk_ref['hash'])
+                yield chunk[max(byte_range[0] - chunk_start, 0):byte_range[1] - chunk_start + 1]
+            chunk_start = chunk_end + 1
+
+    def stat_download(self, user_id, file_path):
+        object_stat = self.s3_facade.stat_object(user_id, file_path)
+        source_user_id, source_path = user_id, file_path
+
+        if 'original-key' in object_stat['metadata']:
+            bucket_name, source_path = object_stat['metadata']['original-key'].split('/', 1)
+            source_user_id = bucket_name.split('-')[1]
+            object_stat = self.s3_facade.stat_object(source_user_id, source_path)
+
+        metadata = object_stat['metadata']
+        return {
+            'user_id': source_user_id,
+            'file_path': source_path,
+            'size': int(metadata.get('logical-size', object_stat['size'])),
+            'etag': metadata.get('content-hash') or object_stat['etag'],
+            'last_modified': object_stat['last_modified'],
+            'content_type': object_stat['content_type'],
+            'chunked': 'chunk-manifest' in metadata,
+            'codec': metadata.get('codec')
+        }
+
+    def generate_download_link(self, object_info):
+        return self.s3_facade.generate_download_link(object_info['user_id'], object_info['file_path'],
+                                                     version=object_info['etag'])
+
+    def open_object_stream(self, object_info, byte_range=None):
+        user_id, file_path = object_info['user_id'], object_info['file_path']
+
+        if object_info['chunked']:
+            body, _ = self.s3_facade.get_object_stream(user_id, file_path)
+            return self.iter_chunks(json.loads(body.read()), byte_range)
+        if object_info['codec']:
+            if byte_range is not None:
+                raise Exception(f"Byte ranges of compressed object {file_path} cannot be served.")
+            body, _ = self.s3_facade.get_object_stream(user_id, file_path)
+            return iter_decompressed(body, object_info['codec'], self.download_chunk_size)
+
+        body, _ = self.s3_facade.get_object_stream(user_id, file_path, byte_range)
+        return body.iter_chunks(chunk_size=self.download_chunk_size)
+
+    def iter_folder_files(self, user_id, folder_path):
+        folder_path = folder_path.strip('/')
+        for name in self.s3_facade.iter_folder_contents(user_id, folder_path, only_name=True):
+            file_path = os.path.join(folder_path, name)
+            if name.endswith('/'):
+                yield from self.iter_folder_files(user_id, file_path)
+            else:
+                yield file_path
+
+    def stream_archive(self, user_id, folder_path, file_names=(), folder_names=()):
+        folder_path = folder_path.strip('/')
+        file_paths = [os.path.join(folder_path, name) for name in file_names]
+        if file_names or folder_names:
+            folder_paths = [os.path.join(folder_path, name) for name in folder_names]
+        else:
+            folder_paths = [folder_path]
+        for selected_folder in folder_paths:
+            for file_path in self.iter_folder_files(user_id, selected_folder):
+                file_paths.append(file_path)
+                if len(file_paths) > self.zip_max_entries:
+                    raise Exception(f"Archives are limited to {self.zip_max_entries} files.")
+
+        # Links are resolved up front, so content shared by several entries is known before the first is written.
+        with ThreadPoolExecutor(max_workers=self.zip_stat_workers) as executor:
+            object_infos = list(executor.map(lambda file_path: self.stat_download(user_id, file_path), file_paths))
+
+        prefix_length = len(folder_path) + 1 if folder_path else 0
+        entries = [
+            ZipEntry(file_path[prefix_length:], f"{object_info['user_id']}/{object_info['file_path']}",
+                     object_info['size'], object_info['last_modified'], object_info)
+            for file_path, object_info in zip(file_paths, object_infos)
+        ]
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "archive_streamed",
+            "resource": folder_path,
+            "message": f"Streaming an archive of {len(entries)} files from {folder_path} for user {user_id}.",
+            "details": {"entries_count": len(entries),
+                        "unique_contents_count": len({entry.content_key for entry in entries}),
+                        "total_size": sum(entry.size for entry in entries)}
+        })
+        writer = ZipStreamWriter(self.open_object_stream, prefetch_depth=self.zip_prefetch_depth,
+                                 spool_memory=self.zip_spool_memory)
+        return writer.iter_archive(entries)
 
     def create_folder(self, user_id, folder_path):
         audit_logger.info({
@@ -141,6 +727,7 @@ class StorageFacade:
 
         try:
             self.s3_facade.create_folder(user_id, folder_path)
+            UserStorageState.bump(user_id)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
@@ -161,6 +748,137 @@ class StorageFacade:
             })
             raise Exception(f"Error creating folder {folder_path} for user {user_id}: {str(e)}")
 
+    def list_folder(self, user_id, folder_path, page_size, continuation_token=None, sort='name', order='asc'):
+        is_index_token = bool(continuation_token) and continuation_token.startswith(self.index_page_token_prefix)
+        if self.browse_from_index and not self._index_behind(user_id):
+            try:
+                return self._list_folder_from_index(user_id, folder_path, page_size,
+                                                    continuation_token if is_index_token else None, sort, order)
+            except ApiError as e:
+                error_logger.error({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "level": "ERROR",
+                    "message": f"Error browsing folder {folder_path} from the index for user {user_id}, "
+                               f"falling back to S3: {str(e)}",
+                    "exception": str(e),
+                    "stack_trace": None,
+                    "context": {"user_id": user_id, "folder_path": folder_path}
+                })
+        if is_index_token:
+            # An index page token means nothing to S3, so the listing restarts from the first page.
+            continuation_token = None
+
+        try:
+            try:
+                contents, next_token = self.s3_facade.list_folder_page(user_id, folder_path, page_size=page_size,
+                                                                       continuation_token=continuation_token,
+                                                                       use_cache=True)
+            except ClientError as e:
+                if not continuation_token or e.response.get('Error', {}).get('Code') != 'InvalidArgument':
+                    raise
+                # A token S3 does not recognise, like an index token, restarts the listing from the first page.
+                contents, next_token = self.s3_facade.list_folder_page(user_id, folder_path, page_size=page_size,
+                                                                       use_cache=True)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "folder_contents_listed",
+                "resource": folder_path,
+                "message": f"Listed a page of folder {folder_path} for user {user_id}.",
+                "details": {"page_size": page_size, "items_count": len(contents), "has_next": next_token is not None}
+            })
+            return {'items': contents, 'next_token': next_token, 'source': 's3'}
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error listing folder {folder_path} for user {user_id}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "folder_path": folder_path}
+            })
+            raise Exception(f"Error listing folder {folder_path} for user {user_id}: {str(e)}")
+
+    def _index_behind(self, user_id):
+        """The index lags S3 while finalization tasks of the user are still queued."""
+        if not self.browse_consistent or not self.async_finalization:
+            return False
+        return self.task_queue.pending_count('finalize_object', user_id) > 0
+
+    def _list_folder_from_index(self, user_id, folder_path, page_size, page_token, sort, order):
+        folder_path = folder_path.strip('/')
+        sort_field = self.browse_sort_fields.get(sort, 'filename')
+        order = 'desc' if order == 'desc' else 'asc'
+        sort_clause = [{sort_field: order}]
+        if sort_field != 'filename':
+            # File names are unique within a folder, which makes search_after positions unambiguous.
+            sort_clause.append({'filename': order})
+
+        body = {
+            "query": {"bool": {"filter": [
+                {"term": {"user_id.keyword": user_id}},
+                {"term": {"folder_path.keyword": folder_path}}
+            ], "must_not": [{"exists": {"field": "trashed_at"}}]}},
+            "sort": sort_clause,
+            "size": page_size,
+            "_source": ["filename", "size"]
+        }
+        search_after = self._decode_index_page_token(page_token) if page_token else None
+        if search_after:
+            body["search_after"] = search_after
+        else:
+            # Subfolders are listed once, on the first page, from the folder paths of every file below this one.
+            prefix = f"{folder_path}/" if folder_path else ''
+            body["runtime_mappings"] = {
+                "subfolder": {"type": "keyword", "script": {"source": self.subfolder_script,
+                                                            "params": {"prefix": prefix}}}
+            }
+            body["aggs"] = {"subfolders": {"global": {}, "aggs": {"below": {
+                "filter": {"bool": {"filter": [
+                    {"term": {"user_id.keyword": user_id}},
+                    {"prefix": {"folder_path.keyword": prefix}}
+                ], "must_not": [{"exists": {"field": "trashed_at"}}]}},
+                "aggs": {"names": {"terms": {"field": "subfolder", "size": self.browse_max_subfolders,
+                                             "order": {"_key": "asc"}}}}
+            }}}}
+
+        response = self.es_facade.search(self.file_hash_index, body)
+        hits = response['hits']['hits']
+
+        contents = []
+        if not search_after:
+            for bucket in response['aggregations']['subfolders']['below']['names']['buckets']:
+                contents.append({'name': bucket['key'], 'type': 'folder', 'size': 'N/A'})
+        for hit in hits:
+            contents.append({'name': hit['_source']['filename'], 'type': 'file', 'size': hit['_source']['size']})
+
+        next_token = None
+        if len(hits) == page_size:
+            next_token = self.index_page_token_prefix + base64.urlsafe_b64encode(
+                json.dumps(hits[-1]['sort']).encode()
+            ).decode()
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "folder_contents_listed",
+            "resource": folder_path,
+            "message": f"Listed a page of folder {folder_path} for user {user_id} from the index.",
+            "details": {"page_size": page_size, "items_count": len(contents), "sort": sort_field, "order": order,
+                        "has_next": next_token is not None}
+        })
+        return {'items': contents, 'next_token': next_token, 'source': 'index'}
+
+    def _decode_index_page_token(self, page_token):
+        """Returns the search_after position of an index page token, or None for a token that is not one."""
+        try:
+            search_after = json.loads(
+                base64.urlsafe_b64decode(page_token[len(self.index_page_token_prefix):].encode())
+            )
+        except ValueError:
+            return None
+        return search_after if isinstance(search_after, list) else None
+
     def read_object(self, user_id, file_path):
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
@@ -172,13 +890,37 @@ class StorageFacade:
         })
 
         try:
-            content, metadata = self.s3_facade.get_object(user_id, file_path)
+            object_stat = self.s3_facade.stat_object(user_id, file_path)
+            metadata = object_stat['metadata']
+
+            if 'chunk-manifest' in metadata or 'codec' in metadata:
+                # Chunked and compressed objects are reassembled by the app, so the client cannot fetch them
+                # from S3 directly.
+                folder_path, filename = os.path.split(file_path)
+                query_string = urlencode({'current_folder': folder_path, 'file': filename})
+                audit_logger.info({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "user": user_id,
+                    "action": "download_link_generated",
+                    "resource": file_path,
+                    "message": f"Generated streaming download link for {file_path}.",
+                    "details": {"original_key": metadata.get('original-key'), "codec": metadata.get('codec')}
+                })
+                return {
+                    'name': file_path,
+                    'type': 'file',
+                    'size': metadata.get('logical-size', "Linked"),
+                    'download_link': f"{reverse('download_file')}?{query_string}",
+                    'chunked': 'chunk-manifest' in metadata,
+                    'streamed': True
+                }
 
             if 'original-key' in metadata:
                 original_file_path = metadata['original-key']
                 bucket_name, file_path = original_file_path.split('/', 1)
                 source_user_id = bucket_name.split('-')[1]
-                download_link = self.s3_facade.generate_download_link(source_user_id, file_path)
+                download_link = self.s3_facade.generate_download_link(source_user_id, file_path,
+                                                                      version=metadata.get('content-hash'))
                 audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
                     "user": user_id,
@@ -188,7 +930,8 @@ class StorageFacade:
                     "details": {"original_key": original_file_path}
                 })
             else:
-                download_link = self.s3_facade.generate_download_link(user_id, file_path)
+                download_link = self.s3_facade.generate_download_link(user_id, file_path,
+                                                                      version=object_stat['etag'])
                 audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
                     "user": user_id,
@@ -201,13 +944,13 @@ class StorageFacade:
             return {
                 'name': file_path,
                 'type': 'file',
-                'size': metadata.get('Content-Length', 0) if metadata.get('Content-Length', 0) else "Linked" ,
+                'size': object_stat['size'] if object_stat['size'] else "Linked",
                 'download_link': download_link
             }
 
         except (ClientError, BotoCoreError, Exception):
             try:
-                folder_contents = self.s3_facade.list_folder_contents(user_id, file_path)
+                folder_contents = self.s3_facade.list_folder_contents(user_id, file_path, use_cache=True)
                 audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
                     "user": user_id,
@@ -228,111 +971,997 @@ class StorageFacade:
                 })
                 raise Exception(f"Error reading object or folder {file_path} for user {user_id}: {str(inner_e)}")
 
-    def delete_object(self, user_id, file_path):
+    def move_object(self, user_id, file_path, destination_path):
+        file_path, destination_path = file_path.strip('/'), destination_path.strip('/')
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
             "user": user_id,
-            "action": "delete_object",
+            "action": "move_object",
             "resource": file_path,
-            "message": "Deleting object from S3",
-            "details": {}
+            "message": "Moving object in S3",
+            "details": {"destination_path": destination_path}
         })
+        if not destination_path or destination_path == file_path:
+            raise Exception(f"Cannot move {file_path} to {destination_path or 'the root'}.")
 
+        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+        doc_id = f"{bucket_name}/{file_path}"
         try:
-            content, metadata = self.s3_facade.get_object(user_id, file_path)
+            document = self.es_facade.get_document(self.file_hash_index, doc_id)
+        except NotFoundError:
+            if next(self.s3_facade.iter_prefix_pages(user_id, f"{file_path}/", page_size=1), []):
+                return self.move_folder(user_id, file_path, destination_path)
+            raise Exception(f"File {file_path} does not exist or is still being processed.")
 
-            if 'original-key' in metadata:
-                self.s3_facade.delete_object(user_id, file_path)
-                self.es_facade.delete_document(self.file_hash_index, f"{user_id}/{file_path}")
-                self._update_user_usage(user_id, 0, decrement_file_count=True)
-                audit_logger.info({
-                    "timestamp": int(datetime.now().timestamp() * 1000),
-                    "user": user_id,
-                    "action": "link_deleted",
-                    "resource": file_path,
-                    "message": f"Link {file_path} deleted successfully for user {user_id}.",
-                    "details": {}
-                })
-                return f"Link {file_path} deleted successfully."
-            else:
-                es_query = {
-                    "query": {
-                        "match": {
-                            "original_key": f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"}
-                    }
-                }
-                search_result = self.es_facade.es_client.search(index=self.file_hash_index, body=es_query)
+        try:
+            self.s3_facade.stat_object(user_id, destination_path)
+            destination_exists = True
+        except Exception:
+            destination_exists = False
+        if destination_exists:
+            raise Exception(f"Destination {destination_path} already exists.")
+        object_stat = self.s3_facade.stat_object(user_id, file_path)
 
-                if search_result['hits']['total']['value'] > 1:
-                    new_content_holder = None
-                    for hit in search_result['hits']['hits']:
-                        potential_new_holder = hit['_id']
-                        if potential_new_holder != f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}":
-                            new_content_holder = potential_new_holder
-                            break
+        moved_count, failed_count = self._move_entries(
+            user_id, [(doc_id, {'key': file_path, 'size': object_stat['size']}, document)],
+            lambda key: destination_path
+        )
+        if failed_count:
+            raise Exception(f"File {file_path} could not be moved to {destination_path}.")
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "object_moved",
+            "resource": file_path,
+            "message": f"File {file_path} moved to {destination_path} for user {user_id}.",
+            "details": {"destination_path": destination_path}
+        })
+        return f"File {file_path} moved to {destination_path}."
 
-                    if new_content_holder is None:
-                        raise Exception(
-                            f"No valid new content holder found for {file_path}. Cannot delete main object.")
+    def move_folder(self, user_id, folder_path, destination_path):
+        """
+        Moves everything under a folder to another folder, one listing page at a time, without reading content.
 
-                    new_content_holder_bucket_name, new_content_holder_file_path = new_content_holder.split('/', 1)
-                    new_content_holder_user_id = new_content_holder_bucket_name.split('-')[1]
-                    self.s3_facade.upload_file(new_content_holder_user_id, new_content_holder_file_path, content)
-
-                    for hit in search_result['hits']['hits']:
-                        doc_id = hit['_id']
-                        if doc_id not in [new_content_holder,
-                                          f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"]:
-                            self.es_facade.update_document(self.file_hash_index, doc_id,
-                                                           {'original_key': new_content_holder})
-                            linked_bucket_name, linked_file_path = doc_id.split("/", 1)
-                            linked_user_id = linked_bucket_name.split('-')[1]
-                            self.s3_facade.upload_file(linked_user_id, linked_file_path, b'',
-                                                       {'original-key': new_content_holder})
-
-                    self._index_file_hash(new_content_holder_file_path, self.create_file_hash(content),
-                                          new_content_holder_user_id, file_size=len(content),
-                                          original_key=new_content_holder)
+        Each page is copied inside S3 by parallel requests and the copies are indexed with one bulk request;
+        only then are its sources removed with one DeleteObjects call and their old entries with one bulk
+        delete. The destination must be empty. A move that stops half-way can be run again to move what is left.
+        """
+        folder_path, destination_path = folder_path.strip('/'), destination_path.strip('/')
+        if not folder_path or destination_path == folder_path or destination_path.startswith(f"{folder_path}/"):
+            raise Exception(f"Cannot move folder {folder_path} into {destination_path or 'the root'}.")
+        if next(self.s3_facade.iter_prefix_pages(user_id, f"{destination_path}/", page_size=1), []):
+            raise Exception(f"Destination {destination_path} already exists.")
 
-                self.s3_facade.delete_object(user_id, file_path)
-                self.es_facade.delete_document(self.file_hash_index,
-                                               f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}")
-                self._update_user_usage(user_id, -len(content), decrement_file_count=True)
-                audit_logger.info({
-                    "timestamp": int(datetime.now().timestamp() * 1000),
-                    "user": user_id,
-                    "action": "original_file_deleted",
-                    "resource": file_path,
-                    "message": f"Original file {file_path} deleted successfully for user {user_id}.",
-                    "details": {}
-                })
-                return f"Original file {file_path} deleted successfully."
-        except (ClientError, BotoCoreError, Exception) as e:
-            try:
-                folder_contents = self.s3_facade.list_folder_contents(user_id, file_path, only_name=True)
-                for item in folder_contents:
-                    item_name = os.path.join(file_path, item)
-                    self.delete_object(user_id, item_name)
-                self.s3_facade.delete_object(user_id, os.path.join(file_path, ''))
-                audit_logger.info({
-                    "timestamp": int(datetime.now().timestamp() * 1000),
-                    "user": user_id,
-                    "action": "folder_deleted",
-                    "resource": file_path,
-                    "message": f"Folder {file_path} and its contents deleted successfully for user {user_id}.",
+        prefix = f"{folder_path}/"
+        moved_count, failed_count = 0, 0
+
+        def destination_for(key):
+            return f"{destination_path}/{key[len(prefix):]}"
+
+        # Every page is moved before the next one is listed; moved keys disappear from the listing behind it.
+        for page in self.s3_facade.iter_prefix_pages(user_id, prefix, page_size=self.delete_batch_size):
+            links, originals, unindexed_paths = self._classify_page(user_id, page)
+            failed_count += len(unindexed_paths)
+            page_moved_count, page_failed_count = self._move_entries(user_id, links + originals, destination_for)
+            moved_count += page_moved_count
+            failed_count += page_failed_count
+
+            folder_markers = [item['key'] for item in page if item['key'].endswith('/')]
+            for marker in folder_markers:
+                self.s3_facade.create_folder(user_id, destination_for(marker))
+            self.s3_facade.delete_objects(user_id, folder_markers)
+        UserStorageState.bump(user_id)
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "folder_moved",
+            "resource": folder_path,
+            "message": f"Folder {folder_path} moved to {destination_path} for user {user_id}.",
+            "details": {"moved_count": moved_count, "failed_count": failed_count}
+        })
+        if failed_count:
+            raise Exception(f"{failed_count} objects in folder {folder_path} could not be moved.")
+        return f"Folder {folder_path} moved to {destination_path}."
+
+    def _move_entries(self, user_id, entries, destination_for, document_fields=None):
+        """
+        Moves indexed objects of one user to the keys given by destination_for and returns the moved and failed
+        counts. document_fields are set on the moved catalog entries.
+
+        Objects are copied server-side, links being empty objects whose metadata comes along. The copies are
+        indexed, and links anywhere that point at a moved original are re-pointed with one bulk update of the
+        index and metadata-only writes to S3, before any source is touched; if that fails, the re-pointing is
+        undone and the copies are dropped. Only then are the sources and their old entries removed. A source
+        that cannot be removed keeps its old entry and is reported as failed, so running the move again finishes
+        it.
+        """
+        if not entries:
+            return 0, 0
+        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+
+        def copy_entry(entry):
+            _, item, _ = entry
+            self.s3_facade.copy_object(user_id, item['key'], user_id, destination_for(item['key']),
+                                       size=item['size'])
+            return entry
+
+        copied_entries = []
+        with ThreadPoolExecutor(max_workers=self.move_workers) as executor:
+            for future in [executor.submit(copy_entry, entry) for entry in entries]:
+                try:
+                    copied_entries.append(future.result())
+                except Exception:
+                    pass
+        if not copied_entries:
+            return 0, len(entries)
+
+        new_documents, moved_originals = [], {}
+        for doc_id, item, document in copied_entries:
+            destination_path = destination_for(item['key'])
+            folder_path, filename = os.path.split(destination_path)
+            new_document = {**document, "folder_path": folder_path, "filename": filename,
+                            "object_key": destination_path,
+                            "file_type": filename.split('.')[-1] if '.' in filename else 'unknown',
+                            **(document_fields or {})}
+            if self._is_original(doc_id, item['key'], document):
+                new_document["original_key"] = f"{bucket_name}/{destination_path}"
+                moved_originals[doc_id] = (new_document["original_key"], document)
+            new_documents.append({'id': f"{bucket_name}/{destination_path}", 'body': new_document})
+
+        try:
+            self.es_facade.bulk_index_documents(self.file_hash_index, new_documents)
+            if moved_originals:
+                self._repoint_moved_originals(moved_originals)
+        except Exception as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error indexing {len(new_documents)} moved objects for user {user_id}, "
+                           f"dropping the copies: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "objects_count": len(new_documents)}
+            })
+            self._drop_moved_copies(user_id, new_documents, moved_originals)
+            return 0, len(entries)
+
+        source_paths = [item['key'] for _, item, _ in copied_entries]
+        try:
+            failed_paths = set(self.s3_facade.delete_objects(user_id, source_paths))
+        except Exception:
+            failed_paths = set(source_paths)
+        moved_entries = [entry for entry in copied_entries if entry[1]['key'] not in failed_paths]
+        self.es_facade.bulk_delete_documents(self.file_hash_index, [doc_id for doc_id, _, _ in moved_entries],
+                                             refresh='wait_for')
+        return len(moved_entries), len(entries) - len(moved_entries)
+
+    def _drop_moved_copies(self, user_id, new_documents, moved_originals):
+        """Undoes a move whose index writes failed: blobs and links go back to the sources, the copies go away."""
+        if moved_originals:
+            self._repoint_moved_originals({new_key: (old_key, document)
+                                           for old_key, (new_key, document) in moved_originals.items()})
+        self.es_facade.bulk_delete_documents(self.file_hash_index, [document['id'] for document in new_documents])
+        self.s3_facade.delete_objects(user_id, [document['body']['object_key'] for document in new_documents])
+
+    def _repoint_moved_originals(self, moved_originals):
+        """Points the blobs and the links of moved originals, given as old key -> (new key, entry), at the new keys."""
+        hashes = {document['hash'] for _, document in moved_originals.values()}
+        blobs = self.es_facade.get_documents(self.blob_index, list(hashes))
+        blob_updates = [{'id': file_hash, 'body': {'original_key': moved_originals[blob['original_key']][0]}}
+                        for file_hash, blob in blobs.items() if blob.get('original_key') in moved_originals]
+        if blob_updates:
+            self.es_facade.bulk_update_documents(self.blob_index, blob_updates)
+            if self.hash_cache is not None:
+                for blob_update in blob_updates:
+                    self.hash_cache.discard(blob_update['id'])
+
+        # The entries just re-indexed must be visible to the search for links.
+        self.es_facade.refresh_index(self.file_hash_index)
+        links = []
+        for hit in helpers.scan(self.es_facade.es_client, index=self.file_hash_index, query={
+            "query": {"terms": {"hash": list(hashes)}},
+            "_source": ["original_key", "hash", "storage_mode", "codec"]
+        }, size=1000):
+            original_key = hit['_source'].get('original_key')
+            if original_key in moved_originals and hit['_id'] != original_key:
+                links.append((hit['_id'], hit['_source'], moved_originals[original_key][0]))
+        if not links:
+            return
+
+        self.es_facade.bulk_update_documents(self.file_hash_index, [
+            {'id': linked_doc_id, 'body': {"original_key": new_original_key}}
+            for linked_doc_id, _, new_original_key in links
+        ], refresh='wait_for')
+
+        def repoint_link(link):
+            linked_doc_id, document, new_original_key = link
+            linked_bucket_name, linked_file_path = linked_doc_id.split('/', 1)
+            linked_user_id = linked_bucket_name.split('-')[1]
+            self.s3_facade.upload_file(linked_user_id, linked_file_path, b'', self._link_metadata(
+                new_original_key, document.get('storage_mode'), document['hash'], document.get('codec')
+            ))
+            return linked_user_id
+
+        with ThreadPoolExecutor(max_workers=self.move_workers) as executor:
+            linked_user_ids = set(executor.map(repoint_link, links))
+        for linked_user_id in linked_user_ids:
+            UserStorageState.bump(linked_user_id)
+
+    def trash_object(self, user_id, file_path):
+        """
+        Moves a file to the user's trash, out of the live namespace: the object and its catalog entry are moved
+        under S3_TRASH_PREFIX, like any other move, so links to it follow and a new file can take the name.
+        Links, new holders and blob references are dealt with by collect_trash once the retention period is
+        over. Folders, and files whose catalog entry is not written yet, are deleted right away.
+        """
+        if not self.trash_enabled:
+            return self.delete_object(user_id, file_path)
+
+        file_path = file_path.strip('/')
+        doc_id = f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"
+        try:
+            document = self.es_facade.get_document(self.file_hash_index, doc_id)
+        except NotFoundError:
+            return self.delete_object(user_id, file_path)
+
+        trash_path = f"{self.s3_facade.trash_prefix}{uuid.uuid4().hex}/{file_path}"
+        object_stat = self.s3_facade.stat_object(user_id, file_path)
+        _, failed_count = self._move_entries(
+            user_id, [(doc_id, {'key': file_path, 'size': object_stat['size']}, document)],
+            lambda key: trash_path,
+            {"trashed_at": int(datetime.now().timestamp() * 1000), "trashed_path": file_path}
+        )
+        if failed_count:
+            raise Exception(f"File {file_path} could not be moved to the trash.")
+
+        UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "object_trashed",
+            "resource": file_path,
+            "message": f"File {file_path} moved to the trash for user {user_id}.",
+            "details": {"doc_id": doc_id, "trash_path": trash_path}
+        })
+        return f"File {file_path} moved to the trash."
+
+    def restore_object(self, user_id, trash_path):
+        doc_id = f"{self.s3_facade.generate_bucket_name(user_id)}/{trash_path}"
+        try:
+            document = self.es_facade.get_document(self.file_hash_index, doc_id)
+        except NotFoundError:
+            raise Exception(f"Trash entry {trash_path} does not exist.")
+        if not trash_path.startswith(self.s3_facade.trash_prefix) or not document.get('trashed_path'):
+            raise Exception(f"Trash entry {trash_path} does not exist.")
+
+        file_path = document['trashed_path']
+        try:
+            self.s3_facade.stat_object(user_id, file_path)
+            destination_exists = True
+        except Exception:
+            destination_exists = False
+        if destination_exists:
+            raise Exception(f"Cannot restore {file_path}: a file with that name already exists.")
+
+        object_stat = self.s3_facade.stat_object(user_id, trash_path)
+        _, failed_count = self._move_entries(
+            user_id, [(doc_id, {'key': trash_path, 'size': object_stat['size']}, document)],
+            lambda key: file_path, {"trashed_at": None, "trashed_path": None}
+        )
+        if failed_count:
+            raise Exception(f"File {file_path} could not be restored.")
+
+        UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "object_restored",
+            "resource": file_path,
+            "message": f"File {file_path} restored from the trash for user {user_id}.",
+            "details": {"doc_id": doc_id}
+        })
+        return f"File {file_path} restored."
+
+    def list_trash(self, user_id, size=100):
+        response = self.es_facade.search(self.file_hash_index, {
+            "query": {"bool": {"filter": [
+                {"term": {"user_id.keyword": user_id}},
+                {"exists": {"field": "trashed_at"}}
+            ]}},
+            "sort": [{"trashed_at": {"order": "desc"}}],
+            "size": size,
+            "_source": ["folder_path", "filename", "size", "trashed_at", "trashed_path"]
+        })
+        return [{
+            'name': hit['_source']['trashed_path'],
+            'trash_path': os.path.join(hit['_source']['folder_path'], hit['_source']['filename']),
+            'size': hit['_source']['size'],
+            'trashed_at': datetime.fromtimestamp(hit['_source']['trashed_at'] / 1000),
+            'purge_at': datetime.fromtimestamp(hit['_source']['trashed_at'] / 1000 + self.trash_retention)
+        } for hit in response['hits']['hits']]
+
+    def collect_trash(self, batch_size=500, max_operations=10_000):
+        """
+        Purges trash entries whose retention period is over, oldest first, in batches of up to 1000.
+
+        Each batch goes through the batched delete path: links are removed with one DeleteObjects call and
+        their blob references released in bulk, then originals release theirs, and an original is only removed
+        from S3 once its reference count reaches zero; content still linked from elsewhere gets a new holder.
+        A pass stops after max_operations objects, and pauses between batches so S3 sees no more than
+        STORAGE_GC_OPERATIONS_PER_SECOND object operations per second.
+        """
+        expired_before = int(datetime.now().timestamp() * 1000) - self.trash_retention * 1000
+        purged_count, failed_doc_ids, operations = 0, [], 0
+
+        while operations < max_operations:
+            response = self.es_facade.search(self.file_hash_index, {
+                "query": {"bool": {
+                    "filter": [{"range": {"trashed_at": {"lt": expired_before}}}],
+                    "must_not": [{"ids": {"values": failed_doc_ids}}]
+                }},
+                "sort": [{"trashed_at": {"order": "asc"}}],
+                "size": min(batch_size, self.delete_batch_size, max_operations - operations)
+            })
+            hits = response['hits']['hits']
+            if not hits:
+                break
+
+            started = time.monotonic()
+            entries_by_user = {}
+            for hit in hits:
+                document = hit['_source']
+                item = {'key': os.path.join(document['folder_path'], document['filename']), 'size': document['size']}
+                entries_by_user.setdefault(document['user_id'], []).append((hit['_id'], item, document))
+
+            for user_id, entries in entries_by_user.items():
+                links, originals = [], []
+                for entry in entries:
+                    (originals if self._is_original(entry[0], entry[1]['key'], entry[2]) else links).append(entry)
+                deleted_doc_ids = self._delete_entries(user_id, links, originals)
+                purged_count += len(deleted_doc_ids)
+                failed_doc_ids.extend(doc_id for doc_id, _, _ in entries if doc_id not in deleted_doc_ids)
+
+            operations += len(hits)
+            # Purged entries must be gone from the next search, and from pages cached under the new generation.
+            self.es_facade.refresh_index(self.file_hash_index)
+            for user_id in entries_by_user:
+                UserStorageState.bump(user_id)
+            pause = len(hits) / self.gc_operations_per_second - (time.monotonic() - started)
+            if pause > 0:
+                time.sleep(pause)
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "trash_collected",
+            "resource": self.file_hash_index,
+            "message": f"Purged {purged_count} trash entries.",
+            "details": {"purged_count": purged_count, "failed_count": len(failed_doc_ids), "operations": operations}
+        })
+        return {"purged_count": purged_count, "failed_count": len(failed_doc_ids)}
+
+    def collect_chunks(self, batch_size=1000):
+        """
+        Removes chunks no manifest has referenced for STORAGE_CHUNK_GC_GRACE seconds, and returns how many.
+
+        Uploads store their chunks before the file is accepted, so a rejected or interrupted upload leaves
+        chunks without references; deleted files leave theirs behind once the last manifest goes. A chunk is
+        first marked with a ref_count of -1, which no upload can acquire, then deleted from S3, then from the
+        index. An upload that finds a marked chunk fails instead of writing a manifest that points at it, and
+        a pass that stopped half-way finishes the chunks it marked on the next run.
+        """
+        unreferenced_before = int(datetime.now().timestamp() * 1000) - self.chunk_gc_grace * 1000
+        response = self.es_facade.search(self.chunk_index, {
+            "query": {"bool": {
+                "should": [
+                    {"term": {"ref_count": -1}},
+                    {"bool": {"filter": [
+                        {"term": {"ref_count": 0}},
+                        {"range": {"unreferenced_since": {"lt": unreferenced_before}}}
+                    ]}}
+                ],
+                "minimum_should_match": 1
+            }},
+            "_source": ["ref_count"],
+            "size": min(batch_size, 1000)
+        })
+        hits = response['hits']['hits']
+        marked = [hit['_id'] for hit in hits if hit['_source'].get('ref_count') == -1]
+        candidates = [hit['_id'] for hit in hits if hit['_source'].get('ref_count') == 0]
+        if candidates:
+            results = self.es_facade.bulk_script_update_documents(self.chunk_index, {
+                chunk_hash: {"source": self.chunk_tombstone_script, "lang": "painless",
+                             "params": {"before": unreferenced_before}}
+                for chunk_hash in candidates
+            })
+            marked.extend(chunk_hash for chunk_hash in candidates if results.get(chunk_hash) == 'updated')
+        if not marked:
+            return 0
+
+        failed_hashes = set(self.s3_facade.delete_chunks(marked))
+        deleted_hashes = [chunk_hash for chunk_hash in marked if chunk_hash not in failed_hashes]
+        self.es_facade.bulk_delete_documents(self.chunk_index, deleted_hashes)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "chunks_collected",
+            "resource": self.chunk_index,
+            "message": f"Collected {len(deleted_hashes)} unreferenced chunks.",
+            "details": {"collected_count": len(deleted_hashes), "failed_count": len(failed_hashes)}
+        })
+        return len(deleted_hashes)
+
+    def delete_object(self, user_id, file_path):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "delete_object",
+            "resource": file_path,
+            "message": "Deleting object from S3",
+            "details": {}
+        })
+
+        try:
+            # Only a path without an object of its own is a folder; any other error is reported as is.
+            if not self.s3_facade.object_exists(user_id, file_path):
+                return self.delete_folder(user_id, file_path)
+            object_stat = self.s3_facade.stat_object(user_id, file_path)
+            metadata = object_stat['metadata']
+            doc_id = f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"
+
+            if 'original-key' in metadata:
+                self._finalize_queued([doc_id])
+                content_hash = metadata.get('content-hash') or self.es_facade.get_document(self.file_hash_index,
+                                                                                           doc_id)['hash']
+                self.s3_facade.delete_object(user_id, file_path)
+                self._release_blob(content_hash)
+                self._delete_entry(user_id, doc_id)
+                audit_logger.info({
+                    "timestamp": int(datetime.now().timestamp() * 1000),
+                    "user": user_id,
+                    "action": "link_deleted",
+                    "resource": file_path,
+                    "message": f"Link {file_path} deleted successfully for user {user_id}.",
                     "details": {}
                 })
-                return f"Folder {file_path} and its contents deleted successfully."
-            except (ClientError, BotoCoreError) as inner_e:
-                error_logger.error({
+                return f"Link {file_path} deleted successfully."
+            else:
+                storage_mode = 'chunked' if 'chunk-manifest' in metadata else None
+                content_size = int(metadata.get('logical-size', object_stat['size']))
+                stored_size = content_size if storage_mode else object_stat['size']
+                content_hash = self._stored_content_hash(user_id, file_path, doc_id, metadata)
+                # Queued entries of this file, and of links to its content, must be indexed to be found below.
+                self._finalize_queued([doc_id, content_hash])
+                release_result, _ = self._release_blob(content_hash)
+
+                # Only content that is still referenced, or that predates the blob registry, needs a new holder.
+                linked_doc_ids = []
+                if release_result != 'deleted':
+                    linked_doc_ids = self._find_links(content_hash, doc_id)
+                    if linked_doc_ids:
+                        self._promote_link(user_id, file_path, object_stat, content_hash, linked_doc_ids,
+                                           update_blob=release_result == 'updated')
+                    elif release_result == 'updated':
+                        self._acquire_blob(content_hash)
+                        raise Exception(
+                            f"No valid new content holder found for {file_path}. Cannot delete main object.")
+
+                # A promoted manifest keeps its chunk references at the new holder.
+                chunk_counts = self._manifest_chunk_counts(user_id, file_path) \
+                    if storage_mode and not linked_doc_ids else None
+                self.s3_facade.delete_object(user_id, file_path)
+                self._delete_entry(user_id, doc_id, -content_size, -stored_size)
+                self._release_chunks(chunk_counts)
+                audit_logger.info({
                     "timestamp": int(datetime.now().timestamp() * 1000),
-                    "level": "ERROR",
-                    "message": f"Error deleting folder or its contents {file_path} for user {user_id}: {str(inner_e)}",
-                    "exception": str(inner_e),
-                    "stack_trace": None,
-                    "context": {"user_id": user_id, "file_path": file_path}
+                    "user": user_id,
+                    "action": "original_file_deleted",
+                    "resource": file_path,
+                    "message": f"Original file {file_path} deleted successfully for user {user_id}.",
+                    "details": {}
                 })
-                raise Exception(f"Error deleting folder or its contents {file_path} for user {user_id}: {str(inner_e)}")
+                return f"Original file {file_path} deleted successfully."
+        except (ClientError, BotoCoreError) as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error deleting object {file_path} for user {user_id}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            raise Exception(f"Error deleting object {file_path} for user {user_id}: {str(e)}")
+
+    def _delete_entry(self, user_id, doc_id, size_change=0, stored_size_change=0):
+        """Deletes a catalog entry and takes it off the usage; an entry that was never indexed was never counted."""
+        try:
+            self.es_facade.delete_document(self.file_hash_index, doc_id, refresh='wait_for')
+        except NotFoundError:
+            return
+        self._update_user_usage(user_id, size_change, decrement_file_count=True,
+                                stored_size_change=stored_size_change)
+
+    def delete_folder(self, user_id, folder_path):
+        for progress in self.iter_delete_folder(user_id, folder_path):
+            pass
+        if progress["failed_count"]:
+            raise Exception(f"{progress['failed_count']} objects in folder {folder_path} could not be deleted.")
+        return f"Folder {folder_path} and its contents deleted successfully."
+
+    def iter_delete_folder(self, user_id, folder_path, progress=None):
+        """
+        Deletes everything under a folder in batches and yields the progress after every listing page.
+
+        The prefix is walked twice. The first walk removes links as they are met: DeleteObjects for up to 1000
+        keys, one bulk delete in the index and one bulk release of their blob references. The second walk
+        handles the originals, once every link inside the folder is gone, so only content still linked from
+        outside needs a new holder; links left over from the first walk are retried, and objects that are not
+        indexed yet take the per-object path. Folder markers go last, and only when nothing failed.
+
+        The progress holds the phase and the last key handled, so passing a saved progress back resumes the
+        walk right after that key. Usage is adjusted once per page, which a resumed walk never repeats since
+        deleted keys are not listed again.
+        """
+        progress = progress or {"phase": "links", "cursor": None, "processed_count": 0, "deleted_count": 0,
+                                "failed_count": 0}
+        prefix = os.path.join(folder_path.strip('/'), '')
+
+        if progress["phase"] == "links":
+            for page in self.s3_facade.iter_prefix_pages(user_id, prefix, page_size=self.delete_batch_size,
+                                                         start_after=progress["cursor"]):
+                if not page:
+                    continue
+                progress["deleted_count"] += self._delete_links_page(user_id, page)
+                progress["processed_count"] += len(page)
+                progress["cursor"] = page[-1]['key']
+                yield progress
+            # Link deletions above must be visible before searching for the links that remain.
+            self.es_facade.refresh_index(self.file_hash_index)
+            progress.update(phase="originals", cursor=None)
+            yield progress
+
+        if progress["phase"] == "originals":
+            for page in self.s3_facade.iter_prefix_pages(user_id, prefix, page_size=self.delete_batch_size,
+                                                         start_after=progress["cursor"]):
+                if not page:
+                    continue
+                deleted_count, failed_count = self._delete_originals_page(user_id, page)
+                progress["deleted_count"] += deleted_count
+                progress["failed_count"] += failed_count
+                progress["cursor"] = page[-1]['key']
+                yield progress
+            progress.update(phase="markers", cursor=None)
+            yield progress
+
+        if progress["phase"] == "markers":
+            if not progress["failed_count"]:
+                for page in self.s3_facade.iter_prefix_pages(user_id, prefix, page_size=self.delete_batch_size,
+                                                             start_after=progress["cursor"]):
+                    folder_markers = [item['key'] for item in page if item['key'].endswith('/')]
+                    self.s3_facade.delete_objects(user_id, folder_markers)
+                    if page:
+                        progress["cursor"] = page[-1]['key']
+                        yield progress
+            UserStorageState.bump(user_id)
+            progress.update(phase="done", cursor=None)
+
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "folder_deleted",
+                "resource": folder_path,
+                "message": f"Folder {folder_path} and its contents deleted for user {user_id}.",
+                "details": {"processed_count": progress["processed_count"],
+                            "deleted_count": progress["deleted_count"], "failed_count": progress["failed_count"]}
+            })
+            yield progress
+
+    def _classify_page(self, user_id, page):
+        """Splits a listing page into indexed links, indexed originals and the paths of unindexed objects."""
+        bucket_name = self.s3_facade.generate_bucket_name(user_id)
+        objects = {f"{bucket_name}/{item['key']}": item for item in page if not item['key'].endswith('/')}
+        documents = self.es_facade.get_documents(self.file_hash_index, list(objects)) if objects else {}
+
+        links, originals, unindexed_paths = [], [], []
+        for doc_id, item in objects.items():
+            document = documents.get(doc_id)
+            if document is None:
+                unindexed_paths.append(item['key'])
+            elif self._is_original(doc_id, item['key'], document):
+                originals.append((doc_id, item, document))
+            else:
+                links.append((doc_id, item, document))
+        return links, originals, unindexed_paths
+
+    @staticmethod
+    def _is_original(doc_id, file_path, document):
+        return document.get('original_key') in (doc_id, file_path)
+
+    def _delete_links_page(self, user_id, page):
+        links, _, _ = self._classify_page(user_id, page)
+        return len(self._delete_entries(user_id, links, []))
+
+    def _delete_originals_page(self, user_id, page):
+        links, originals, unindexed_paths = self._classify_page(user_id, page)
+        deleted_doc_ids = self._delete_entries(user_id, links, originals)
+        deleted_count = len(deleted_doc_ids)
+        failed_count = len(links) + len(originals) - deleted_count
+
+        for file_path in unindexed_paths:
+            try:
+                self.delete_object(user_id, file_path)
+                deleted_count += 1
+            except Exception:
+                failed_count += 1
+        return deleted_count, failed_count
+
+    def _delete_entries(self, user_id, links, originals):
+        """
+        Deletes indexed links, then indexed originals, of one user with bulk requests and a single usage update.
+        Returns the IDs of the deleted entries.
+        """
+        # Deletes wait for a refresh, so the links deleted here are never picked as new holders below.
+        deleted_links = self._delete_indexed_batch(user_id, links, release_blobs=True)
+
+        deletable, promoted_doc_ids = self._release_originals(user_id, originals)
+        # Manifests going away for good give up their chunks; promoted ones keep them at the new holder.
+        chunk_counts = {doc_id: self._manifest_chunk_counts(user_id, item['key']) for doc_id, item, document
+                        in deletable if document.get('storage_mode') == 'chunked' and doc_id not in promoted_doc_ids}
+        deleted_originals = self._delete_indexed_batch(user_id, deletable)
+        self._release_chunks(sum((chunk_counts[doc_id] for doc_id, _, _ in deleted_originals
+                                  if doc_id in chunk_counts), Counter()))
+
+        file_count_change = -len(deleted_links) - len(deleted_originals)
+        if file_count_change:
+            self._update_user_usage(
+                user_id, -sum(document.get('size', item['size']) for _, item, document in deleted_originals),
+                file_count_change=file_count_change,
+                stored_size_change=-sum(document.get('stored_size', item['size'])
+                                        for _, item, document in deleted_originals)
+            )
+        return {doc_id for doc_id, _, _ in deleted_links + deleted_originals}
+
+    def _delete_indexed_batch(self, user_id, entries, release_blobs=False):
+        """
+        Deletes a batch of indexed objects from S3, then the catalog entries of those that are gone. With
+        release_blobs, the blob references of the deleted entries are released in the same bulk request, so a
+        worker lost after the S3 delete leaves entries that reconciliation removes and releases, never entries
+        gone with their references still held.
+        """
+        if not entries:
+            return []
+        failed_paths = set(self.s3_facade.delete_objects(user_id, [item['key'] for _, item, _ in entries]))
+        deleted_entries = [entry for entry in entries if entry[1]['key'] not in failed_paths]
+        if release_blobs:
+            self._delete_and_release(self.file_hash_index, [doc_id for doc_id, _, _ in deleted_entries],
+                                     Counter(document['hash'] for _, _, document in deleted_entries))
+        else:
+            self.es_facade.bulk_delete_documents(self.file_hash_index,
+                                                 [doc_id for doc_id, _, _ in deleted_entries], refresh='wait_for')
+        return deleted_entries
+
+    def _delete_and_release(self, index_name, doc_ids, hash_counts):
+        """Deletes catalog entries and releases their blob references with one bulk request."""
+        if not doc_ids:
+            return {}
+        results = self.es_facade.bulk_script_update_and_delete_documents(
+            self.blob_index, self._blob_release_scripts(hash_counts), index_name, doc_ids,
+            retry_on_conflict=5, refresh='wait_for'
+        )
+        self._forget_released_blobs(results)
+        return results
+
+    def _acquire_chunks(self, chunk_counts):
+        """Takes references to the chunks of a manifest; fails, holding none of them, if any chunk is gone."""
+        results = self.es_facade.bulk_script_update_documents(self.chunk_index, {
+            chunk_hash: {"source": self.chunk_acquire_script, "lang": "painless", "params": {"count": count}}
+            for chunk_hash, count in chunk_counts.items()
+        }, retry_on_conflict=5)
+        missing = [chunk_hash for chunk_hash in chunk_counts if results.get(chunk_hash) != 'updated']
+        if missing:
+            self._release_chunks(Counter({chunk_hash: count for chunk_hash, count in chunk_counts.items()
+                                          if results.get(chunk_hash) == 'updated'}))
+            raise Exception(f"{len(missing)} chunks were collected while the upload was in progress; "
+                            f"upload the file again.")
+
+    def _release_chunks(self, chunk_counts):
+        if not chunk_counts:
+            return
+        now = int(datetime.now().timestamp() * 1000)
+        self.es_facade.bulk_script_update_documents(self.chunk_index, {
+            chunk_hash: {"source": self.chunk_release_script, "lang": "painless",
+                         "params": {"count": count, "now": now}}
+            for chunk_hash, count in chunk_counts.items()
+        }, retry_on_conflict=5)
+
+    def _manifest_chunk_counts(self, user_id, file_path):
+        """Counts the chunk references of a manifest; an unreadable manifest leaves its chunks pinned."""
+        try:
+            body, _ = self.s3_facade.get_object(user_id, file_path)
+            return Counter(chunk_ref['hash'] for chunk_ref in json.loads(body)['chunks'])
+        except Exception as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error reading the chunk manifest {file_path} for user {user_id}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path}
+            })
+            return Counter()
+
+    def _release_blobs(self, hash_counts):
+        if not hash_counts:
+            return {}
+        results = self.es_facade.bulk_script_update_documents(self.blob_index, self._blob_release_scripts(hash_counts),
+                                                              retry_on_conflict=5)
+        self._forget_released_blobs(results)
+        return results
+
+    def _blob_release_scripts(self, hash_counts):
+        return {
+            file_hash: {"source": self.blob_release_script, "lang": "painless", "params": {"count": count}}
+            for file_hash, count in hash_counts.items()
+        }
+
+    def _forget_released_blobs(self, results):
+        if self.hash_cache is not None:
+            for file_hash, result in results.items():
+                if result == 'deleted':
+                    self.hash_cache.discard(file_hash)
+
+    def _release_originals(self, user_id, batch):
+        """
+        Releases the blobs of a batch of originals and promotes a link of each one still referenced from outside
+        the folder. Returns the originals that may be deleted, and the IDs of those whose content was promoted.
+        """
+        release_results = self._release_blobs(Counter(document['hash'] for _, _, document in batch))
+        links_by_original = {}
+        if any(result != 'deleted' for result in release_results.values()):
+            for hit in helpers.scan(self.es_facade.es_client, index=self.file_hash_index, query={
+                "query": {"terms": {"hash": [document['hash'] for _, _, document in batch]}},
+                "_source": ["original_key"]
+            }, size=1000):
+                original_key = hit['_source'].get('original_key')
+                if hit['_id'] != original_key:
+                    links_by_original.setdefault(original_key, []).append(hit['_id'])
+
+        deletable = []
+        promoted_doc_ids = set()
+        for doc_id, item, document in batch:
+            release_result = release_results.get(document['hash'], 'error')
+            linked_doc_ids = links_by_original.get(doc_id, [])
+            if release_result == 'error':
+                continue
+            if linked_doc_ids:
+                try:
+                    self._promote_link(user_id, item['key'], self.s3_facade.stat_object(user_id, item['key']),
+                                       document['hash'], linked_doc_ids, update_blob=release_result == 'updated')
+                except Exception as e:
+                    if release_result == 'updated':
+                        self._acquire_blob(document['hash'])
+                    error_logger.error({
+                        "timestamp": int(datetime.now().timestamp() * 1000),
+                        "level": "ERROR",
+                        "message": f"Error promoting a link of {item['key']} for user {user_id}: {str(e)}",
+                        "exception": str(e),
+                        "stack_trace": None,
+                        "context": {"user_id": user_id, "file_path": item['key'], "hash": document['hash']}
+                    })
+                    continue
+            elif release_result == 'updated':
+                # Still referenced, but the referencing entries are not indexed yet; keep the content.
+                self._acquire_blob(document['hash'])
+                continue
+            deletable.append((doc_id, item, document))
+            if linked_doc_ids:
+                promoted_doc_ids.add(doc_id)
+        return deletable, promoted_doc_ids
+
+    def process_finalization_tasks(self, batch_size=500):
+        tasks = self.task_queue.claim_batch('finalize_object', batch_size)
+        if not tasks:
+            return 0
+        return self._finalize_tasks(tasks)
+
+    def _finalize_queued(self, keys):
+        """
+        Finalizes the queued tasks of the given entries or contents right away, then waits for the ones another
+        worker is running, so a delete sees every entry and no task writes one after the delete removed it.
+        """
+        if not self.async_finalization:
+            return 0
+        tasks = self.task_queue.claim_batch('finalize_object', 1000, keys=keys)
+        if tasks:
+            self._finalize_tasks(tasks)
+        if not self.task_queue.wait_for_claimed('finalize_object', keys):
+            raise Exception("The object is still being finalized by another worker; try again later.")
+        if tasks:
+            self.es_facade.refresh_index(self.file_hash_index)
+        return len(tasks)
+
+    def _finalize_tasks(self, tasks):
+        def object_exists(task):
+            payload = task[1]['payload']
+            return self.s3_facade.object_exists(payload['user_id'], payload['document']['object_key'])
+
+        # An object deleted before its task ran must not be indexed or counted again; the delete released its
+        # blob reference already.
+        with ThreadPoolExecutor(max_workers=self.batch_upload_workers) as executor:
+            exists = list(executor.map(object_exists, tasks))
+        skipped_doc_ids = [task['payload']['doc_id'] for (_, task), found in zip(tasks, exists) if not found]
+
+        hash_documents = {}
+        usage_changes = {}
+        for (_, task), found in zip(tasks, exists):
+            if not found:
+                continue
+            payload = task['payload']
+            hash_documents[payload['doc_id']] = {'id': payload['doc_id'], 'body': payload['document']}
+            usage_change = usage_changes.setdefault((payload['user_id'], task['batch_id']),
+                                                    {"size_change": 0, "stored_size_change": 0,
+                                                     "file_count_change": 0})
+            usage_change["size_change"] += payload['size_change']
+            usage_change["stored_size_change"] += payload.get('stored_size_change', payload['size_change'])
+            usage_change["file_count_change"] += payload['file_count_change']
+
+        # Re-indexing by id is idempotent; usage increments are guarded by the batch id of the claim.
+        if hash_documents:
+            self.es_facade.bulk_index_documents(self.file_hash_index, list(hash_documents.values()),
+                                                refresh='wait_for')
+        self.es_facade.bulk_update_documents(self.user_usage_index, [
+            {
+                'id': user_id,
+                'script': {
+                    "source": self.usage_batch_script,
+                    "lang": "painless",
+                    "params": {**usage_change, "batch_id": batch_id, "history": self.usage_batch_history}
+                },
+                'retry_on_conflict': 3
+            } for (user_id, batch_id), usage_change in usage_changes.items()
+        ])
+        for user_id in {user for user, _ in usage_changes}:
+            UserStorageState.bump(user_id)
+        self.task_queue.complete([task_id for task_id, _ in tasks])
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "finalization_tasks_processed",
+            "resource": self.file_hash_index,
+            "message": f"Processed {len(tasks)} finalization tasks.",
+            "details": {"tasks_count": len(tasks), "users_count": len({user for user, _ in usage_changes}),
+                        "skipped_doc_ids": skipped_doc_ids}
+        })
+        return len(tasks)
+
+    def process_derivative_tasks(self, batch_size=20):
+        tasks = self.task_queue.claim_batch('generate_derivatives', batch_size)
+        for _, task in tasks:
+            payload = task['payload']
+            self._generate_derivatives(payload['user_id'], payload['file_path'], payload['hash'])
+        self.task_queue.complete([task_id for task_id, _ in tasks])
+        return len(tasks)
+
+    def thumbnail_url(self, file_path, variant='thumbnail'):
+        if not self.derivatives_enabled or source_kind(file_path) is None:
+            return None
+        folder_path, filename = os.path.split(file_path)
+        query_string = urlencode({'current_folder': folder_path, 'file': filename, 'variant': variant})
+        return f"{reverse('file_thumbnail')}?{query_string}"
+
+    def derivative_link(self, user_id, file_path, variant):
+        metadata = self.s3_facade.stat_object(user_id, file_path)['metadata']
+        file_hash = metadata.get('content-hash')
+        if file_hash is None:
+            doc_id = f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"
+            file_hash = self.es_facade.get_document(self.file_hash_index, doc_id)['hash']
+
+        derivative = self.es_facade.get_documents(self.derivative_index, [file_hash]).get(file_hash)
+        if derivative is None or self._derivative_retry_due(derivative):
+            # Files stored before derivatives were enabled get them on first view, failed ones once their wait ends.
+            self._request_derivatives(user_id, file_path, file_hash)
+            return None
+        if derivative['status'] != 'ready' or variant not in derivative['variants']:
+            return None
+        return self.s3_facade.generate_derivative_link(derivative['variants'][variant]['key'])
+
+    def _request_derivatives(self, user_id, file_path, file_hash):
+        if not self.derivatives_enabled:
+            return
+        kind = source_kind(file_path)
+        if kind is None:
+            return
+
+        # Derivatives are keyed by content, so only the first copy of a hash queues their generation, and later
+        # copies only take over a claim that failed or was abandoned.
+        now = int(datetime.now().timestamp() * 1000)
+        source_key = f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"
+        claimed = self.es_facade.create_document(self.derivative_index, file_hash, {
+            "hash": file_hash,
+            "status": "pending",
+            "kind": kind,
+            "source_key": source_key,
+            "variants": {},
+            "attempts": 1,
+            "retry_after": now + self.derivative_retry_backoff * 1000,
+            "creation_date": now,
+            "last_activity_date": now
+        })
+        if not claimed:
+            result, _ = self.es_facade.script_update_document(self.derivative_index, file_hash, {
+                "source": self.derivative_reclaim_script,
+                "lang": "painless",
+                "params": {"now": now, "backoff": self.derivative_retry_backoff * 1000, "kind": kind,
+                           "source_key": source_key}
+            }, source=False)
+            claimed = result == 'updated'
+        if claimed:
+            self.task_queue.enqueue('generate_derivatives', {
+                "user_id": user_id,
+                "file_path": file_path,
+                "hash": file_hash
+            }, user_id=user_id)
+
+    @staticmethod
+    def _derivative_retry_due(derivative):
+        return derivative['status'] in ('failed', 'pending') and \
+            derivative.get('retry_after', 0) < int(datetime.now().timestamp() * 1000)
+
+    def _generate_derivatives(self, user_id, file_path, file_hash):
+        try:
+            object_info = self.stat_download(user_id, file_path)
+        except Exception as e:
+            # The copy was removed before its turn came; the next copy or view of this content queues it again.
+            self.es_facade.delete_document(self.derivative_index, file_hash)
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "derivatives_source_missing",
+                "resource": file_path,
+                "message": f"Source {file_path} of derivatives for {file_hash} is gone: {str(e)}",
+                "details": {"hash": file_hash}
+            })
+            return
+
+        update_fields = {"last_activity_date": int(datetime.now().timestamp() * 1000)}
+        try:
+            if object_info['size'] > self.derivative_max_source_size:
+                update_fields.update({"status": "skipped", "error": "Source is too large."})
+            else:
+                content = b''.join(self.open_object_stream(object_info))
+                variants = {}
+                for variant, (data, width, height) in render_derivatives(content, source_kind(file_path),
+                                                                         self.derivative_quality).items():
+                    derivative_key = generate_derivative_key(self.s3_facade.derivative_prefix, file_hash, variant)
+                    self.s3_facade.upload_derivative(derivative_key, data, DERIVATIVE_CONTENT_TYPE)
+                    variants[variant] = {"key": derivative_key, "width": width, "height": height,
+                                         "size": len(data)}
+                update_fields.update({"status": "ready", "variants": variants})
+            audit_logger.info({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "user": user_id,
+                "action": "derivatives_generated",
+                "resource": file_path,
+                "message": f"Derivatives for {file_path} finished with status {update_fields['status']}.",
+                "details": {"hash": file_hash, "variants": update_fields.get("variants", {})}
+            })
+        except Exception as e:
+            update_fields.update({"status": "failed", "error": str(e)})
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error generating derivatives for {file_path}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": user_id, "file_path": file_path, "hash": file_hash}
+            })
+        self.es_facade.update_document(self.derivative_index, file_hash, update_fields)
+
+    @staticmethod
+    def storage_state(user_id):
+        return UserStorageState.current(user_id)
 
     def search_object(self, user_id, search_term):
         search_result = self.es_facade.search_documents(self.file_hash_index, user_id, search_term)
@@ -342,23 +1971,336 @@ class StorageFacade:
             search_object = search_object["_source"]
             original_key = search_object["original_key"]
 
-            bucket_name, file_path = original_key.split("/", 1)
-            raw_user_id = bucket_name.split("-")[1]
+            if search_object.get("storage_mode") == "chunked":
+                # Chunked content is streamed by the app, which resolves the user's own path.
+                raw_user_id = user_id
+                file_path = os.path.join(search_object["folder_path"], search_object["filename"])
+            else:
+                bucket_name, file_path = original_key.split("/", 1)
+                raw_user_id = bucket_name.split("-")[1]
 
             object_info = self.read_object(raw_user_id, file_path)
+            if isinstance(object_info, dict):
+                object_info['thumbnail_url'] = self.thumbnail_url(
+                    os.path.join(search_object["folder_path"], search_object["filename"])
+                )
             searching_list.append(object_info)
         return searching_list
 
-    def _index_file_hash(self, file_path, file_hash, user_id, file_size, original_key=None):
+    def _stored_content_hash(self, user_id, file_path, doc_id, metadata):
+        if 'content-hash' in metadata:
+            return metadata['content-hash']
+        try:
+            return self.es_facade.get_document(self.file_hash_index, doc_id)['hash']
+        except NotFoundError:
+            # Not indexed yet, e.g. a multipart upload whose finalization is still queued.
+            body, _ = self.s3_facade.get_object_stream(user_id, file_path)
+            hasher = hashlib.sha256()
+            for block in body.iter_chunks(chunk_size=self.download_chunk_size):
+                hasher.update(block)
+            return hasher.hexdigest()
+
+    def _find_links(self, content_hash, original_key):
+        """Returns the ids of the catalog entries that link to the original at original_key."""
+        return [
+            hit['_id'] for hit in helpers.scan(self.es_facade.es_client, index=self.file_hash_index, query={
+                "query": {"term": {"hash": content_hash}},
+                "_source": ["original_key"]
+            }, size=1000)
+            if hit['_id'] != original_key and hit['_source'].get('original_key') == original_key
+        ]
+
+    def _promote_link(self, user_id, file_path, object_stat, content_hash, linked_doc_ids, update_blob):
+        """
+        Turns the first link of an original that is being deleted into the new original.
+
+        The content is copied inside S3 and the remaining links are re-pointed with one bulk request to the
+        index and parallel metadata-only writes to S3, so no byte of the content passes through this process.
+        """
+        metadata = {**object_stat['metadata'], 'content-hash': content_hash}
+        storage_mode = 'chunked' if 'chunk-manifest' in metadata else None
+        content_size = int(metadata.get('logical-size', object_stat['size']))
+        stored_size = content_size if storage_mode else object_stat['size']
+
+        new_holder = linked_doc_ids[0]
+        new_holder_bucket_name, new_holder_file_path = new_holder.split('/', 1)
+        new_holder_user_id = new_holder_bucket_name.split('-')[1]
+        self.s3_facade.copy_object(user_id, file_path, new_holder_user_id, new_holder_file_path, metadata,
+                                   size=object_stat['size'])
+        if update_blob:
+            self.es_facade.update_document(self.blob_index, content_hash, {'original_key': new_holder})
+            if self.hash_cache is not None:
+                self.hash_cache.discard(content_hash)
+
+        holder_fields = {"original_key": new_holder, "size": content_size, "stored_size": stored_size}
+        if storage_mode:
+            holder_fields["storage_mode"] = storage_mode
+        if metadata.get('codec'):
+            holder_fields["codec"] = metadata['codec']
+        self.es_facade.bulk_update_documents(self.file_hash_index, [{'id': new_holder, 'body': holder_fields}] + [
+            {'id': linked_doc_id, 'body': {"original_key": new_holder}} for linked_doc_id in linked_doc_ids[1:]
+        ], refresh='wait_for')
+        # The new holder now accounts for the content that its link did not.
+        self._update_user_usage(new_holder_user_id, content_size, file_count_change=0,
+                                stored_size_change=stored_size)
+
+        link_metadata = self._link_metadata(new_holder, storage_mode, content_hash, metadata.get('codec'))
+
+        def repoint_link(linked_doc_id):
+            linked_bucket_name, linked_file_path = linked_doc_id.split('/', 1)
+            linked_user_id = linked_bucket_name.split('-')[1]
+            self.s3_facade.upload_file(linked_user_id, linked_file_path, b'', link_metadata)
+            return linked_user_id
+
+        with ThreadPoolExecutor(max_workers=self.batch_upload_workers) as executor:
+            linked_user_ids = set(executor.map(repoint_link, linked_doc_ids[1:]))
+        for linked_user_id in linked_user_ids:
+            UserStorageState.bump(linked_user_id)
+
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
             "user": user_id,
-            "action": "index_file_hash",
+            "action": "original_promoted",
             "resource": file_path,
-            "message": "Indexing file hash in Elasticsearch",
-            "details": {"file_hash": file_hash}
+            "message": f"Content of {file_path} copied to {new_holder} and {len(linked_doc_ids) - 1} links re-pointed.",
+            "details": {"hash": content_hash, "new_original_key": new_holder, "links_count": len(linked_doc_ids) - 1}
+        })
+
+    def _acquire_original(self, file_hash, file_size=None):
+        if self.hash_cache is not None:
+            if not self.hash_cache.might_contain(file_hash):
+                return None
+            cached_blob = self.hash_cache.get(file_hash)
+            if cached_blob is not None:
+                if file_size is not None and cached_blob['size'] != file_size:
+                    return None
+                result, _ = self._acquire_blob(file_hash, original_key=cached_blob['original_key'])
+                if result == 'updated':
+                    return cached_blob
+                # Released or moved by another worker since it was cached; a moved blob is read again.
+                self.hash_cache.discard(file_hash)
+                if result == 'not_found':
+                    return None
+
+        result, blob = self._acquire_blob(file_hash, file_size)
+        if self.hash_cache is not None:
+            if result == 'updated':
+                self.hash_cache.remember(file_hash, blob)
+            elif result == 'not_found':
+                self.hash_cache.record_false_positive()
+        return blob if result == 'updated' else None
+
+    def _acquire_originals(self, hash_counts):
+        """
+        Takes the given number of references to each content in one bulk request and returns the blobs of
+        the contents already stored, keyed by hash. Hashes the Bloom filter rules out are not sent at all.
+        """
+        if self.hash_cache is not None:
+            hash_counts = {file_hash: count for file_hash, count in hash_counts.items()
+                           if self.hash_cache.might_contain(file_hash)}
+        if not hash_counts:
+            return {}
+
+        results = self.es_facade.bulk_script_update_documents(self.blob_index, {
+            file_hash: {"source": self.blob_acquire_script, "lang": "painless", "params": {"count": count}}
+            for file_hash, count in hash_counts.items()
+        }, retry_on_conflict=5, source=True)
+        blobs = {}
+        for file_hash, (result, blob) in results.items():
+            if result == 'updated':
+                blobs[file_hash] = blob
+                if self.hash_cache is not None:
+                    self.hash_cache.remember(file_hash, blob)
+            elif result == 'not_found' and self.hash_cache is not None:
+                self.hash_cache.record_false_positive()
+        return blobs
+
+    def _acquire_blob(self, file_hash, file_size=None, original_key=None):
+        # Against a known original key the source is not read back; the caller already has it.
+        return self.es_facade.script_update_document(self.blob_index, file_hash, {
+            "source": self.blob_acquire_script,
+            "lang": "painless",
+            "params": {"size": file_size, "original_key": original_key}
+        }, retry_on_conflict=5, source=original_key is None)
+
+    def _release_blob(self, file_hash):
+        result = self.es_facade.script_update_document(self.blob_index, file_hash, {
+            "source": self.blob_release_script,
+            "lang": "painless",
+            "params": {}
+        }, retry_on_conflict=5)
+        if result[0] == 'deleted' and self.hash_cache is not None:
+            self.hash_cache.discard(file_hash)
+        return result
+
+    def _register_blob(self, file_hash, original_key, file_size, storage_mode=None, codec=None):
+        blob = {
+            "hash": file_hash,
+            "original_key": original_key,
+            "size": file_size,
+            "ref_count": 1,
+            "creation_date": int(datetime.now().timestamp() * 1000)
+        }
+        if storage_mode:
+            blob["storage_mode"] = storage_mode
+        if codec:
+            blob["codec"] = codec
+
+        # A lost create means a concurrent upload registered the same content first; take a reference to
+        # its copy instead. The loop only repeats if that blob was released again in between.
+        for _ in range(self.blob_register_attempts):
+            if self.es_facade.create_document(self.blob_index, file_hash, blob):
+                if self.hash_cache is not None:
+                    self.hash_cache.remember(file_hash, blob)
+                return None
+
+            result, original_doc = self._acquire_blob(file_hash)
+            if result == 'updated':
+                return original_doc
+        raise Exception(f"Could not register blob {file_hash} after {self.blob_register_attempts} attempts.")
+
+    @staticmethod
+    def _link_metadata(original_file_key, storage_mode=None, file_hash=None, codec=None):
+        metadata = {'original-key': original_file_key}
+        if file_hash:
+            metadata['content-hash'] = file_hash
+        if codec:
+            metadata['codec'] = codec
+        if storage_mode == 'chunked':
+            metadata['chunk-manifest'] = CHUNK_MANIFEST_VERSION
+        return metadata
+
+    def _link_object(self, user_id, file_path, file_hash, original_doc, read_your_writes=False):
+        # The caller already holds the blob reference this link accounts for.
+        original_file_key = original_doc['original_key']
+        storage_mode = original_doc.get('storage_mode')
+        self.s3_facade.upload_file(user_id, file_path, b'',
+                                   self._link_metadata(original_file_key, storage_mode, file_hash,
+                                                       original_doc.get('codec')))
+
+        self._record_file(user_id, file_path, file_hash, 0, original_file_key, storage_mode=storage_mode,
+                          read_your_writes=read_your_writes)
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "file_linked",
+            "resource": file_path,
+            "message": f"File {file_path} linked to existing object with key {original_file_key}.",
+            "details": {"original_key": original_file_key}
+        })
+        return f"File {file_path} linked to existing object with key {original_file_key}."
+
+    def _store_chunk_manifest(self, user_id, file_path, file_hash, file_size, chunk_refs, stored_size,
+                              read_your_writes=False):
+        manifest = {
+            "version": CHUNK_MANIFEST_VERSION,
+            "hash": file_hash,
+            "size": file_size,
+            "chunks": chunk_refs
+        }
+        metadata = {
+            'chunk-manifest': CHUNK_MANIFEST_VERSION,
+            'content-hash': file_hash,
+            'logical-size': str(file_size)
+        }
+        # The references are taken before the manifest exists, so no manifest ever points at a collectable chunk.
+        chunk_counts = Counter(chunk_ref['hash'] for chunk_ref in chunk_refs)
+        self._acquire_chunks(chunk_counts)
+        try:
+            self.s3_facade.upload_file(user_id, file_path, json.dumps(manifest).encode(), metadata)
+        except Exception:
+            self._release_chunks(chunk_counts)
+            raise
+
+        link_result = self._store_original(user_id, file_path, file_hash, file_size, storage_mode='chunked',
+                                           read_your_writes=read_your_writes)
+        if link_result:
+            # The manifest was replaced by a link to content registered concurrently.
+            self._release_chunks(chunk_counts)
+            return link_result
+
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "file_uploaded",
+            "resource": file_path,
+            "message": f"File {file_path} uploaded successfully as {len(chunk_refs)} chunks.",
+            "details": {"file_size": file_size, "stored_size": stored_size, "chunks_count": len(chunk_refs)}
+        })
+        return f"File {file_path} uploaded successfully."
+
+    def _store_original(self, user_id, file_path, file_hash, file_size, storage_mode=None, codec=None,
+                        stored_size=None, read_your_writes=False):
+        full_original_key = os.path.join(self.s3_facade.generate_bucket_name(user_id), file_path)
+        original_doc = self._register_blob(file_hash, full_original_key, file_size, storage_mode, codec)
+
+        if original_doc:
+            # Another upload of the same content won the registration, so the copy just written becomes a link.
+            return self._link_object(user_id, file_path, file_hash, original_doc, read_your_writes)
+
+        self._record_file(user_id, file_path, file_hash, file_size, full_original_key, storage_mode=storage_mode,
+                          codec=codec, stored_size=stored_size, read_your_writes=read_your_writes)
+        return None
+
+    def _prepare_content(self, file_path, file_content, file_hash):
+        """
+        Returns the body to store for content held in memory, compressed when that is enabled and worth it, and
+        its metadata.
+
+        Only create_object and batch uploads pass through here: streamed multipart, resumable and staged uploads
+        reach S3 part by part, or straight from the client, and are always stored uncompressed. A compressed
+        object is decompressed by the app on every download, which also turns down Range requests for it.
+        """
+        metadata = {'content-hash': file_hash}
+        if (not self.compression_enabled or len(file_content) < self.compression_min_size
+                or not is_compressible(file_path, file_content)):
+            return file_content, metadata
+
+        codec = default_codec()
+        compressed_content = compress(file_content, codec, self.compression_level)
+        # Content that barely shrinks is stored as is, so reads of it never pay for decompression.
+        if len(compressed_content) > len(file_content) * (1 - self.compression_min_saving):
+            return file_content, metadata
+
+        metadata.update({'codec': codec, 'logical-size': str(len(file_content))})
+        return compressed_content, metadata
+
+    def _record_file(self, user_id, file_path, file_hash, file_size, original_key, storage_mode=None, codec=None,
+                     stored_size=None, read_your_writes=False):
+        if stored_size is None:
+            stored_size = file_size
+
+        if read_your_writes or not self.async_finalization:
+            self._index_file_hash(file_path, file_hash, user_id, file_size=file_size, original_key=original_key,
+                                  storage_mode=storage_mode, codec=codec, stored_size=stored_size)
+            self._update_user_usage(user_id, file_size, stored_size_change=stored_size)
+            self._request_derivatives(user_id, file_path, file_hash)
+            return
+
+        doc_id, document = self._build_file_hash_document(file_path, file_hash, user_id, file_size,
+                                                          original_key, storage_mode, codec, stored_size)
+        UserStorageState.bump(user_id)
+        task_id = self.task_queue.enqueue('finalize_object', {
+            "user_id": user_id,
+            "doc_id": doc_id,
+            "document": document,
+            "size_change": file_size,
+            "stored_size_change": stored_size,
+            "file_count_change": 1
+        }, user_id=user_id, keys=[doc_id, file_hash])
+        self._request_derivatives(user_id, file_path, file_hash)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "finalization_queued",
+            "resource": file_path,
+            "message": f"Indexing and usage accounting for {file_path} queued.",
+            "details": {"task_id": task_id, "doc_id": doc_id}
         })
 
+    def _build_file_hash_document(self, file_path, file_hash, user_id, file_size, original_key=None,
+                                  storage_mode=None, codec=None, stored_size=None):
         folder_path, filename = os.path.split(file_path)
         file_type = filename.split('.')[-1] if '.' in filename else 'unknown'
 
@@ -368,14 +2310,38 @@ class StorageFacade:
             "user_id": user_id,
             "filename": filename,
             "folder_path": folder_path,
+            "object_key": file_path,
             "creation_date": int(datetime.now().timestamp() * 1000),
             "size": file_size,
             "file_type": file_type,
         }
+        if storage_mode:
+            document["storage_mode"] = storage_mode
+        if codec:
+            document["codec"] = codec
+        if stored_size is not None:
+            document["stored_size"] = stored_size
+
+        return f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}", document
+
+    def _index_file_hash(self, file_path, file_hash, user_id, file_size, original_key=None, storage_mode=None,
+                         codec=None, stored_size=None):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "index_file_hash",
+            "resource": file_path,
+            "message": "Indexing file hash in Elasticsearch",
+            "details": {"file_hash": file_hash}
+        })
+
+        doc_id, document = self._build_file_hash_document(file_path, file_hash, user_id, file_size,
+                                                          original_key, storage_mode, codec, stored_size)
 
         try:
-            doc_id = f"{self.s3_facade.generate_bucket_name(user_id)}/{file_path}"
-            self.es_facade.index_document(self.file_hash_index, doc_id, document)
+            # The generation moves once the entry is searchable, so no cached page pairs it with older content.
+            self.es_facade.index_document(self.file_hash_index, doc_id, document, refresh='wait_for')
+            UserStorageState.bump(user_id)
             audit_logger.info({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "user": user_id,
@@ -395,33 +2361,30 @@ class StorageFacade:
             })
             raise Exception(f"Error indexing file hash for {file_path} in Elasticsearch: {str(e)}")
 
-    def _update_user_usage(self, user_id, file_size_change, decrement_file_count=False):
+    def _update_user_usage(self, user_id, file_size_change, decrement_file_count=False, file_count_change=None,
+                           stored_size_change=None):
         audit_logger.info({
             "timestamp": int(datetime.now().timestamp() * 1000),
             "user": user_id,
             "action": "update_user_usage",
             "resource": user_id,
             "message": "Updating user storage usage in Elasticsearch",
-            "details": {"file_size_change": file_size_change}
+            "details": {"file_size_change": file_size_change, "stored_size_change": stored_size_change}
         })
 
+        if stored_size_change is None:
+            stored_size_change = file_size_change
+        if file_count_change is None:
+            file_count_change = -1 if decrement_file_count else 1
         try:
-            current_usage = self.es_facade.get_document(self.user_usage_index, user_id)
-            updated_size = current_usage['total_size'] + file_size_change
-            updated_file_count = current_usage['file_count'] + (-1 if decrement_file_count else 1)
-            self.es_facade.update_document(self.user_usage_index, user_id, {
-                "total_size": updated_size,
-                "file_count": updated_file_count
-            })
-            audit_logger.info({
-                "timestamp": int(datetime.now().timestamp() * 1000),
-                "user": user_id,
-                "action": "user_usage_updated",
-                "resource": user_id,
-                "message": f"Updated storage usage for user {user_id}: size change {file_size_change}, file count updated.",
-                "details": {"total_size": updated_size, "file_count": updated_file_count}
-            })
-        except (ClientError, BotoCoreError) as e:
+            # One scripted increment, so concurrent writers never overwrite each other's totals.
+            result = self.es_facade.script_update_document(self.user_usage_index, user_id, {
+                "source": self.usage_change_script,
+                "lang": "painless",
+                "params": {"size_change": file_size_change, "stored_size_change": stored_size_change,
+                           "file_count_change": file_count_change}
+            }, retry_on_conflict=5, source=False)[0]
+        except ApiError as e:
             error_logger.error({
                 "timestamp": int(datetime.now().timestamp() * 1000),
                 "level": "ERROR",
@@ -431,3 +2394,17 @@ class StorageFacade:
                 "context": {"user_id": user_id}
             })
             raise Exception(f"Failed to update user usage for user {user_id}: {str(e)}")
+        if result == 'not_found':
+            raise Exception(f"Failed to update user usage for user {user_id}: no usage record exists.")
+
+        UserStorageState.bump(user_id)
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": user_id,
+            "action": "user_usage_updated",
+            "resource": user_id,
+            "message": f"Updated storage usage for user {user_id}: size change {file_size_change}, "
+                       f"file count change {file_count_change}.",
+            "details": {"size_change": file_size_change, "stored_size_change": stored_size_change,
+                        "file_count_change": file_count_change}
+        })
@@ -0,0 +1,158 @@
+import logging
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+
+from storage.es_mappings import STORAGE_TASK_MAPPING
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class TaskQueueFacade:
+    """
+    Durable work queue kept in an Elasticsearch index.
+
+    Workers claim tasks in batches with update_by_query, which never hands the same task to two workers.
+    A task keeps the batch id of its first claim. A batch abandoned by a crashed worker is reclaimed as a
+    whole after TASK_CLAIM_TIMEOUT, so handlers can use the batch id as an idempotency key.
+    Tasks can carry keys, such as the entries they write, so the queued ones for a key can be claimed ahead of
+    the queue, and a writer can wait for the ones another worker is running to finish.
+    """
+
+    claim_script = """
+        if (ctx._source.batch_id == null) { ctx._source.batch_id = params.claim_token; }
+        ctx._source.status = 'processing';
+        ctx._source.claim_token = params.claim_token;
+        ctx._source.claimed_at = params.now;
+        ctx._source.attempts = (ctx._source.attempts == null ? 0 : ctx._source.attempts) + 1;
+    """
+
+    def __init__(self, es_facade):
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "init",
+            "resource": "TaskQueueFacade",
+            "message": "Initializing TaskQueueFacade",
+            "details": {}
+        })
+        self.es_facade = es_facade
+        self.task_index = settings.ES_TASK_INDEX
+        self.claim_timeout = settings.TASK_CLAIM_TIMEOUT
+        self.fence_timeout = settings.TASK_FENCE_TIMEOUT
+        self.es_facade.create_index(self.task_index, STORAGE_TASK_MAPPING)
+        self.es_facade.put_mapping(self.task_index, STORAGE_TASK_MAPPING)
+
+    def enqueue(self, task_type, payload, user_id=None, keys=()):
+        task_id = uuid.uuid4().hex
+        self.es_facade.index_document(self.task_index, task_id, {
+            "task_type": task_type,
+            "user_id": user_id,
+            "keys": list(keys),
+            "payload": payload,
+            "status": "queued",
+            "batch_id": None,
+            "claim_token": None,
+            "claimed_at": None,
+            "attempts": 0,
+            "creation_date": int(datetime.now().timestamp() * 1000)
+        })
+        return task_id
+
+    def claim_batch(self, task_type, batch_size, keys=None):
+        """
+        Claims a batch of tasks. With keys, only tasks carrying one of the keys are claimed: queued ones, and
+        claimed ones whose worker has been silent for longer than TASK_CLAIM_TIMEOUT.
+        """
+        now = int(datetime.now().timestamp() * 1000)
+        claim_token = uuid.uuid4().hex
+
+        stale_hits = []
+        if keys is None:
+            stale_result = self.es_facade.es_client.search(index=self.task_index, body={
+                "query": {"bool": {"filter": [
+                    {"term": {"task_type": task_type}},
+                    {"term": {"status": "processing"}},
+                    {"range": {"claimed_at": {"lt": now - self.claim_timeout * 1000}}}
+                ]}},
+                "_source": ["batch_id"],
+                "size": 1
+            })
+            stale_hits = stale_result['hits']['hits']
+
+        if stale_hits:
+            query = {"term": {"batch_id": stale_hits[0]['_source']['batch_id']}}
+            max_docs = None
+        else:
+            filters = [{"term": {"task_type": task_type}}]
+            if keys is None:
+                filters.append({"term": {"status": "queued"}})
+            else:
+                filters.append({"terms": {"keys": list(keys)}})
+                filters.append({"bool": {"should": [
+                    {"term": {"status": "queued"}},
+                    {"bool": {"filter": [
+                        {"term": {"status": "processing"}},
+                        {"range": {"claimed_at": {"lt": now - self.claim_timeout * 1000}}}
+                    ]}}
+                ], "minimum_should_match": 1}})
+            query = {"bool": {"filter": filters}}
+            max_docs = batch_size
+
+        claimed_count = self.es_facade.update_by_query(
+            self.task_index, query,
+            {"source": self.claim_script, "lang": "painless", "params": {"claim_token": claim_token, "now": now}},
+            max_docs=max_docs
+        )
+        if not claimed_count:
+            return []
+
+        claimed_result = self.es_facade.es_client.search(index=self.task_index, body={
+            "query": {"term": {"claim_token": claim_token}},
+            "size": claimed_count
+        })
+        tasks = [(hit['_id'], hit['_source']) for hit in claimed_result['hits']['hits']]
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": "system",
+            "action": "claim_tasks",
+            "resource": self.task_index,
+            "message": f"Claimed {len(tasks)} {task_type} tasks.",
+            "details": {"claim_token": claim_token, "reclaimed": bool(stale_hits)}
+        })
+        return tasks
+
+    def pending_count(self, task_type, user_id=None):
+        """Counts queued and claimed tasks of a type, optionally only those enqueued on behalf of one user."""
+        filters = [{"term": {"task_type": task_type}}, {"terms": {"status": ["queued", "processing"]}}]
+        if user_id is not None:
+            filters.append({"term": {"user_id": user_id}})
+        response = self.es_facade.es_client.count(index=self.task_index, body={"query": {"bool": {"filter": filters}}})
+        return response['count']
+
+    def wait_for_claimed(self, task_type, keys, poll_interval=0.1):
+        """
+        Waits until no live worker holds a task carrying one of the keys; returns False if one still does after
+        TASK_FENCE_TIMEOUT seconds.
+        """
+        deadline = time.monotonic() + self.fence_timeout
+        while True:
+            now = int(datetime.now().timestamp() * 1000)
+            response = self.es_facade.es_client.count(index=self.task_index, body={"query": {"bool": {"filter": [
+                {"term": {"task_type": task_type}},
+                {"terms": {"keys": list(keys)}},
+                {"term": {"status": "processing"}},
+                {"range": {"claimed_at": {"gte": now - self.claim_timeout * 1000}}}
+            ]}}})
+            if not response['count']:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+    def complete(self, task_ids):
+        if task_ids:
+            self.es_facade.bulk_delete_documents(self.task_index, task_ids)
@@ -1,3 +1,1364 @@
-from django.test import TestCase
+import base64
+import hashlib
+import random
+import time
+import zipfile
+from datetime import datetime
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from botocore.exceptions import ClientError
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from elasticsearch import helpers
+from moto import mock_aws
+
+from storage import views
+from storage.compression import (CODEC_GZIP, CODEC_ZSTD, SNIFF_SIZE, compress, is_compressible,
+                                 iter_decompressed)
+from storage.delete_job_utils import FolderDeleteJobFacade
+from storage.es_utils import ESFacade
+from storage.hash_cache import HashLookupCache
+from storage.hash_utils import HashStateMismatch, ResumableSHA256
+from storage.listing_cache import FolderListingCache
+from storage.models import UserStorageState
+from storage.reconcile_utils import ReconcileFacade
+from storage.resumable_utils import ResumableUploadFacade, UploadSessionNotFound
+from storage.s3_utils import S3Facade
+from storage.storage_utils import StorageFacade
+from storage.task_queue import TaskQueueFacade
+from storage.upload_handlers import S3StreamingUploadHandler
+from storage.zip_stream import ZipEntry, ZipStreamWriter
+
+USER_ID = '1'
+PART_SIZE = 5 * 1024 * 1024
+CSRF_TOKEN = 'a' * 32
+
+
+class MotoTestCase(SimpleTestCase):
+    """Runs each test against an in-memory S3 with one user bucket already created."""
+
+    def setUp(self):
+        settings_override = override_settings(S3_ENDPOINT_URL=None, S3_MULTIPART_CHUNK_SIZE=PART_SIZE)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        aws_mock = mock_aws()
+        aws_mock.start()
+        self.addCleanup(aws_mock.stop)
+
+        self.s3_facade = S3Facade()
+        self.s3_facade.create_bucket_for_user(USER_ID)
+        self.bucket_name = self.s3_facade.generate_bucket_name(USER_ID)
+
+    def list_keys(self):
+        response = self.s3_facade.s3_client.list_objects_v2(Bucket=self.bucket_name)
+        return [item['Key'] for item in response.get('Contents', [])]
+
+    def list_multipart_uploads(self):
+        return self.s3_facade.s3_client.list_multipart_uploads(Bucket=self.bucket_name).get('Uploads', [])
+
+
+class StorageFacadeTestCase(MotoTestCase):
+    """A StorageFacade on moto-backed S3, with Elasticsearch replaced by a mock the test scripts."""
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(HASH_CACHE_ENABLED=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for patcher in (mock.patch('storage.storage_utils.ESFacade'),
+                        mock.patch('storage.storage_utils.UserStorageState.bump')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage_facade = StorageFacade()
+        self.es_facade = self.storage_facade.es_facade
+
+    def script_results(self, blob_result):
+        """Answers blob scripts with blob_result and usage increments as applied."""
+        def script_update_document(index_name, doc_id, script, **kwargs):
+            return ('updated', None) if index_name == self.storage_facade.user_usage_index else blob_result
+        return script_update_document
+
+    @staticmethod
+    def search_response(hits=(), total=None):
+        hits = list(hits)
+        return {'hits': {'hits': hits, 'total': {'value': len(hits) if total is None else total}}}
+
+
+class FileUploadViewTests(MotoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade = mock.Mock(s3_facade=self.s3_facade, chunked_mode=False,
+                                        chunked_min_file_size=PART_SIZE)
+        facade_patch = mock.patch.object(views, 'storage_facade', self.storage_facade)
+        facade_patch.start()
+        self.addCleanup(facade_patch.stop)
+
+    def post(self, content, csrf_token=None):
+        data = {'file': SimpleUploadedFile('a.txt', content)}
+        if csrf_token is not None:
+            data['csrfmiddlewaretoken'] = csrf_token
+        request = RequestFactory(enforce_csrf_checks=True).post('/upload/', data)
+        request.user = SimpleNamespace(is_authenticated=True, username=USER_ID)
+        # A forged cross-site POST carries the victim's CSRF cookie but cannot know the token.
+        request.COOKIES['csrftoken'] = CSRF_TOKEN
+        return views.FileUploadView.as_view()(request)
+
+    def test_post_without_csrf_token_leaves_no_object(self):
+        response = self.post(b'x' * (PART_SIZE + 10))
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.list_keys(), [])
+        self.assertEqual(self.list_multipart_uploads(), [])
+        self.storage_facade.complete_multipart_object.assert_not_called()
+        self.storage_facade.create_object.assert_not_called()
+
+    def test_small_post_without_csrf_token_is_not_stored(self):
+        response = self.post(b'small file')
+
+        self.assertEqual(response.status_code, 403)
+        self.storage_facade.create_object.assert_not_called()
+
+    def test_post_with_csrf_token_completes_streamed_upload(self):
+        response = self.post(b'x' * (PART_SIZE + 10), csrf_token=CSRF_TOKEN)
+
+        self.assertEqual(response.status_code, 302)
+        self.storage_facade.complete_multipart_object.assert_called_once()
+        user_id, file_path, upload_id, parts, _, file_size = \
+            self.storage_facade.complete_multipart_object.call_args.args
+        self.assertEqual((user_id, file_path, file_size, len(parts)), (USER_ID, 'a.txt', PART_SIZE + 10, 2))
+        self.assertEqual([upload['UploadId'] for upload in self.list_multipart_uploads()], [upload_id])
+
+    def test_failed_save_aborts_streamed_upload(self):
+        self.storage_facade.complete_multipart_object.side_effect = Exception("index unavailable")
+
+        response = self.post(b'x' * (PART_SIZE + 10), csrf_token=CSRF_TOKEN)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.list_multipart_uploads(), [])
+
+
+class DownloadLinkCacheTests(MotoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade.upload_file(USER_ID, 'a.txt', b'first')
+        presign_patch = mock.patch.object(self.s3_facade.s3_client, 'generate_presigned_url',
+                                          wraps=self.s3_facade.s3_client.generate_presigned_url)
+        self.generate_presigned_url = presign_patch.start()
+        self.addCleanup(presign_patch.stop)
+
+    def test_link_is_reused_for_the_same_version_only(self):
+        first_url = self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        self.assertEqual(self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1'), first_url)
+        self.assertEqual(self.generate_presigned_url.call_count, 1)
+
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v2')
+        self.assertEqual(self.generate_presigned_url.call_count, 2)
+        self.assertEqual(self.s3_facade.download_link_cache.stats()['hits'], 1)
+
+    def test_writing_the_object_drops_its_link(self):
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        self.s3_facade.upload_file(USER_ID, 'a.txt', b'second')
+
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        self.assertEqual(self.generate_presigned_url.call_count, 2)
+
+    def test_link_close_to_expiry_is_not_reused(self):
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        expires_in = self.s3_facade.download_link_expiration - self.s3_facade.download_link_cache.min_remaining
+
+        with mock.patch('storage.link_cache.time.time', return_value=time.time() + expires_in + 1):
+            self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        self.assertEqual(self.generate_presigned_url.call_count, 2)
+
+    def test_explicit_expiration_gets_a_fresh_link(self):
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', version='v1')
+        self.s3_facade.generate_download_link(USER_ID, 'a.txt', expiration=7200, version='v1')
+
+        self.assertEqual(self.generate_presigned_url.call_count, 2)
+        self.assertEqual(self.generate_presigned_url.call_args.kwargs['ExpiresIn'], 7200)
+
+
+class StreamingUploadHandlerTests(MotoTestCase):
+    def test_chunked_mode_buffers_at_most_one_part(self):
+        storage_facade = mock.Mock(s3_facade=self.s3_facade, chunked_mode=True,
+                                   chunked_min_file_size=4 * PART_SIZE)
+        handler = S3StreamingUploadHandler(RequestFactory().post('/upload/'), storage_facade, USER_ID)
+        handler.new_file('file', 'a.bin', 'application/octet-stream', 2 * PART_SIZE)
+
+        with mock.patch('storage.upload_handlers.ChunkedObjectWriter') as chunked_object_writer:
+            handler.receive_data_chunk(b'x' * (PART_SIZE - 1), 0)
+            chunked_object_writer.assert_not_called()
+            handler.receive_data_chunk(b'x', PART_SIZE - 1)
+
+        chunked_object_writer.return_value.write.assert_called_once_with(b'x' * PART_SIZE)
+        self.assertEqual(len(handler.buffer), 0)
+
+
+class ProbeObjectTests(StorageFacadeTestCase):
+    file_hash = 'f' * 64
+
+    def test_probe_does_not_link_content_the_caller_does_not_hold(self):
+        self.es_facade.search.return_value = self.search_response(total=0)
+
+        result = self.storage_facade.probe_object(USER_ID, 'a.txt', self.file_hash, 10)
+
+        self.assertFalse(result['exists'])
+        self.es_facade.script_update_document.assert_not_called()
+        self.assertEqual(self.list_keys(), [])
+
+    def test_probe_links_content_the_caller_already_holds(self):
+        self.es_facade.search.return_value = self.search_response(total=1)
+        self.es_facade.script_update_document.return_value = (
+            'updated', {'original_key': f'{self.bucket_name}/b.txt', 'size': 10}
+        )
+
+        result = self.storage_facade.probe_object(USER_ID, 'a.txt', self.file_hash, 10)
+
+        self.assertTrue(result['exists'])
+        self.assertEqual(self.list_keys(), ['a.txt'])
+        query = self.es_facade.search.call_args.args[1]['query']['bool']['filter']
+        self.assertIn({'term': {'user_id.keyword': USER_ID}}, query)
+
+
+class ObjectStatTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.s3_facade.upload_file(USER_ID, 'original.txt', b'content', {'content-hash': 'c' * 64})
+        self.s3_facade.upload_file(USER_ID, 'link.txt', b'', StorageFacade._link_metadata(
+            f'{self.bucket_name}/original.txt', file_hash='c' * 64))
+        get_object_patch = mock.patch.object(self.s3_facade.s3_client, 'get_object',
+                                             wraps=self.s3_facade.s3_client.get_object)
+        self.get_object = get_object_patch.start()
+        self.addCleanup(get_object_patch.stop)
+
+    def test_stat_reads_headers_only(self):
+        object_stat = self.s3_facade.stat_object(USER_ID, 'original.txt')
+
+        self.assertEqual(object_stat['size'], len(b'content'))
+        self.assertEqual(object_stat['etag'], hashlib.md5(b'content').hexdigest())
+        self.assertEqual(object_stat['metadata'], {'content-hash': 'c' * 64})
+        self.assertIsNotNone(object_stat['last_modified'])
+        self.get_object.assert_not_called()
+
+    def test_read_object_reports_the_real_size(self):
+        result = self.storage_facade.read_object(USER_ID, 'original.txt')
+
+        self.assertEqual(result['size'], len(b'content'))
+        self.assertIn('original.txt', result['download_link'])
+        self.get_object.assert_not_called()
+
+    def test_read_object_presigns_the_original_of_a_link(self):
+        with mock.patch.object(self.s3_facade, 'generate_download_link', return_value='url') as generate_link:
+            result = self.storage_facade.read_object(USER_ID, 'link.txt')
+
+        self.assertEqual(result['download_link'], 'url')
+        generate_link.assert_called_once_with(USER_ID, 'original.txt', version='c' * 64)
+        self.get_object.assert_not_called()
+
+    def test_missing_object_raises(self):
+        with self.assertRaises(Exception):
+            self.s3_facade.stat_object(USER_ID, 'missing.txt')
+
+
+class BatchUploadTests(StorageFacadeTestCase):
+    def test_batch_takes_blob_references_in_bulk(self):
+        same_hash, stored_hash = hashlib.sha256(b'same').hexdigest(), hashlib.sha256(b'stored').hexdigest()
+        self.es_facade.bulk_script_update_documents.side_effect = [
+            {same_hash: ('not_found', None), stored_hash: ('updated', {'original_key': f'{self.bucket_name}/x.txt'})},
+            {same_hash: ('updated', {'original_key': f'{self.bucket_name}/a.txt'})}
+        ]
+
+        results = self.storage_facade.create_objects(USER_ID, [
+            ('a.txt', BytesIO(b'same')), ('b.txt', BytesIO(b'same')), ('c.txt', BytesIO(b'stored'))
+        ])
+
+        self.assertEqual([result['status'] for result in results], ['uploaded', 'linked', 'linked'])
+        first_call, duplicate_call = self.es_facade.bulk_script_update_documents.call_args_list
+        first_counts = {file_hash: script['params']['count'] for file_hash, script in first_call.args[1].items()}
+        duplicate_counts = {file_hash: script['params']['count']
+                            for file_hash, script in duplicate_call.args[1].items()}
+        self.assertEqual(first_counts, {same_hash: 2, stored_hash: 1})
+        self.assertEqual(duplicate_counts, {same_hash: 1})
+        self.assertEqual({call.args[0] for call in self.es_facade.script_update_document.call_args_list},
+                         {self.storage_facade.user_usage_index})
+        self.assertEqual(self.s3_facade.get_object(USER_ID, 'b.txt')[0], b'')
+
+
+class HashLookupCacheTests(StorageFacadeTestCase):
+    file_hash = 'e' * 64
+
+    def setUp(self):
+        super().setUp()
+        thread_patch = mock.patch('storage.hash_cache.threading.Thread')
+        self.loader_thread = thread_patch.start()
+        self.addCleanup(thread_patch.stop)
+        self.storage_facade.hash_cache = HashLookupCache(self.es_facade, self.storage_facade.blob_index)
+        self.blob = {'original_key': f'{self.bucket_name}/a.txt', 'size': 10}
+
+    def test_loader_starts_with_the_first_lookup(self):
+        self.loader_thread.assert_not_called()
+
+        self.storage_facade.hash_cache.might_contain(self.file_hash)
+        self.storage_facade.hash_cache.might_contain(self.file_hash)
+
+        self.loader_thread.assert_called_once()
+        self.loader_thread.return_value.start.assert_called_once_with()
+
+    def test_cached_blob_is_acquired_without_reading_it_back(self):
+        self.es_facade.script_update_document.side_effect = [('updated', self.blob), ('updated', None)]
+
+        self.storage_facade._acquire_original(self.file_hash)
+        original_doc = self.storage_facade._acquire_original(self.file_hash)
+
+        self.assertEqual(original_doc['original_key'], self.blob['original_key'])
+        cached_call = self.es_facade.script_update_document.call_args
+        self.assertEqual(cached_call.args[2]['params']['original_key'], self.blob['original_key'])
+        self.assertFalse(cached_call.kwargs['source'])
+        self.assertEqual(self.storage_facade.hash_cache.stats()['lru_hits'], 1)
+
+    def test_moved_blob_is_read_again(self):
+        moved_blob = {**self.blob, 'original_key': f'{self.bucket_name}/b.txt'}
+        self.es_facade.script_update_document.side_effect = [('updated', self.blob), ('noop', None),
+                                                             ('updated', moved_blob)]
+
+        self.storage_facade._acquire_original(self.file_hash)
+        original_doc = self.storage_facade._acquire_original(self.file_hash)
+
+        self.assertEqual(original_doc['original_key'], moved_blob['original_key'])
+        self.assertEqual(self.storage_facade.hash_cache.get(self.file_hash)['original_key'],
+                         moved_blob['original_key'])
+
+
+class TrashTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.s3_facade.create_bucket_for_user('2')
+        self.original_key = f'{self.bucket_name}/a.txt'
+        self.link_doc_id = f"{self.s3_facade.generate_bucket_name('2')}/b.txt"
+        self.old_hash = StorageFacade.create_file_hash(b'old content')
+
+        self.s3_facade.upload_file(USER_ID, 'a.txt', b'old content', {'content-hash': self.old_hash})
+        self.s3_facade.upload_file('2', 'b.txt', b'', StorageFacade._link_metadata(self.original_key,
+                                                                                   file_hash=self.old_hash))
+        documents = {
+            self.storage_facade.file_hash_index: {'hash': self.old_hash, 'original_key': self.original_key,
+                                                  'user_id': USER_ID, 'folder_path': '', 'filename': 'a.txt',
+                                                  'size': 11},
+            self.storage_facade.user_usage_index: {'total_size': 11, 'stored_size': 11, 'file_count': 1}
+        }
+        self.es_facade.get_document.side_effect = lambda index_name, doc_id: documents[index_name]
+        self.es_facade.get_documents.return_value = {
+            self.old_hash: {'hash': self.old_hash, 'original_key': self.original_key, 'ref_count': 2}
+        }
+        scan_patch = mock.patch('storage.storage_utils.helpers.scan', return_value=[
+            {'_id': self.link_doc_id, '_source': {'original_key': self.original_key, 'hash': self.old_hash}}
+        ])
+        scan_patch.start()
+        self.addCleanup(scan_patch.stop)
+
+    def test_trashing_a_linked_original_moves_it_out_of_the_live_namespace(self):
+        self.storage_facade.trash_object(USER_ID, 'a.txt')
+
+        keys = self.list_keys()
+        self.assertNotIn('a.txt', keys)
+        [trash_path] = keys
+        self.assertTrue(trash_path.startswith('.trash/') and trash_path.endswith('/a.txt'))
+        trash_document = self.es_facade.bulk_index_documents.call_args.args[1][0]
+        self.assertEqual(trash_document['id'], f'{self.bucket_name}/{trash_path}')
+        self.assertEqual(trash_document['body']['trashed_path'], 'a.txt')
+        self.es_facade.bulk_delete_documents.assert_called_once_with(self.storage_facade.file_hash_index,
+                                                                     [self.original_key], refresh='wait_for')
+        link_metadata = self.s3_facade.stat_object('2', 'b.txt')['metadata']
+        self.assertEqual(link_metadata['original-key'], f'{self.bucket_name}/{trash_path}')
+
+    def test_reupload_after_trash_leaves_the_trashed_original_intact(self):
+        self.storage_facade.trash_object(USER_ID, 'a.txt')
+        [trash_path] = self.list_keys()
+        self.es_facade.script_update_document.side_effect = self.script_results(('not_found', None))
+        self.es_facade.create_document.return_value = True
+
+        self.storage_facade.create_object(USER_ID, 'a.txt', b'new content')
+
+        self.assertEqual(self.s3_facade.get_object(USER_ID, 'a.txt')[0], b'new content')
+        self.assertEqual(self.s3_facade.get_object(USER_ID, trash_path)[0], b'old content')
+        link_metadata = self.s3_facade.stat_object('2', 'b.txt')['metadata']
+        self.assertEqual(link_metadata['original-key'], f'{self.bucket_name}/{trash_path}')
+
+
+class DeleteObjectTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade.async_finalization = True
+        self.storage_facade.task_queue = mock.Mock()
+        self.storage_facade.task_queue.claim_batch.return_value = []
+        self.file_hash = StorageFacade.create_file_hash(b'content')
+        self.doc_id = f'{self.bucket_name}/a.txt'
+        self.storage_facade.s3_facade.upload_file(USER_ID, 'a.txt', b'content', {'content-hash': self.file_hash})
+        self.es_facade.get_document.return_value = {'total_size': 7, 'stored_size': 7, 'file_count': 1}
+        scan_patch = mock.patch('storage.storage_utils.helpers.scan', return_value=[])
+        scan_patch.start()
+        self.addCleanup(scan_patch.stop)
+
+    def finalize_task(self, user_id, file_path):
+        doc_id, document = self.storage_facade._build_file_hash_document(file_path, self.file_hash, user_id, 7,
+                                                                         original_key=None)
+        return ('task-1', {'batch_id': 'batch-1', 'payload': {
+            'user_id': user_id, 'doc_id': doc_id, 'document': document, 'size_change': 7,
+            'stored_size_change': 7, 'file_count_change': 1
+        }})
+
+    def test_delete_finalizes_queued_entry_before_deleting_it(self):
+        self.storage_facade.task_queue.claim_batch.return_value = [self.finalize_task(USER_ID, 'a.txt')]
+        self.es_facade.script_update_document.return_value = ('deleted', None)
+
+        self.storage_facade.delete_object(USER_ID, 'a.txt')
+
+        self.assertEqual(self.storage_facade.task_queue.claim_batch.call_args.kwargs['keys'],
+                         [self.doc_id, self.file_hash])
+        [indexed] = self.es_facade.bulk_index_documents.call_args.args[1]
+        self.assertEqual(indexed['id'], self.doc_id)
+        self.es_facade.delete_document.assert_called_once_with(self.storage_facade.file_hash_index, self.doc_id,
+                                                               refresh='wait_for')
+        self.assertEqual(self.list_keys(), [])
+
+    def test_finalization_skips_entries_whose_object_is_gone(self):
+        self.storage_facade.task_queue.claim_batch.return_value = [self.finalize_task(USER_ID, 'gone.txt')]
+
+        self.assertEqual(self.storage_facade.process_finalization_tasks(), 1)
+
+        self.es_facade.bulk_index_documents.assert_not_called()
+        self.storage_facade.task_queue.complete.assert_called_once_with(['task-1'])
+
+    def test_failed_file_delete_is_not_retried_as_a_folder_delete(self):
+        self.es_facade.script_update_document.return_value = ('updated', {'ref_count': 1})
+
+        with mock.patch.object(self.storage_facade, 'delete_folder') as delete_folder:
+            with self.assertRaisesMessage(Exception, "No valid new content holder"):
+                self.storage_facade.delete_object(USER_ID, 'a.txt')
+
+        delete_folder.assert_not_called()
+        self.assertEqual(self.list_keys(), ['a.txt'])
+
+    def test_delete_waits_for_tasks_another_worker_is_running(self):
+        self.storage_facade.task_queue.wait_for_claimed.return_value = False
+
+        with self.assertRaisesMessage(Exception, "still being finalized"):
+            self.storage_facade.delete_object(USER_ID, 'a.txt')
+
+        self.storage_facade.task_queue.wait_for_claimed.assert_called_once_with('finalize_object',
+                                                                                [self.doc_id, self.file_hash])
+        self.es_facade.script_update_document.assert_not_called()
+        self.assertEqual(self.list_keys(), ['a.txt'])
+
+    def test_path_without_object_is_deleted_as_a_folder(self):
+        with mock.patch.object(self.storage_facade, 'delete_folder') as delete_folder:
+            self.storage_facade.delete_object(USER_ID, 'folder')
+
+        delete_folder.assert_called_once_with(USER_ID, 'folder')
+
+
+class DroppedStream:
+    """A request body whose connection drops after the given bytes."""
+
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, size):
+        block = self.stream.read(size)
+        if not block:
+            raise IOError("connection reset")
+        return block
+
+
+class ResumableUploadTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.es_facade.index_document.return_value = (1, 1)
+        self.resumable_upload_facade = ResumableUploadFacade(self.storage_facade)
+        self.session_id, self.session = self.resumable_upload_facade.create_session(USER_ID, 'a.bin',
+                                                                                    2 * PART_SIZE + 10)
+        self.es_facade.get_versioned_document.return_value = (self.session, 1, 1)
+        self.es_facade.index_document.reset_mock()
+
+    def test_session_is_saved_after_each_stored_part(self):
+        with self.assertRaises(IOError):
+            self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, 0,
+                                                      DroppedStream(b'x' * (PART_SIZE + 100)))
+
+        [save_call] = self.es_facade.index_document.call_args_list
+        saved_session = save_call.args[2]
+        self.assertEqual((saved_session['offset'], len(saved_session['parts'])), (PART_SIZE, 1))
+        self.assertEqual((save_call.kwargs['if_seq_no'], save_call.kwargs['if_primary_term']), (1, 1))
+
+    def test_chunks_smaller_than_a_part_are_kept_until_a_part_fills(self):
+        session = self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, 0, BytesIO(b'a' * 100))
+
+        self.assertEqual((session['offset'], session['tail_size'], session['parts']), (100, 100, []))
+        first_tail_key = session['tail_key']
+        self.assertEqual(self.s3_facade.get_object(USER_ID, first_tail_key)[0], b'a' * 100)
+
+        session = self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, 100,
+                                                            BytesIO(b'b' * PART_SIZE))
+
+        self.assertEqual((session['offset'], session['tail_size'], len(session['parts'])), (PART_SIZE + 100, 100, 1))
+        self.assertEqual(self.list_keys(), [session['tail_key']])
+        self.assertEqual(self.s3_facade.get_object(USER_ID, session['tail_key'])[0], b'b' * 100)
+        hasher = ResumableSHA256(base64.b64decode(session['hash_state']))
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(b'a' * 100 + b'b' * (PART_SIZE - 100)).hexdigest())
+
+    def test_upload_completed_before_a_lost_session_save_is_not_completed_again(self):
+        self.es_facade.script_update_document.side_effect = self.script_results(('not_found', None))
+        self.es_facade.create_document.return_value = True
+        content = b'c' * (2 * PART_SIZE + 10)
+        self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, 0, BytesIO(content))
+        # The worker stopped before the completed session was saved.
+        self.session.update(status='active', result=None)
+
+        session = self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, len(content), BytesIO(b''))
+
+        self.assertEqual((session['status'], session['result']), ('completed', 'File a.bin uploaded successfully.'))
+        self.assertEqual(self.s3_facade.get_object(USER_ID, 'a.bin')[0], content)
+
+    def test_session_saved_under_another_libcrypto_is_dropped(self):
+        state = base64.b64decode(self.session['hash_state'])
+        self.session['hash_state'] = base64.b64encode((0).to_bytes(8, 'big') + state[8:]).decode()
+
+        with self.assertRaises(UploadSessionNotFound):
+            self.resumable_upload_facade.append_chunk(USER_ID, self.session_id, 0, BytesIO(b'a'))
+
+        self.assertEqual(self.list_multipart_uploads(), [])
+        self.es_facade.delete_document.assert_called_once_with(self.resumable_upload_facade.session_index,
+                                                               self.session_id)
+
+    def test_abandoned_session_is_expired_and_its_upload_aborted(self):
+        self.es_facade.es_client.search.return_value = self.search_response([
+            {'_id': self.session_id, '_source': dict(self.session), '_seq_no': 1, '_primary_term': 1}
+        ])
+        self.assertEqual(len(self.list_multipart_uploads()), 1)
+
+        self.assertEqual(self.resumable_upload_facade.expire_sessions(), 1)
+
+        self.assertEqual(self.list_multipart_uploads(), [])
+        self.assertEqual(self.es_facade.index_document.call_args.args[2]['status'], 'expired')
+        self.es_facade.delete_document.assert_called_once_with(self.resumable_upload_facade.session_index,
+                                                               self.session_id)
+
+
+class ResumableSHA256Tests(SimpleTestCase):
+    def test_restored_state_continues_the_hash(self):
+        hasher = ResumableSHA256()
+        hasher.update(b'first half ')
+        restored = ResumableSHA256(hasher.state())
+        restored.update(b'second half')
+
+        self.assertEqual(restored.hexdigest(), hashlib.sha256(b'first half second half').hexdigest())
+
+    def test_state_from_another_libcrypto_version_is_refused(self):
+        state = ResumableSHA256().state()
+
+        with self.assertRaises(HashStateMismatch):
+            ResumableSHA256((0).to_bytes(8, 'big') + state[8:])
+
+    def test_startup_check_passes_on_the_loaded_libcrypto(self):
+        ResumableSHA256.check()
+
+
+class StagedPromotionTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file_hash = StorageFacade.create_file_hash(b'content')
+        self.staging_key = f'{self.storage_facade.s3_facade.staging_prefix}upload-1'
+        self.storage_facade.s3_facade.upload_file(USER_ID, self.staging_key, b'content', {})
+
+    def test_new_content_is_promoted_to_an_original(self):
+        self.es_facade.script_update_document.side_effect = self.script_results(('not_found', None))
+        self.es_facade.create_document.return_value = True
+
+        self.storage_facade.promote_staged_object(USER_ID, self.staging_key, 'a.txt', self.file_hash, 7)
+
+        self.assertEqual(self.list_keys(), ['a.txt'])
+        body, metadata = self.storage_facade.s3_facade.get_object(USER_ID, 'a.txt')
+        self.assertEqual((body, metadata['content-hash']), (b'content', self.file_hash))
+        blob_index, file_hash, blob = self.es_facade.create_document.call_args.args
+        self.assertEqual((blob_index, file_hash, blob['ref_count']), (self.storage_facade.blob_index,
+                                                                      self.file_hash, 1))
+
+    def test_large_staged_upload_is_copied_in_parts(self):
+        self.es_facade.script_update_document.side_effect = self.script_results(('not_found', None))
+        self.es_facade.create_document.return_value = True
+        s3_facade = self.storage_facade.s3_facade
+        s3_facade.copy_multipart_threshold = 7
+
+        with mock.patch.object(s3_facade, '_copy_object_multipart',
+                               wraps=s3_facade._copy_object_multipart) as copy_object_multipart:
+            self.storage_facade.promote_staged_object(USER_ID, self.staging_key, 'a.txt', self.file_hash, 7)
+
+        self.assertEqual(copy_object_multipart.call_args.args[-1], 7)
+        body, metadata = s3_facade.get_object(USER_ID, 'a.txt')
+        self.assertEqual((body, metadata['content-hash']), (b'content', self.file_hash))
+
+    def test_known_content_is_linked_and_the_staged_copy_dropped(self):
+        original_key = f'{self.bucket_name}/b.txt'
+        self.es_facade.script_update_document.return_value = ('updated', {'original_key': original_key, 'size': 7})
+
+        self.storage_facade.promote_staged_object(USER_ID, self.staging_key, 'a.txt', self.file_hash, 7)
+
+        self.assertEqual(self.list_keys(), ['a.txt'])
+        body, metadata = self.storage_facade.s3_facade.get_object(USER_ID, 'a.txt')
+        self.assertEqual((body, metadata['original-key']), (b'', original_key))
+        self.es_facade.create_document.assert_not_called()
+
+
+class LinkPromotionTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.s3_facade.copy_multipart_threshold = self.s3_facade.copy_part_size = PART_SIZE
+        self.content = random.randbytes(2 * PART_SIZE + 10)
+        self.file_hash = StorageFacade.create_file_hash(self.content)
+        self.s3_facade.upload_file(USER_ID, 'a.txt', self.content, {'content-hash': self.file_hash})
+        self.linked_doc_ids = [f'{self.bucket_name}/{name}' for name in ('b.txt', 'c.txt', 'd.txt')]
+        for linked_doc_id in self.linked_doc_ids:
+            self.s3_facade.upload_file(USER_ID, linked_doc_id.split('/', 1)[1], b'', StorageFacade._link_metadata(
+                f'{self.bucket_name}/a.txt', file_hash=self.file_hash))
+        self.es_facade.script_update_document.side_effect = self.script_results(('updated', None))
+
+    def promote(self):
+        object_stat = self.s3_facade.stat_object(USER_ID, 'a.txt')
+        with mock.patch.object(self.s3_facade.s3_client, 'upload_part_copy',
+                               wraps=self.s3_facade.s3_client.upload_part_copy) as upload_part_copy:
+            self.storage_facade._promote_link(USER_ID, 'a.txt', object_stat, self.file_hash, self.linked_doc_ids,
+                                              update_blob=True)
+        return upload_part_copy
+
+    def test_first_link_receives_a_server_side_copy(self):
+        upload_part_copy = self.promote()
+
+        self.assertEqual(upload_part_copy.call_count, 3)
+        self.assertEqual(upload_part_copy.call_args_list[-1].kwargs['CopySourceRange'],
+                         f'bytes={2 * PART_SIZE}-{2 * PART_SIZE + 9}')
+        body, metadata = self.s3_facade.get_object(USER_ID, 'b.txt')
+        self.assertEqual(body, self.content)
+        self.assertEqual(metadata['content-hash'], self.file_hash)
+        self.assertNotIn('original-key', metadata)
+        self.assertEqual(self.list_multipart_uploads(), [])
+
+    def test_remaining_links_are_repointed_in_one_bulk_request(self):
+        new_holder = self.linked_doc_ids[0]
+
+        self.promote()
+
+        self.es_facade.update_document.assert_called_once_with(self.storage_facade.blob_index, self.file_hash,
+                                                               {'original_key': new_holder})
+        [bulk_call] = self.es_facade.bulk_update_documents.call_args_list
+        index_name, documents = bulk_call.args
+        self.assertEqual(index_name, self.storage_facade.file_hash_index)
+        self.assertEqual(documents[0], {'id': new_holder, 'body': {
+            'original_key': new_holder, 'size': len(self.content), 'stored_size': len(self.content)}})
+        self.assertEqual(documents[1:], [{'id': linked_doc_id, 'body': {'original_key': new_holder}}
+                                         for linked_doc_id in self.linked_doc_ids[1:]])
+        for linked_doc_id in self.linked_doc_ids[1:]:
+            body, metadata = self.s3_facade.get_object(USER_ID, linked_doc_id.split('/', 1)[1])
+            self.assertEqual((body, metadata['original-key']), (b'', new_holder))
+
+    def test_small_original_is_copied_in_one_request(self):
+        self.s3_facade.copy_multipart_threshold = len(self.content) + 1
+
+        upload_part_copy = self.promote()
+
+        upload_part_copy.assert_not_called()
+        self.assertEqual(self.s3_facade.get_object(USER_ID, 'b.txt')[0], self.content)
+
+
+class BlobRefCountTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.s3_facade.create_bucket_for_user('2')
+        self.file_hash = StorageFacade.create_file_hash(b'content')
+        self.original_key = f'{self.bucket_name}/a.txt'
+        self.link_doc_id = f"{self.s3_facade.generate_bucket_name('2')}/b.txt"
+        self.s3_facade.upload_file(USER_ID, 'a.txt', b'content', {'content-hash': self.file_hash})
+        self.s3_facade.upload_file('2', 'b.txt', b'', StorageFacade._link_metadata(self.original_key,
+                                                                                   file_hash=self.file_hash))
+        self.es_facade.get_document.return_value = {'total_size': 7, 'stored_size': 7, 'file_count': 1}
+        scan_patch = mock.patch('storage.storage_utils.helpers.scan', return_value=[
+            {'_id': self.link_doc_id, '_source': {'original_key': self.original_key}}
+        ])
+        scan_patch.start()
+        self.addCleanup(scan_patch.stop)
+
+    def released_hashes(self):
+        return [call.args[1] for call in self.es_facade.script_update_document.call_args_list
+                if call.args[2]['source'] == StorageFacade.blob_release_script]
+
+    def test_deleting_a_link_releases_one_reference(self):
+        self.es_facade.script_update_document.return_value = ('updated', None)
+
+        self.storage_facade.delete_object('2', 'b.txt')
+
+        self.assertEqual(self.released_hashes(), [self.file_hash])
+        self.assertEqual(self.s3_facade.get_object(USER_ID, 'a.txt')[0], b'content')
+
+    def test_last_reference_deletes_the_content_without_looking_for_links(self):
+        self.es_facade.script_update_document.return_value = ('deleted', None)
+
+        with mock.patch.object(self.storage_facade, '_find_links') as find_links:
+            self.storage_facade.delete_object(USER_ID, 'a.txt')
+
+        find_links.assert_not_called()
+        self.assertEqual(self.list_keys(), [])
+
+    def test_referenced_content_moves_to_a_link_before_the_original_goes(self):
+        self.es_facade.script_update_document.return_value = ('updated', None)
+
+        self.storage_facade.delete_object(USER_ID, 'a.txt')
+
+        self.assertEqual(self.list_keys(), [])
+        self.assertEqual(self.s3_facade.get_object('2', 'b.txt')[0], b'content')
+        self.es_facade.update_document.assert_any_call(self.storage_facade.blob_index, self.file_hash,
+                                                       {'original_key': self.link_doc_id})
+
+
+class ChunkRefCountTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.s3_facade.create_chunk_bucket()
+        self.es_facade.get_documents.return_value = {}
+        self.chunk_refs, _ = self.storage_facade.store_chunks([b'one', b'two', b'one'])
+        self.chunk_hashes = [chunk_ref['hash'] for chunk_ref in self.chunk_refs]
+        self.file_hash = StorageFacade.create_file_hash(b'onetwoone')
+
+    def chunk_scripts(self, script):
+        return [call.args[1] for call in self.es_facade.bulk_script_update_documents.call_args_list
+                if next(iter(call.args[1].values()))['source'] == script]
+
+    def store_manifest(self):
+        with mock.patch.object(self.storage_facade, '_store_original', return_value=None):
+            self.storage_facade._store_chunk_manifest(USER_ID, 'a.bin', self.file_hash, 9, self.chunk_refs, 6)
+
+    def test_new_chunks_are_stored_unreferenced(self):
+        [indexed_call] = self.es_facade.bulk_index_documents.call_args_list
+        self.assertEqual(indexed_call.kwargs['op_type'], 'create')
+        self.assertEqual({doc['body']['ref_count'] for doc in indexed_call.args[1]}, {0})
+
+    def test_manifest_takes_its_chunk_references_before_it_is_uploaded(self):
+        one, two = self.chunk_hashes[:2]
+        self.es_facade.bulk_script_update_documents.return_value = {one: 'updated', two: 'updated'}
+
+        self.store_manifest()
+
+        [acquired] = self.chunk_scripts(StorageFacade.chunk_acquire_script)
+        self.assertEqual({chunk_hash: script['params']['count'] for chunk_hash, script in acquired.items()},
+                         {one: 2, two: 1})
+        self.assertEqual(self.list_keys(), ['a.bin'])
+
+    def test_collected_chunk_fails_the_upload_and_releases_the_others(self):
+        one, two = self.chunk_hashes[:2]
+        self.es_facade.bulk_script_update_documents.return_value = {one: 'updated', two: 'noop'}
+
+        with self.assertRaisesMessage(Exception, "chunks were collected"):
+            self.store_manifest()
+
+        [released] = self.chunk_scripts(StorageFacade.chunk_release_script)
+        self.assertEqual(list(released), [one])
+        self.assertEqual(released[one]['params']['count'], 2)
+        self.assertEqual(self.list_keys(), [])
+
+    def test_deleting_the_last_manifest_releases_its_chunks(self):
+        one, two = self.chunk_hashes[:2]
+        self.es_facade.bulk_script_update_documents.return_value = {one: 'updated', two: 'updated'}
+        self.store_manifest()
+        self.es_facade.bulk_script_update_documents.reset_mock()
+        self.es_facade.script_update_document.return_value = ('deleted', None)
+        self.es_facade.get_document.return_value = {'total_size': 9, 'stored_size': 6, 'file_count': 1}
+
+        self.storage_facade.delete_object(USER_ID, 'a.bin')
+
+        [released] = self.chunk_scripts(StorageFacade.chunk_release_script)
+        self.assertEqual({chunk_hash: script['params']['count'] for chunk_hash, script in released.items()},
+                         {one: 2, two: 1})
+        self.assertEqual(self.list_keys(), [])
+
+    def test_collection_marks_unreferenced_chunks_before_deleting_them(self):
+        one, two = self.chunk_hashes[:2]
+        self.es_facade.search.return_value = self.search_response([
+            {'_id': one, '_source': {'ref_count': 0}},
+            {'_id': two, '_source': {'ref_count': 0}}
+        ])
+        # The second chunk was acquired again between the search and the mark.
+        self.es_facade.bulk_script_update_documents.return_value = {one: 'updated', two: 'noop'}
+
+        self.assertEqual(self.storage_facade.collect_chunks(), 1)
+
+        [marked] = self.chunk_scripts(StorageFacade.chunk_tombstone_script)
+        self.assertEqual(set(marked), {one, two})
+        self.es_facade.bulk_delete_documents.assert_called_once_with(self.storage_facade.chunk_index, [one])
+        chunk_keys = [item['Key'] for item in self.s3_facade.s3_client.list_objects_v2(
+            Bucket=self.s3_facade.chunk_bucket_name).get('Contents', [])]
+        self.assertEqual(chunk_keys, [self.s3_facade.generate_chunk_key(two)])
+
+
+class FolderDeleteResumeTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade.delete_batch_size = 2
+        self.file_hash = StorageFacade.create_file_hash(b'content')
+        self.paths = [f'docs/{number}.txt' for number in range(4)]
+        for file_path in self.paths:
+            self.storage_facade.s3_facade.upload_file(USER_ID, file_path, b'', StorageFacade._link_metadata(
+                'user-2-bucket/a.txt', file_hash=self.file_hash))
+        self.es_facade.get_documents.side_effect = lambda index_name, doc_ids: {
+            doc_id: {'hash': self.file_hash, 'original_key': 'user-2-bucket/a.txt'} for doc_id in doc_ids
+        }
+        self.es_facade.bulk_script_update_and_delete_documents.return_value = {self.file_hash: 'updated'}
+
+    def test_links_are_released_in_the_request_that_deletes_their_entries(self):
+        list(self.storage_facade.iter_delete_folder(USER_ID, 'docs'))
+
+        first_page = self.es_facade.bulk_script_update_and_delete_documents.call_args_list[0]
+        blob_index, scripts, index_name, doc_ids = first_page.args
+        self.assertEqual((blob_index, index_name), (self.storage_facade.blob_index,
+                                                    self.storage_facade.file_hash_index))
+        self.assertEqual(scripts[self.file_hash]['params']['count'], 2)
+        self.assertEqual(doc_ids, [f'{self.bucket_name}/{file_path}' for file_path in self.paths[:2]])
+        self.es_facade.bulk_script_update_documents.assert_not_called()
+
+    def test_saved_progress_resumes_after_the_last_page(self):
+        first_run = self.storage_facade.iter_delete_folder(USER_ID, 'docs')
+        saved_progress = dict(next(first_run))
+        first_run.close()
+        self.assertEqual((saved_progress['phase'], saved_progress['cursor']), ('links', 'docs/1.txt'))
+        self.es_facade.get_documents.reset_mock()
+
+        for progress in self.storage_facade.iter_delete_folder(USER_ID, 'docs', saved_progress):
+            pass
+
+        self.assertEqual(progress['phase'], 'done')
+        self.assertEqual((progress['processed_count'], progress['deleted_count']), (4, 4))
+        self.assertEqual(self.list_keys(), [])
+        [resumed_call] = self.es_facade.get_documents.call_args_list
+        self.assertEqual(resumed_call.args[1], [f'{self.bucket_name}/{file_path}' for file_path in self.paths[2:]])
+
+    def test_every_saved_page_revalidates_cached_listings(self):
+        self.es_facade.index_document.return_value = (1, 1)
+        saves_before_bump = []
+        UserStorageState.bump.side_effect = lambda user_id: saves_before_bump.append(
+            self.es_facade.index_document.call_count)
+        job_facade = FolderDeleteJobFacade(self.storage_facade, workers=0)
+        job = {'user_id': USER_ID, 'folder_path': 'docs', 'status': 'queued', 'phase': 'links', 'cursor': None,
+               'processed_count': 0, 'deleted_count': 0, 'failed_count': 0, 'result': None}
+
+        self.assertTrue(job_facade._run('job-1', job, 0, 1))
+
+        self.assertEqual(job['status'], 'completed')
+        # The first save marks the job running; every later one, page or final, is followed by a bump.
+        saves = self.es_facade.index_document.call_count
+        self.assertGreater(saves, 3)
+        self.assertLessEqual(set(range(2, saves + 1)), set(saves_before_bump))
+
+
+class FolderDeleteBatchTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade.delete_batch_size = 2
+        self.file_hash = StorageFacade.create_file_hash(b'content')
+        self.paths = [f'docs/{number}.txt' for number in range(5)]
+        for file_path in self.paths:
+            self.storage_facade.s3_facade.upload_file(USER_ID, file_path, b'', StorageFacade._link_metadata(
+                'user-2-bucket/a.txt', file_hash=self.file_hash))
+        self.es_facade.get_documents.side_effect = lambda index_name, doc_ids: {
+            doc_id: {'hash': self.file_hash, 'original_key': 'user-2-bucket/a.txt'} for doc_id in doc_ids
+        }
+        self.es_facade.bulk_script_update_and_delete_documents.return_value = {self.file_hash: 'updated'}
+        self.es_facade.script_update_document.side_effect = self.script_results(('updated', None))
+        s3_client = self.storage_facade.s3_facade.s3_client
+        self.real_delete_objects = s3_client.delete_objects
+        delete_patch = mock.patch.object(s3_client, 'delete_objects', wraps=self.real_delete_objects)
+        self.delete_objects = delete_patch.start()
+        self.addCleanup(delete_patch.stop)
+
+    def released_pages(self):
+        return [(call.args[3], call.args[1][self.file_hash]['params']['count'])
+                for call in self.es_facade.bulk_script_update_and_delete_documents.call_args_list]
+
+    def doc_ids(self, file_paths):
+        return [f'{self.bucket_name}/{file_path}' for file_path in file_paths]
+
+    def test_links_are_deleted_with_one_request_per_page(self):
+        self.storage_facade.delete_folder(USER_ID, 'docs')
+
+        self.assertEqual(self.list_keys(), [])
+        self.assertEqual([[item['Key'] for item in call.kwargs['Delete']['Objects']]
+                          for call in self.delete_objects.call_args_list],
+                         [self.paths[:2], self.paths[2:4], self.paths[4:]])
+        self.assertEqual(self.released_pages(), [(self.doc_ids(self.paths[:2]), 2),
+                                                 (self.doc_ids(self.paths[2:4]), 2),
+                                                 (self.doc_ids(self.paths[4:]), 1)])
+        usage_change = self.es_facade.script_update_document.call_args_list[-1].args[2]['params']
+        self.assertEqual(usage_change['file_count_change'], -1)
+
+    def test_keys_the_batch_could_not_delete_are_counted_as_failed(self):
+        def delete_objects(Bucket, Delete):
+            kept = [item for item in Delete['Objects'] if item['Key'] != 'docs/2.txt']
+            response = self.real_delete_objects(Bucket=Bucket, Delete={**Delete, 'Objects': kept}) if kept else {}
+            if len(kept) < len(Delete['Objects']):
+                response['Errors'] = [{'Key': 'docs/2.txt', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+            return response
+        self.delete_objects.side_effect = delete_objects
+
+        for progress in self.storage_facade.iter_delete_folder(USER_ID, 'docs'):
+            pass
+
+        self.assertEqual((progress['processed_count'], progress['deleted_count'], progress['failed_count']),
+                         (5, 4, 1))
+        self.assertEqual(self.list_keys(), ['docs/2.txt'])
+        self.assertEqual(self.released_pages(), [(self.doc_ids(self.paths[:2]), 2),
+                                                 (self.doc_ids(self.paths[3:4]), 1),
+                                                 (self.doc_ids(self.paths[4:]), 1)])
+        with self.assertRaisesMessage(Exception, "1 objects in folder docs could not be deleted."):
+            self.storage_facade.delete_folder(USER_ID, 'docs')
+
+
+class ReconcileTests(StorageFacadeTestCase):
+    """Objects a, b and c against entries a, c and d: b has no entry, d no object and c's original is gone."""
+
+    content_hash = StorageFacade.create_file_hash(b'content')
+
+    def setUp(self):
+        super().setUp()
+        s3_facade = self.storage_facade.s3_facade
+        s3_facade.upload_file(USER_ID, 'a.txt', b'content', {'content-hash': self.content_hash})
+        s3_facade.upload_file(USER_ID, 'b.txt', b'other', {'content-hash': 'b' * 64})
+        s3_facade.upload_file(USER_ID, 'c.txt', b'', StorageFacade._link_metadata(
+            self.doc_id('gone.txt'), file_hash=self.content_hash))
+        self.es_facade.iter_point_in_time.return_value = [[
+            self.hit('a.txt', size=7),
+            self.hit('c.txt', original_key=self.doc_id('gone.txt')),
+        ], [
+            self.hit('d.txt', hash='d' * 64, size=3)
+        ]]
+        self.es_facade.get_documents.return_value = {}
+        self.es_facade.es_client.count.return_value = {'count': 0}
+        self.es_facade.script_update_document.side_effect = self.script_results(('not_found', None))
+        self.recorded_usage = {'total_size': 100, 'stored_size': 100, 'file_count': 9}
+        self.es_facade.get_document.side_effect = lambda index_name, doc_id: (
+            self.recorded_usage if index_name == self.storage_facade.user_usage_index
+            else {'original_key': self.doc_id('a.txt')}
+        )
+
+    def doc_id(self, file_path):
+        return f'{self.bucket_name}/{file_path}'
+
+    def hit(self, file_path, original_key=None, **fields):
+        return {'_id': self.doc_id(file_path), '_source': {
+            'object_key': file_path, 'hash': self.content_hash, 'original_key': original_key or self.doc_id(file_path),
+            'size': 0, 'creation_date': 0, **fields
+        }}
+
+    def reconcile(self, dry_run):
+        return ReconcileFacade(self.storage_facade, dry_run=dry_run, grace=0).reconcile_user(USER_ID)
+
+    def test_dry_run_reports_every_kind_of_drift(self):
+        report = self.reconcile(dry_run=True)
+
+        self.assertEqual((report['objects_count'], report['entries_count']), (3, 3))
+        self.assertEqual(report['missing_entries'], ['b.txt'])
+        self.assertEqual(report['orphans'], ['d.txt'])
+        self.assertEqual(report['broken_links'], ['c.txt'])
+        self.assertEqual(report['usage'], {'recorded': self.recorded_usage,
+                                           'actual': {'total_size': 7, 'stored_size': 7, 'file_count': 2}})
+        self.es_facade.update_document.assert_not_called()
+        self.es_facade.bulk_script_update_and_delete_documents.assert_not_called()
+        self.assertEqual(self.storage_facade.s3_facade.stat_object(USER_ID, 'c.txt')['metadata']['original-key'],
+                         self.doc_id('gone.txt'))
+
+    def test_repair_indexes_removes_and_repoints(self):
+        report = self.reconcile(dry_run=False)
+
+        self.assertEqual(report['counts']['repaired'], 3)
+        indexed = [call.args for call in self.es_facade.index_document.call_args_list]
+        self.assertIn(self.doc_id('b.txt'), [args[1] for args in indexed])
+        orphans_call = self.es_facade.bulk_script_update_and_delete_documents.call_args
+        self.assertEqual(orphans_call.args[3], [self.doc_id('d.txt')])
+        self.assertEqual(orphans_call.args[1]['d' * 64]['params']['count'], 1)
+        self.assertEqual(self.storage_facade.s3_facade.stat_object(USER_ID, 'c.txt')['metadata']['original-key'],
+                         self.doc_id('a.txt'))
+        self.es_facade.update_document.assert_any_call(self.storage_facade.file_hash_index, self.doc_id('c.txt'),
+                                                       {'original_key': self.doc_id('a.txt')})
+        self.es_facade.update_document.assert_any_call(self.storage_facade.user_usage_index, USER_ID,
+                                                       {'total_size': 12, 'stored_size': 12, 'file_count': 3})
+
+    def test_usage_is_left_alone_while_writes_are_in_flight(self):
+        self.es_facade.es_client.count.return_value = {'count': 1}
+
+        report = self.reconcile(dry_run=False)
+
+        self.assertIsNone(report['usage'])
+        usage_updates = [call for call in self.es_facade.update_document.call_args_list
+                         if call.args[0] == self.storage_facade.user_usage_index]
+        self.assertEqual(usage_updates, [])
+
+
+class ParseByteRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(views.parse_byte_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(views.parse_byte_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(views.parse_byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(views.parse_byte_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(views.parse_byte_range('bytes=500-5000', 1000), (500, 999))
+
+    def test_ignored_headers(self):
+        self.assertIsNone(views.parse_byte_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(views.parse_byte_range('bytes=-', 1000))
+        self.assertIsNone(views.parse_byte_range('items=0-1', 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for range_header in ('bytes=1000-', 'bytes=5-2', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                views.parse_byte_range(range_header, 1000)
+
+
+class ChunkedBody(BytesIO):
+    """An S3 streaming body over in-memory bytes."""
+
+    def iter_chunks(self, chunk_size):
+        return iter(lambda: self.read(chunk_size), b'')
+
+
+class CompressionTests(SimpleTestCase):
+    content = b'{"name": "value", "items": [1, 2, 3]}\n' * 2000
+
+    def test_compressed_content_round_trips_with_each_codec(self):
+        for codec in (CODEC_ZSTD, CODEC_GZIP):
+            compressed = compress(self.content, codec, 3)
+
+            self.assertLess(len(compressed), len(self.content))
+            self.assertEqual(b''.join(iter_decompressed(ChunkedBody(compressed), codec, block_size=1000)),
+                             self.content)
+
+    def test_compressibility_is_judged_by_extension_type_then_content(self):
+        self.assertTrue(is_compressible('data/report.csv', b'\x00binary'))
+        self.assertFalse(is_compressible('photo.png', b'plain text'))
+        self.assertTrue(is_compressible('README', b'plain text'))
+        self.assertFalse(is_compressible('blob', b'\x00\x01\x02'))
+        # A multi-byte character cut off by the sniffed sample still counts as text.
+        self.assertTrue(is_compressible('notes', 'é'.encode() * (SNIFF_SIZE // 2) + b'\xc3'))
+
+    @override_settings(STORAGE_COMPRESSION_ENABLED=True, STORAGE_COMPRESSION_MIN_SIZE=1024)
+    def test_only_content_worth_compressing_is_stored_compressed(self):
+        with mock.patch('storage.storage_utils.ESFacade'):
+            storage_facade = StorageFacade()
+
+        body, metadata = storage_facade._prepare_content('a.json', self.content, 'f' * 64)
+        self.assertEqual(metadata['logical-size'], str(len(self.content)))
+        self.assertEqual(b''.join(iter_decompressed(ChunkedBody(body), metadata['codec'])), self.content)
+
+        for file_path, content in (('small.json', b'{}'), ('random.txt', random.Random(0).randbytes(4096))):
+            body, metadata = storage_facade._prepare_content(file_path, content, 'f' * 64)
+            self.assertEqual((body, metadata), (content, {'content-hash': 'f' * 64}))
+
+
+class ZipStreamWriterTests(SimpleTestCase):
+    contents = {'one': [b'first ', b'content'], 'two': [b'second content']}
+
+    def archive(self, entries, open_source):
+        writer = ZipStreamWriter(open_source, prefetch_depth=2, queue_blocks=1)
+        return zipfile.ZipFile(BytesIO(b''.join(writer.iter_archive(entries))))
+
+    def test_shared_content_is_fetched_once(self):
+        opened = []
+
+        def open_source(source):
+            opened.append(source)
+            return iter(self.contents[source])
+
+        modified = datetime(2024, 5, 1, 12, 30)
+        archive = self.archive([
+            ZipEntry('a.txt', 'one', 13, modified, 'one'),
+            ZipEntry('b.txt', 'two', 14, modified, 'two'),
+            ZipEntry('copy/a.txt', 'one', 13, modified, 'one')
+        ], open_source)
+
+        self.assertEqual(archive.namelist(), ['a.txt', 'b.txt', 'copy/a.txt'])
+        self.assertEqual(archive.read('copy/a.txt'), b'first content')
+        self.assertEqual(archive.read('b.txt'), b'second content')
+        self.assertEqual(archive.getinfo('a.txt').date_time, (2024, 5, 1, 12, 30, 0))
+        self.assertEqual(sorted(opened), ['one', 'two'])
+
+    def test_fetch_error_stops_the_archive(self):
+        def open_source(source):
+            raise IOError(f"{source} unavailable")
+
+        with self.assertRaisesMessage(IOError, "one unavailable"):
+            self.archive([ZipEntry('a.txt', 'one', 13, None, 'one')], open_source)
+
+
+class MoveEntriesTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3_facade = self.storage_facade.s3_facade
+        self.entries = []
+        for name in ('a.txt', 'b.txt'):
+            self.s3_facade.upload_file(USER_ID, f'src/{name}', name.encode())
+            doc_id = f'{self.bucket_name}/src/{name}'
+            self.entries.append((doc_id, {'key': f'src/{name}', 'size': 5},
+                                 {'hash': name, 'original_key': doc_id, 'folder_path': 'src', 'filename': name}))
+        self.es_facade.get_documents.return_value = {}
+        scan_patch = mock.patch('storage.storage_utils.helpers.scan', return_value=[])
+        scan_patch.start()
+        self.addCleanup(scan_patch.stop)
+
+    def move(self):
+        return self.storage_facade._move_entries(USER_ID, self.entries, lambda key: f"dst/{key[len('src/'):]}")
+
+    def test_move_indexes_copies_before_removing_sources(self):
+        calls = []
+        self.es_facade.bulk_index_documents.side_effect = lambda *args: calls.append(('index', self.list_keys()))
+
+        self.assertEqual(self.move(), (2, 0))
+
+        self.assertEqual(calls, [('index', ['dst/a.txt', 'dst/b.txt', 'src/a.txt', 'src/b.txt'])])
+        self.assertEqual(self.list_keys(), ['dst/a.txt', 'dst/b.txt'])
+        [new_documents] = [call.args[1] for call in self.es_facade.bulk_index_documents.call_args_list]
+        self.assertEqual([document['body']['original_key'] for document in new_documents],
+                         [f'{self.bucket_name}/dst/a.txt', f'{self.bucket_name}/dst/b.txt'])
+        self.es_facade.bulk_delete_documents.assert_called_once_with(
+            self.storage_facade.file_hash_index, [doc_id for doc_id, _, _ in self.entries], refresh='wait_for'
+        )
+
+    def test_failed_index_write_drops_copies_and_keeps_sources(self):
+        self.es_facade.bulk_index_documents.side_effect = Exception("index unavailable")
+
+        self.assertEqual(self.move(), (0, 2))
+
+        self.assertEqual(self.list_keys(), ['src/a.txt', 'src/b.txt'])
+        self.es_facade.bulk_delete_documents.assert_called_once_with(
+            self.storage_facade.file_hash_index, [f'{self.bucket_name}/dst/a.txt', f'{self.bucket_name}/dst/b.txt']
+        )
+
+    def test_failed_repoint_is_undone(self):
+        with mock.patch.object(self.storage_facade, '_repoint_moved_originals',
+                               side_effect=[Exception("link rewrite failed"), None]) as repoint:
+            self.assertEqual(self.move(), (0, 2))
+
+        undo_mapping = repoint.call_args_list[1].args[0]
+        self.assertEqual(undo_mapping[f'{self.bucket_name}/dst/a.txt'][0], f'{self.bucket_name}/src/a.txt')
+        self.assertEqual(self.list_keys(), ['src/a.txt', 'src/b.txt'])
+
+
+class GenerationBumpTests(StorageFacadeTestCase):
+    def test_generation_moves_only_after_the_entry_is_searchable(self):
+        written_before_bump = []
+        with mock.patch('storage.storage_utils.UserStorageState.bump',
+                        side_effect=lambda user_id: written_before_bump.append(
+                            (self.es_facade.index_document.called,
+                             self.es_facade.script_update_document.called))):
+            self.es_facade.script_update_document.return_value = ('updated', None)
+            self.storage_facade._record_file(USER_ID, 'a.txt', 'f' * 64, 7, None)
+
+        self.assertEqual(written_before_bump, [(True, False), (True, True)])
+        self.assertEqual(self.es_facade.index_document.call_args.kwargs['refresh'], 'wait_for')
+
+
+class DerivativeRetryTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade.derivatives_enabled = True
+        self.storage_facade.task_queue = mock.Mock()
+        kind_patch = mock.patch('storage.storage_utils.source_kind', return_value='image')
+        kind_patch.start()
+        self.addCleanup(kind_patch.stop)
+        self.file_hash = StorageFacade.create_file_hash(b'image')
+        self.storage_facade.s3_facade.upload_file(USER_ID, 'a.png', b'image', {'content-hash': self.file_hash})
+
+    def now(self):
+        return int(datetime.now().timestamp() * 1000)
+
+    def test_first_copy_claims_the_derivatives(self):
+        self.es_facade.create_document.return_value = True
+
+        self.storage_facade._request_derivatives(USER_ID, 'a.png', self.file_hash)
+
+        self.es_facade.script_update_document.assert_not_called()
+        self.storage_facade.task_queue.enqueue.assert_called_once()
+
+    def test_failed_claim_is_queued_again_once_reclaimed(self):
+        self.es_facade.create_document.return_value = False
+        self.es_facade.script_update_document.return_value = ('updated', None)
+
+        self.storage_facade._request_derivatives(USER_ID, 'a.png', self.file_hash)
+
+        script = self.es_facade.script_update_document.call_args.args[2]
+        self.assertEqual(script['source'], StorageFacade.derivative_reclaim_script)
+        self.assertEqual(script['params']['source_key'], f'{self.bucket_name}/a.png')
+        self.storage_facade.task_queue.enqueue.assert_called_once()
+
+    def test_claim_still_waiting_is_not_queued(self):
+        self.es_facade.create_document.return_value = False
+        self.es_facade.script_update_document.return_value = ('noop', None)
+
+        self.storage_facade._request_derivatives(USER_ID, 'a.png', self.file_hash)
+
+        self.storage_facade.task_queue.enqueue.assert_not_called()
+
+    def test_view_requests_failed_derivatives_only_after_their_wait(self):
+        for retry_after, requested in ((self.now() + 60_000, False), (self.now() - 1, True)):
+            self.es_facade.get_documents.return_value = {self.file_hash: {
+                'status': 'failed', 'variants': {}, 'retry_after': retry_after
+            }}
+            with mock.patch.object(self.storage_facade, '_request_derivatives') as request_derivatives:
+                self.assertIsNone(self.storage_facade.derivative_link(USER_ID, 'a.png', 'thumbnail'))
+
+            self.assertEqual(request_derivatives.called, requested)
+
+
+class ListFolderTests(StorageFacadeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage_facade.s3_facade.upload_file(USER_ID, 'docs/a.txt', b'content')
+
+    def test_unreadable_index_token_lists_the_first_page(self):
+        self.storage_facade.browse_from_index = True
+        self.storage_facade.browse_consistent = False
+        self.es_facade.search.return_value = {
+            'hits': {'hits': [{'_source': {'filename': 'a.txt', 'size': 7}, 'sort': ['a.txt']}]},
+            'aggregations': {'subfolders': {'below': {'names': {'buckets': [{'key': 'sub'}]}}}}
+        }
+
+        for page_token in ('index:not-base64!', 'index:' + 'bm90IGpzb24=', 'index:NQ=='):
+            folder_page = self.storage_facade.list_folder(USER_ID, 'docs', 10, page_token)
+
+            body = self.es_facade.search.call_args.args[1]
+            self.assertNotIn('search_after', body)
+            self.assertEqual([item['name'] for item in folder_page['items']], ['sub', 'a.txt'])
+
+    def test_rejected_s3_token_lists_the_first_page(self):
+        self.storage_facade.browse_from_index = False
+        list_folder_page = self.storage_facade.s3_facade.list_folder_page
+        rejected = ClientError({'Error': {'Code': 'InvalidArgument', 'Message': 'bad token'}}, 'ListObjectsV2')
+
+        with mock.patch.object(self.storage_facade.s3_facade, 'list_folder_page',
+                               side_effect=[rejected, list_folder_page(USER_ID, 'docs')]):
+            folder_page = self.storage_facade.list_folder(USER_ID, 'docs', 10, 'stale-token')
+
+        self.assertEqual(folder_page['items'], [{'name': 'a.txt', 'type': 'file', 'size': 7}])
+
+    def upload_folder_entries(self):
+        for name in ('b.txt', 'c.txt', 'd.txt', 'e.txt', 'sub/x.txt'):
+            self.storage_facade.s3_facade.upload_file(USER_ID, f'docs/{name}', b'content')
+        return ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt', 'sub']
+
+    def test_s3_pages_follow_continuation_tokens(self):
+        self.storage_facade.browse_from_index = False
+        names = self.upload_folder_entries()
+
+        listed, page_token, pages = [], None, 0
+        while True:
+            folder_page = self.storage_facade.list_folder(USER_ID, 'docs', 2, page_token)
+            self.assertLessEqual(len(folder_page['items']), 2)
+            listed.extend(item['name'] for item in folder_page['items'])
+            pages += 1
+            page_token = folder_page['next_token']
+            if page_token is None:
+                break
+
+        self.assertEqual(sorted(listed), names)
+        self.assertEqual(pages, 3)
+
+    def test_folder_contents_are_listed_lazily(self):
+        s3_facade = self.storage_facade.s3_facade
+        names = self.upload_folder_entries()
+
+        with mock.patch.object(s3_facade.s3_client, 'list_objects_v2',
+                               wraps=s3_facade.s3_client.list_objects_v2) as list_objects:
+            contents = s3_facade.iter_folder_contents(USER_ID, 'docs', only_name=True, page_size=2)
+            first_name = next(contents)
+            self.assertEqual(list_objects.call_count, 1)
+            self.assertEqual(sorted([first_name, *contents]), [*names[:-1], 'sub/'])
+            self.assertEqual(list_objects.call_count, 3)
+            self.assertEqual(list_objects.call_args.kwargs['MaxKeys'], 2)
+
+        self.assertEqual(sorted(item['name'] for item in s3_facade.list_folder_contents(USER_ID, 'docs')), names)
+
+    def test_s3_errors_are_reported_as_listing_errors(self):
+        self.storage_facade.browse_from_index = False
+
+        with self.assertRaisesMessage(Exception, "Error listing folder docs"):
+            self.storage_facade.list_folder('2', 'docs', 10)
+
+
+class UsageUpdateTests(StorageFacadeTestCase):
+    def test_usage_changes_are_scripted_increments(self):
+        self.es_facade.script_update_document.return_value = ('updated', None)
+
+        self.storage_facade._update_user_usage(USER_ID, -7, file_count_change=-1, stored_size_change=-3)
+
+        index_name, user_id, script = self.es_facade.script_update_document.call_args.args
+        self.assertEqual((index_name, user_id), (self.storage_facade.user_usage_index, USER_ID))
+        self.assertEqual(script['params'], {'size_change': -7, 'stored_size_change': -3, 'file_count_change': -1})
+        self.assertEqual(self.es_facade.script_update_document.call_args.kwargs['retry_on_conflict'], 5)
+        self.es_facade.get_document.assert_not_called()
+        self.es_facade.update_document.assert_not_called()
+
+    def test_missing_usage_record_is_reported(self):
+        self.es_facade.script_update_document.return_value = ('not_found', None)
+
+        with self.assertRaisesMessage(Exception, "no usage record exists"):
+            self.storage_facade._update_user_usage(USER_ID, 7)
+
+
+class TaskQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.es_facade = mock.Mock()
+        self.task_queue = TaskQueueFacade(self.es_facade)
+
+    def test_claiming_by_key_takes_over_abandoned_claims(self):
+        self.es_facade.update_by_query.return_value = 0
+
+        self.task_queue.claim_batch('finalize_object', 10, keys=['a'])
+
+        query = self.es_facade.update_by_query.call_args.args[1]
+        [status_filter] = [clause for clause in query['bool']['filter'] if 'bool' in clause]
+        self.assertEqual(status_filter['bool']['should'][0], {'term': {'status': 'queued'}})
+        self.assertIn({'term': {'status': 'processing'}}, status_filter['bool']['should'][1]['bool']['filter'])
+
+    @override_settings(TASK_FENCE_TIMEOUT=0)
+    def test_waiting_for_claimed_tasks_gives_up_after_the_fence_timeout(self):
+        self.task_queue = TaskQueueFacade(self.es_facade)
+        self.es_facade.es_client.count.return_value = {'count': 1}
+
+        self.assertFalse(self.task_queue.wait_for_claimed('finalize_object', ['a']))
+
+    def test_waiting_for_claimed_tasks_returns_once_they_finish(self):
+        self.es_facade.es_client.count.side_effect = [{'count': 1}, {'count': 0}]
+
+        self.assertTrue(self.task_queue.wait_for_claimed('finalize_object', ['a'], poll_interval=0))
+        self.assertEqual(self.es_facade.es_client.count.call_count, 2)
+
+
+class ESFacadeBulkTests(SimpleTestCase):
+    def test_failed_items_are_logged_and_raised(self):
+        es_facade = ESFacade()
+        failed_item = {'delete': {'_id': 'a', 'status': 404, 'result': 'not_found'}}
+        bulk_error = helpers.BulkIndexError('1 document(s) failed to index.', [failed_item])
+
+        with mock.patch('storage.es_utils.helpers.bulk', side_effect=bulk_error), \
+                mock.patch('storage.es_utils.error_logger') as error_logger:
+            with self.assertRaises(helpers.BulkIndexError):
+                es_facade.bulk_delete_documents('files', ['a'])
+
+        [logged] = error_logger.error.call_args.args
+        self.assertEqual(logged['context']['errors'], [failed_item])
+
+
+class FolderListingCacheTests(SimpleTestCase):
+    def test_per_process_cache_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            FolderListingCache('default', ttl=30, stale_ttl=300)
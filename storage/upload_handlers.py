@@ -0,0 +1,217 @@
+import hashlib
+import logging
+import os
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from storage.chunking import ChunkedObjectWriter
+
+audit_logger = logging.getLogger('audit_logger')
+error_logger = logging.getLogger('error_logger')
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    An uploaded file whose content was streamed straight to S3 and is not kept in the worker.
+
+    Streaming only stages the content; nothing shows up in the user's storage until save() is called, which the
+    view does once the request has passed its CSRF check. A file that is never saved is dropped with discard().
+    """
+
+    def __init__(self, name, content_type, size, charset, file_hash, file_path, storage_facade, user_id,
+                 content=None, upload_id=None, parts=None, chunk_refs=None, stored_size=0, read_your_writes=False):
+        super().__init__(file=None, name=name, content_type=content_type, size=size, charset=charset)
+        self.file_hash = file_hash
+        self.file_path = file_path
+        self.storage_facade = storage_facade
+        self.user_id = user_id
+        self.content = content
+        self.upload_id = upload_id
+        self.parts = parts
+        self.chunk_refs = chunk_refs
+        self.stored_size = stored_size
+        self.read_your_writes = read_your_writes
+        self.result = None
+
+    def save(self):
+        if self.result is not None:
+            return self.result
+
+        if self.chunk_refs is not None:
+            result = self.storage_facade.create_chunked_object(self.user_id, self.file_path, self.file_hash,
+                                                               self.size, self.chunk_refs, self.stored_size,
+                                                               read_your_writes=self.read_your_writes)
+        elif self.upload_id is None:
+            result = self.storage_facade.create_object(self.user_id, self.file_path, self.content,
+                                                       file_hash=self.file_hash,
+                                                       read_your_writes=self.read_your_writes)
+        else:
+            result = self.storage_facade.complete_multipart_object(self.user_id, self.file_path, self.upload_id,
+                                                                   self.parts, self.file_hash, self.size,
+                                                                   read_your_writes=self.read_your_writes)
+        self.result = result
+        self.content, self.upload_id, self.parts, self.chunk_refs = None, None, None, None
+        return result
+
+    def discard(self):
+        """Aborts the staged multipart upload of a file that was not saved; collect_chunks removes its stored chunks."""
+        upload_id, self.upload_id = self.upload_id, None
+        self.content, self.parts, self.chunk_refs = None, None, None
+        if upload_id is None:
+            return
+        try:
+            self.storage_facade.s3_facade.abort_multipart_upload(self.user_id, self.file_path, upload_id)
+        except Exception as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error aborting unsaved upload of {self.file_path}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": self.user_id, "file_path": self.file_path, "upload_id": upload_id}
+            })
+
+    def open(self, mode=None):
+        raise ValueError("Streamed uploads have no local content to open.")
+
+    def close(self):
+        pass
+
+
+class S3StreamingUploadHandler(FileUploadHandler):
+    """
+    Streams every uploaded file into the user's bucket while the request body is still arriving.
+
+    The SHA-256 hash is updated chunk by chunk and the content is buffered only up to one
+    multipart part, so peak memory stays at S3_MULTIPART_CHUNK_SIZE regardless of the file size.
+    Files smaller than one part never start a multipart upload and go through create_object.
+    In chunked storage mode, files past STORAGE_CHUNKED_MIN_FILE_SIZE are fed to the chunker instead; the
+    threshold is capped at one part here, so that mode buffers no more than the multipart path does.
+
+    The handler runs while the request body is parsed, which is before any CSRF check, so it never completes
+    an upload: each file is handed over as an unsaved StreamedUploadedFile that the view saves or discards.
+    """
+
+    def __init__(self, request, storage_facade, user_id, folder_path='', read_your_writes=False):
+        super().__init__(request)
+        self.read_your_writes = read_your_writes
+        self.storage_facade = storage_facade
+        self.s3_facade = storage_facade.s3_facade
+        self.user_id = user_id
+        self.folder_path = folder_path
+        self.part_size = settings.S3_MULTIPART_CHUNK_SIZE
+        self.chunked_mode = storage_facade.chunked_mode
+        self.chunked_min_file_size = min(storage_facade.chunked_min_file_size, self.part_size)
+        self.streamed_files = []
+        self._reset()
+
+    def _reset(self):
+        self.file_path = None
+        self.hasher = None
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.file_size = 0
+        self.chunk_writer = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._reset()
+        self.file_path = os.path.join(self.folder_path, self.file_name)
+        self.hasher = hashlib.sha256()
+        audit_logger.info({
+            "timestamp": int(datetime.now().timestamp() * 1000),
+            "user": self.user_id,
+            "action": "streaming_upload_started",
+            "resource": self.file_path,
+            "message": f"Started streaming upload of {self.file_path}.",
+            "details": {"content_length": self.content_length, "part_size": self.part_size}
+        })
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        self.file_size += len(raw_data)
+
+        if self.chunk_writer is not None:
+            self.chunk_writer.write(raw_data)
+            return None
+
+        self.buffer.extend(raw_data)
+        if self.chunked_mode:
+            if len(self.buffer) >= self.chunked_min_file_size:
+                self.chunk_writer = ChunkedObjectWriter(self.storage_facade)
+                self.chunk_writer.write(bytes(self.buffer))
+                self.buffer.clear()
+            return None
+
+        while len(self.buffer) >= self.part_size:
+            self._flush_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return None
+
+    def _flush_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_facade.create_multipart_upload(self.user_id, self.file_path)
+        part = self.s3_facade.upload_part(self.user_id, self.file_path, self.upload_id, len(self.parts) + 1, body)
+        self.parts.append(part)
+
+    def file_complete(self, file_size):
+        file_hash = self.hasher.hexdigest()
+
+        if self.chunk_writer is not None:
+            pending = {'chunk_refs': self.chunk_writer.close(), 'stored_size': self.chunk_writer.stored_size}
+        elif self.upload_id is None:
+            pending = {'content': bytes(self.buffer)}
+        else:
+            if self.buffer:
+                self._flush_part(bytes(self.buffer))
+            pending = {'upload_id': self.upload_id, 'parts': self.parts}
+
+        uploaded_file = StreamedUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.file_size,
+            charset=self.charset,
+            file_hash=file_hash,
+            file_path=self.file_path,
+            storage_facade=self.storage_facade,
+            user_id=self.user_id,
+            read_your_writes=self.read_your_writes,
+            **pending
+        )
+        self.streamed_files.append(uploaded_file)
+        self._reset()
+        return uploaded_file
+
+    def discard_unsaved(self):
+        """Drops every streamed file the view did not save, e.g. because the request failed its CSRF check."""
+        for uploaded_file in self.streamed_files:
+            if uploaded_file.result is None:
+                uploaded_file.discard()
+
+    def upload_interrupted(self):
+        self._abort()
+        self.discard_unsaved()
+
+    def upload_complete(self):
+        self._abort()
+
+    def _abort(self):
+        if self.upload_id is None:
+            return
+        try:
+            self.s3_facade.abort_multipart_upload(self.user_id, self.file_path, self.upload_id)
+        except Exception as e:
+            error_logger.error({
+                "timestamp": int(datetime.now().timestamp() * 1000),
+                "level": "ERROR",
+                "message": f"Error aborting interrupted upload of {self.file_path}: {str(e)}",
+                "exception": str(e),
+                "stack_trace": None,
+                "context": {"user_id": self.user_id, "file_path": self.file_path, "upload_id": self.upload_id}
+            })
+        finally:
+            self._reset()
@@ -4,13 +4,28 @@ from storage import views
 urlpatterns = [
     path('', views.FileListView.as_view(), name='list_files'),
     path('upload/', views.FileUploadView.as_view(), name='upload_file'),
+    path('upload/batch/', views.BatchFileUploadView.as_view(), name='batch_upload_file'),
+    path('upload/resumable/', views.ResumableUploadCreateView.as_view(), name='create_resumable_upload'),
+    path('upload/resumable/<str:session_id>/', views.ResumableUploadView.as_view(), name='resumable_upload'),
+    path('upload/direct/', views.DirectUploadCreateView.as_view(), name='create_direct_upload'),
+    path('upload/direct/<str:staged_id>/', views.DirectUploadView.as_view(), name='direct_upload'),
+    path('upload/direct/<str:staged_id>/complete/', views.DirectUploadCompleteView.as_view(),
+         name='complete_direct_upload'),
+    path('upload/probe/', views.FileProbeView.as_view(), name='probe_upload'),
     path('delete/', views.FileDeleteView.as_view(), name='delete_file'),
+    path('trash/', views.TrashView.as_view(), name='trash'),
     path('download/', views.FileDownloadView.as_view(), name='download_file'),
+    path('download/zip/', views.ArchiveDownloadView.as_view(), name='download_zip'),
+    path('thumbnail/', views.FileThumbnailView.as_view(), name='file_thumbnail'),
     path('search/', views.FileSearchView.as_view(), name='search_file'),
     path('create-folder/', views.FolderCreateView.as_view(), name='create_folder'),
+    path('move/', views.MoveView.as_view(), name='move'),
     path('delete-folder/', views.FolderDeleteView.as_view(), name='delete_folder'),
+    path('delete-folder/jobs/<str:job_id>/', views.FolderDeleteJobView.as_view(), name='folder_delete_job'),
     path('reports/audit-logs/', views.AuditLogView.as_view(), name='audit_logs'),
     path('reports/error-logs/', views.ErrorLogView.as_view(), name='error_logs'),
+    path('reports/hash-cache/', views.HashCacheStatsView.as_view(), name='hash_cache_stats'),
+    path('reports/listing-cache/', views.ListingCacheStatsView.as_view(), name='listing_cache_stats'),
     path('reports/user-usage/', views.UserUsageReportView.as_view(), name='user_usage'),
     path('reports/user-usage/<str:user_id>/', views.UserUsageReportView.as_view(), name='user_usage_detail'),
 ]
@@ -1,54 +1,174 @@
+import base64
+import binascii
 import os
+import re
+import time
+from datetime import datetime, timezone
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.core.paginator import Paginator
-from django.http import HttpResponseNotFound, HttpResponseBadRequest
+from django.http import (HttpResponse, HttpResponseNotFound, HttpResponseBadRequest, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import render, redirect
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition
 from django.views.generic import DeleteView, View
 
+from storage.delete_job_utils import FolderDeleteJobFacade, FolderDeleteJobNotFound
+from storage.derivatives import DERIVATIVE_VARIANTS
 from storage.report_utils import ReportFacade
+from storage.resumable_utils import ResumableUploadFacade, UploadSessionConflict, UploadSessionNotFound
+from storage.staging_utils import StagedUploadFacade
 from storage.storage_utils import StorageFacade
+from storage.upload_handlers import S3StreamingUploadHandler
 
 storage_facade = StorageFacade()
 report_facade = ReportFacade()
+resumable_upload_facade = ResumableUploadFacade(storage_facade)
+staged_upload_facade = StagedUploadFacade(storage_facade)
+folder_delete_job_facade = FolderDeleteJobFacade(storage_facade)
+
+
+def parse_byte_range(range_header, size):
+    """
+    Parses a single-range "bytes=" header into an inclusive (start, end) pair.
+
+    Returns None for headers that should be ignored, such as multiple ranges, and raises ValueError when the
+    range cannot be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        suffix_length = int(end)
+        if suffix_length == 0:
+            raise ValueError(range_header)
+        return max(size - suffix_length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(range_header)
+    return start, end
+
+
+def storage_state(request):
+    """Reads the user's storage generation once per request; both validators below are derived from it."""
+    if not hasattr(request, 'storage_state'):
+        request.storage_state = storage_facade.storage_state(request.user.username)
+    return request.storage_state
+
+
+def storage_state_etag(request, *args, **kwargs):
+    state = storage_state(request)
+    return f"{state.pk}-{state.generation}"
+
+
+def storage_state_last_modified(request, *args, **kwargs):
+    return storage_state(request).modified_at
+
+
+def search_link_window(request):
+    # Cached download links are handed out while at least S3_DOWNLOAD_LINK_MIN_REMAINING seconds of their
+    # validity are left, so a search page revalidated within that window never carries expired links.
+    return int(time.time()) // settings.S3_DOWNLOAD_LINK_MIN_REMAINING
+
+
+def search_etag(request, *args, **kwargs):
+    return f"{storage_state_etag(request)}-{search_link_window(request)}"
+
+
+def search_last_modified(request, *args, **kwargs):
+    window_start = datetime.fromtimestamp(search_link_window(request) * settings.S3_DOWNLOAD_LINK_MIN_REMAINING,
+                                          tz=timezone.utc)
+    return max(storage_state_last_modified(request), window_start)
+
+
+def read_your_writes_requested(request):
+    """Callers that must see the index updated before the response opt in with ?read_your_writes=1."""
+    return request.GET.get('read_your_writes', '').lower() in ('1', 'true', 'yes')
 
 
 class FileListView(LoginRequiredMixin, View):
     template_name = 'storage/list_files.html'
 
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=storage_state_etag, last_modified_func=storage_state_last_modified))
     def get(self, request, *args, **kwargs):
         current_folder = request.GET.get('current_folder', '').lstrip('/').rstrip('/')
         bucket_name = request.user.username
-
-        files_and_folders = storage_facade.read_object(bucket_name, current_folder)
+        try:
+            page_size = int(request.GET.get('page_size', settings.STORAGE_LIST_PAGE_SIZE))
+        except ValueError:
+            page_size = settings.STORAGE_LIST_PAGE_SIZE
+        page_size = min(max(page_size, 1), settings.STORAGE_LIST_MAX_PAGE_SIZE)
+        page_token = request.GET.get('page_token') or None
+        sort = request.GET.get('sort', 'name')
+        if sort not in StorageFacade.browse_sort_fields:
+            sort = 'name'
+        order = 'desc' if request.GET.get('order') == 'desc' else 'asc'
+
+        folder_page = storage_facade.list_folder(bucket_name, current_folder, page_size, page_token, sort, order)
 
         if current_folder.count('/') < 1:
             parent_folder = ''
         else:
             parent_folder = '/'.join(current_folder.split('/')[:-1])
 
+        files_and_folders = [
+            {**item, 'thumbnail_url': storage_facade.thumbnail_url(os.path.join(current_folder, item['name']))}
+            if item['type'] == 'file' else item
+            for item in folder_page['items']
+        ]
+
         context = {
             'files_and_folders': files_and_folders,
             'current_folder': current_folder,
-            'parent_folder': parent_folder
+            'parent_folder': parent_folder,
+            'page_size': page_size,
+            'is_first_page': page_token is None,
+            'next_page_token': folder_page['next_token'],
+            'delete_jobs': folder_delete_job_facade.list_jobs(bucket_name),
+            'sortable': folder_page['source'] == 'index',
+            'sort': sort,
+            'order': order
         }
 
         return render(request, self.template_name, context)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
 class FileUploadView(LoginRequiredMixin, View):
     template_name = 'storage/upload_file.html'
 
     def post(self, request, *args, **kwargs):
-        file = request.FILES['file']
+        # Upload handlers must be replaced before anything reads request.POST, including the CSRF check.
         uploading_folder = request.GET.get('current_folder', '')
-        file_path = os.path.join(uploading_folder, file.name)
+        bucket_name = request.user.username
+        upload_handler = S3StreamingUploadHandler(request, storage_facade, bucket_name, uploading_folder,
+                                                  read_your_writes=read_your_writes_requested(request))
+        request.upload_handlers = [upload_handler]
+        try:
+            return self._streamed_post(request, uploading_folder)
+        finally:
+            # Whatever was streamed but not saved, e.g. because the CSRF check failed, is dropped again.
+            upload_handler.discard_unsaved()
 
-        file_content = file.read()
+    @method_decorator(csrf_protect)
+    def _streamed_post(self, request, uploading_folder):
+        if 'file' not in request.FILES:
+            return HttpResponseBadRequest("No file was uploaded.")
 
-        bucket_name = request.user.username
-        storage_facade.create_object(bucket_name, file_path, file_content)
+        try:
+            request.FILES['file'].save()
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error uploading file: {str(e)}")
 
         return redirect(f"{reverse('list_files')}?current_folder={uploading_folder}")
 
@@ -56,6 +176,196 @@ class FileUploadView(LoginRequiredMixin, View):
         return render(request, self.template_name, {'current_folder': request.GET.get('current_folder', '')})
 
 
+class BatchFileUploadView(LoginRequiredMixin, View):
+    def post(self, request, *args, **kwargs):
+        uploading_folder = request.GET.get('current_folder', '')
+        files = request.FILES.getlist('files')
+        relative_paths = request.POST.getlist('paths')
+
+        if not files:
+            return HttpResponseBadRequest("No files were uploaded.")
+        if relative_paths and len(relative_paths) != len(files):
+            return HttpResponseBadRequest("Each uploaded file needs exactly one relative path.")
+
+        batch = []
+        for index, file in enumerate(files):
+            relative_path = relative_paths[index].lstrip('/') if relative_paths else file.name
+            if not relative_path or '..' in relative_path.split('/'):
+                return HttpResponseBadRequest(f"Invalid relative path for {file.name}.")
+            batch.append((os.path.join(uploading_folder, relative_path), file))
+
+        bucket_name = request.user.username
+        try:
+            results = storage_facade.create_objects(bucket_name, batch)
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error uploading files: {str(e)}")
+
+        return JsonResponse({'results': results})
+
+
+class ResumableUploadMixin:
+    tus_version = '1.0.0'
+
+    def tus_response(self, status, session=None, **headers):
+        response = HttpResponse(status=status)
+        response['Tus-Resumable'] = self.tus_version
+        response['Cache-Control'] = 'no-store'
+        if session is not None:
+            response['Upload-Offset'] = session['offset']
+            response['Upload-Length'] = session['upload_length']
+            response['Upload-Part-Size'] = session['part_size']
+        for header, value in headers.items():
+            response[header.replace('_', '-')] = value
+        return response
+
+    @staticmethod
+    def parse_upload_metadata(header):
+        metadata = {}
+        for pair in filter(None, (item.strip() for item in header.split(','))):
+            key, _, encoded_value = pair.partition(' ')
+            metadata[key] = base64.b64decode(encoded_value).decode() if encoded_value else ''
+        return metadata
+
+
+class ResumableUploadCreateView(LoginRequiredMixin, ResumableUploadMixin, View):
+    def post(self, request, *args, **kwargs):
+        uploading_folder = request.GET.get('current_folder', '')
+        try:
+            upload_length = int(request.headers.get('Upload-Length', ''))
+            metadata = self.parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+        except (ValueError, binascii.Error):
+            return HttpResponseBadRequest("Upload-Length and a valid Upload-Metadata header are required.")
+
+        file_name = os.path.basename(metadata.get('filename', ''))
+        if upload_length < 0 or not file_name:
+            return HttpResponseBadRequest("A non-negative Upload-Length and a filename are required.")
+
+        bucket_name = request.user.username
+        try:
+            session_id, session = resumable_upload_facade.create_session(
+                bucket_name, os.path.join(uploading_folder, file_name), upload_length
+            )
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error creating upload session: {str(e)}")
+
+        return self.tus_response(201, session, Location=reverse('resumable_upload', args=[session_id]))
+
+
+class ResumableUploadView(LoginRequiredMixin, ResumableUploadMixin, View):
+    def head(self, request, session_id, *args, **kwargs):
+        try:
+            session = resumable_upload_facade.get_session(request.user.username, session_id)
+        except UploadSessionNotFound:
+            return self.tus_response(404)
+        return self.tus_response(200, session)
+
+    def patch(self, request, session_id, *args, **kwargs):
+        if request.content_type != 'application/offset+octet-stream':
+            return self.tus_response(415)
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return HttpResponseBadRequest("A numeric Upload-Offset header is required.")
+
+        try:
+            session = resumable_upload_facade.append_chunk(request.user.username, session_id, offset, request)
+        except UploadSessionNotFound:
+            return self.tus_response(404)
+        except UploadSessionConflict as e:
+            response = self.tus_response(409)
+            response.content = str(e)
+            return response
+        return self.tus_response(204, session)
+
+    def delete(self, request, session_id, *args, **kwargs):
+        try:
+            resumable_upload_facade.terminate_session(request.user.username, session_id)
+        except UploadSessionNotFound:
+            return self.tus_response(404)
+        return self.tus_response(204)
+
+
+class DirectUploadCreateView(LoginRequiredMixin, View):
+    def post(self, request, *args, **kwargs):
+        uploading_folder = request.GET.get('current_folder', '')
+        file_name = os.path.basename(request.POST.get('file', ''))
+        try:
+            file_size = int(request.POST.get('size', ''))
+        except ValueError:
+            return HttpResponseBadRequest("A numeric file size is required.")
+
+        if not file_name or not 0 <= file_size <= settings.S3_STAGING_MAX_UPLOAD_SIZE:
+            return HttpResponseBadRequest("A file name and a size within the direct upload limit are required.")
+
+        bucket_name = request.user.username
+        try:
+            staged_id, upload_post = staged_upload_facade.create_staged_upload(
+                bucket_name, os.path.join(uploading_folder, file_name), file_size
+            )
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error creating direct upload: {str(e)}")
+
+        return JsonResponse({
+            'id': staged_id,
+            'upload': upload_post,
+            'complete_url': reverse('complete_direct_upload', args=[staged_id])
+        }, status=201)
+
+
+class DirectUploadView(LoginRequiredMixin, View):
+    def get(self, request, staged_id, *args, **kwargs):
+        try:
+            staged_upload = staged_upload_facade.get_staged_upload(request.user.username, staged_id)
+        except UploadSessionNotFound as e:
+            return HttpResponseNotFound(str(e))
+
+        return JsonResponse({
+            'id': staged_id,
+            'file': staged_upload['file_path'],
+            'status': staged_upload['status'],
+            'message': staged_upload['result']
+        })
+
+
+class DirectUploadCompleteView(LoginRequiredMixin, View):
+    def post(self, request, staged_id, *args, **kwargs):
+        try:
+            staged_upload = staged_upload_facade.mark_uploaded(request.user.username, staged_id)
+        except UploadSessionNotFound as e:
+            return HttpResponseNotFound(str(e))
+        except UploadSessionConflict as e:
+            return JsonResponse({'id': staged_id, 'message': str(e)}, status=409)
+
+        return JsonResponse({'id': staged_id, 'status': staged_upload['status']}, status=202)
+
+
+class FileProbeView(LoginRequiredMixin, View):
+    sha256_pattern = re.compile(r'^[0-9a-f]{64}$')
+
+    def post(self, request, *args, **kwargs):
+        uploading_folder = request.GET.get('current_folder', '')
+        file_name = request.POST.get('file', '')
+        file_hash = request.POST.get('hash', '').lower()
+
+        try:
+            file_size = int(request.POST.get('size', ''))
+        except ValueError:
+            return HttpResponseBadRequest("A numeric file size is required.")
+
+        if not file_name or file_size < 0 or not self.sha256_pattern.match(file_hash):
+            return HttpResponseBadRequest("A file name, a non-negative size and a SHA-256 hex digest are required.")
+
+        file_path = os.path.join(uploading_folder, file_name)
+        bucket_name = request.user.username
+        try:
+            probe_result = storage_facade.probe_object(bucket_name, file_path, file_hash, file_size,
+                                                       read_your_writes=read_your_writes_requested(request))
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error probing file: {str(e)}")
+
+        return JsonResponse(probe_result)
+
+
 class FileDeleteView(LoginRequiredMixin, DeleteView):
     template_name = 'storage/delete_file.html'
 
@@ -71,28 +381,143 @@ class FileDeleteView(LoginRequiredMixin, DeleteView):
         deleting_file = request.POST.get('file')
 
         bucket_name = request.user.username
-        storage_facade.delete_object(bucket_name, os.path.join(current_folder, deleting_file))
+        try:
+            storage_facade.trash_object(bucket_name, os.path.join(current_folder, deleting_file))
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error deleting file: {str(e)}")
 
         return redirect(f"{reverse('list_files')}?current_folder={current_folder}")
 
 
+class TrashView(LoginRequiredMixin, View):
+    template_name = 'storage/trash.html'
+
+    def get(self, request, *args, **kwargs):
+        context = {
+            'trashed_files': storage_facade.list_trash(request.user.username)
+        }
+        return render(request, self.template_name, context)
+
+    def post(self, request, *args, **kwargs):
+        restoring_file = request.POST.get('file')
+        if not restoring_file:
+            return HttpResponseBadRequest("A file to restore is required.")
+
+        try:
+            storage_facade.restore_object(request.user.username, restoring_file)
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error restoring file: {str(e)}")
+
+        return redirect(reverse('trash'))
+
+
 class FileDownloadView(LoginRequiredMixin, View):
+    """
+    Redirects to a presigned S3 URL, or streams the object through the app when STORAGE_DOWNLOAD_PROXY is set
+    or when the object is chunked or compressed. Streamed downloads honour single byte ranges and
+    If-None-Match / If-Modified-Since, and never hold more than one block of the object in memory.
+    """
+
     def get(self, request, *args, **kwargs):
         try:
             current_folder = request.GET.get('current_folder', '')
             file = request.GET.get('file')
             bucket_name = request.user.username
             file_path = os.path.join(current_folder, file)
-            download_info = storage_facade.read_object(bucket_name, file_path)
-            return redirect(download_info.get("download_link"))
+            object_info = storage_facade.stat_download(bucket_name, file_path)
+            if not settings.STORAGE_DOWNLOAD_PROXY and not object_info['chunked'] and not object_info['codec']:
+                return redirect(storage_facade.generate_download_link(object_info))
+            return self._stream(request, file_path, object_info)
         except Exception as e:
             return HttpResponseNotFound(f"File not found: {str(e)}")
 
+    def _stream(self, request, file_path, object_info):
+        etag = quote_etag(object_info['etag'])
+        last_modified = object_info['last_modified']
+        last_modified_timestamp = int(last_modified.timestamp()) if last_modified else None
+        conditional_response = get_conditional_response(request, etag=etag, last_modified=last_modified_timestamp)
+        if conditional_response is not None:
+            return conditional_response
+
+        size = object_info['size']
+        byte_range = None
+        seekable = not object_info['codec']
+        if seekable and 'HTTP_RANGE' in request.META:
+            if_range = request.META.get('HTTP_IF_RANGE')
+            if if_range is None or if_range == etag:
+                try:
+                    byte_range = parse_byte_range(request.META['HTTP_RANGE'], size)
+                except ValueError:
+                    response = HttpResponse(status=416)
+                    response['Content-Range'] = f"bytes */{size}"
+                    return response
+
+        response = StreamingHttpResponse(storage_facade.open_object_stream(object_info, byte_range),
+                                         content_type=object_info['content_type'] or 'application/octet-stream')
+        if byte_range is not None:
+            response.status_code = 206
+            response['Content-Range'] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+            response['Content-Length'] = byte_range[1] - byte_range[0] + 1
+        else:
+            response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes' if seekable else 'none'
+        response['ETag'] = etag
+        if last_modified_timestamp is not None:
+            response['Last-Modified'] = http_date(last_modified_timestamp)
+        response['Content-Disposition'] = f'attachment; filename="{os.path.basename(file_path)}"'
+        return response
+
+
+class ArchiveDownloadView(LoginRequiredMixin, View):
+    """Streams a folder, or files and folders selected in it, as a ZIP archive that is built while it is sent."""
+
+    def get(self, request, *args, **kwargs):
+        current_folder = request.GET.get('current_folder', '').strip('/')
+        file_names = request.GET.getlist('file')
+        folder_names = request.GET.getlist('folder')
+        try:
+            archive = storage_facade.stream_archive(request.user.username, current_folder, file_names, folder_names)
+        except Exception as e:
+            return HttpResponseNotFound(f"Files not found: {str(e)}")
+
+        if len(folder_names) == 1 and not file_names:
+            archive_name = folder_names[0]
+        else:
+            archive_name = os.path.basename(current_folder) or 'files'
+        response = StreamingHttpResponse(archive, content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="{archive_name}.zip"'
+        return response
+
+
+class FileThumbnailView(LoginRequiredMixin, View):
+    """Redirects to the shared thumbnail or preview of a file's content, or answers 404 until it is generated."""
+
+    def get(self, request, *args, **kwargs):
+        current_folder = request.GET.get('current_folder', '')
+        file = request.GET.get('file')
+        variant = request.GET.get('variant', 'thumbnail')
+        if variant not in DERIVATIVE_VARIANTS:
+            return HttpResponseBadRequest(f"Unknown preview variant {variant}.")
+        try:
+            derivative_link = storage_facade.derivative_link(request.user.username,
+                                                             os.path.join(current_folder, file), variant)
+        except Exception as e:
+            return HttpResponseNotFound(f"File not found: {str(e)}")
+        if derivative_link is None:
+            return HttpResponseNotFound("No preview is available yet.")
+
+        response = redirect(derivative_link)
+        # The presigned link stays valid at least this long, so browsers may skip the lookup meanwhile.
+        patch_cache_control(response, private=True, max_age=settings.S3_DOWNLOAD_LINK_MIN_REMAINING)
+        return response
+
 
 class FileSearchView(LoginRequiredMixin, View):
     template_name = 'storage/file_search.html'
     paginate_by = 20
 
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=search_etag, last_modified_func=search_last_modified))
     def get(self, request, *args, **kwargs):
         search_term = request.GET.get('q', '')
         page_number = int(request.GET.get('page', 1))
@@ -134,6 +559,37 @@ class FolderCreateView(LoginRequiredMixin, View):
         return render(request, self.template_name, {'current_folder': request.GET.get('current_folder', '')})
 
 
+class MoveView(LoginRequiredMixin, View):
+    template_name = 'storage/move.html'
+
+    def get(self, request, *args, **kwargs):
+        context = {
+            'current_folder': request.GET.get('current_folder', ''),
+            'file': request.GET.get('file', ''),
+            'folder': request.GET.get('folder', '')
+        }
+        return render(request, self.template_name, context)
+
+    def post(self, request, *args, **kwargs):
+        current_folder = request.GET.get('current_folder', '')
+        moving_file = request.POST.get('file')
+        moving_folder = request.POST.get('folder')
+        destination = request.POST.get('destination', '').strip('/')
+        if not destination or not (moving_file or moving_folder):
+            return HttpResponseBadRequest("An item to move and a destination path are required.")
+
+        bucket_name = request.user.username
+        try:
+            if moving_folder:
+                storage_facade.move_folder(bucket_name, os.path.join(current_folder, moving_folder), destination)
+            else:
+                storage_facade.move_object(bucket_name, os.path.join(current_folder, moving_file), destination)
+        except Exception as e:
+            return HttpResponseBadRequest(f"Error moving to {destination}: {str(e)}")
+
+        return redirect(f"{reverse('list_files')}?current_folder={os.path.dirname(destination)}")
+
+
 class FolderDeleteView(LoginRequiredMixin, View):
     template_name = 'storage/delete_folder.html'
 
@@ -151,11 +607,30 @@ class FolderDeleteView(LoginRequiredMixin, View):
         full_path = os.path.join(current_folder, deleting_folder_name)
         bucket_name = request.user.username
 
-        storage_facade.delete_object(bucket_name, full_path)
+        folder_delete_job_facade.submit_job(bucket_name, full_path)
 
         return redirect(f"{reverse('list_files')}?current_folder={current_folder}")
 
 
+class FolderDeleteJobView(LoginRequiredMixin, View):
+    def get(self, request, job_id, *args, **kwargs):
+        try:
+            job = folder_delete_job_facade.get_job(request.user.username, job_id)
+        except FolderDeleteJobNotFound as e:
+            return HttpResponseNotFound(str(e))
+
+        return JsonResponse({
+            'id': job_id,
+            'folder': job['folder_path'],
+            'status': job['status'],
+            'phase': job['phase'],
+            'processed_count': job['processed_count'],
+            'deleted_count': job['deleted_count'],
+            'failed_count': job['failed_count'],
+            'message': job['result']
+        })
+
+
 class AuditLogView(LoginRequiredMixin, PermissionRequiredMixin, View):
     template_name = 'storage/audit_logs.html'
     paginate_by = 20
@@ -216,9 +691,31 @@ class ErrorLogView(LoginRequiredMixin, PermissionRequiredMixin, View):
             return HttpResponseBadRequest(f"Error retrieving error logs: {str(e)}")
 
 
+class HashCacheStatsView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    def has_permission(self):
+        return self.request.user.is_superuser
+
+    def get(self, request, *args, **kwargs):
+        if storage_facade.hash_cache is None:
+            return JsonResponse({'enabled': False})
+        return JsonResponse({'enabled': True, **storage_facade.hash_cache.stats()})
+
+
+class ListingCacheStatsView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    def has_permission(self):
+        return self.request.user.is_superuser
+
+    def get(self, request, *args, **kwargs):
+        if storage_facade.s3_facade.listing_cache is None:
+            return JsonResponse({'enabled': False})
+        return JsonResponse({'enabled': True, **storage_facade.s3_facade.listing_cache.stats()})
+
+
 class UserUsageReportView(LoginRequiredMixin, View):
     template_name = 'storage/user_usage.html'
 
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=storage_state_etag, last_modified_func=storage_state_last_modified))
     def get(self, request, *args, **kwargs):
         try:
             usage = report_facade.get_user_usage(self.request.user.username)
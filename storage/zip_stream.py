@@ -0,0 +1,147 @@
+import io
+import queue
+import tempfile
+import threading
+import zipfile
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+ZipEntry = namedtuple('ZipEntry', ['arcname', 'content_key', 'size', 'last_modified', 'source'])
+
+_END = object()
+
+
+class _ArchiveBuffer(io.RawIOBase):
+    """Write-only, unseekable sink that hands the bytes written by ZipFile back to the response generator."""
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        return len(data)
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ZipStreamWriter:
+    """
+    Builds a ZIP archive on the fly and yields it block by block.
+
+    Entries are written in order while the content of the next `prefetch_depth` entries is read in parallel
+    into bounded queues, so S3 latency overlaps with writing. Entries sharing a content key are fetched
+    once: the first copy is spooled while it is written and replayed for the others, and the spool is
+    dropped after its last use. Since the output is unseekable, ZipFile writes data descriptors after each
+    entry and switches to ZIP64 where sizes require it.
+    """
+
+    def __init__(self, open_source, prefetch_depth=4, queue_blocks=4, spool_memory=8 * 1024 * 1024):
+        self.open_source = open_source
+        self.prefetch_depth = max(prefetch_depth, 1)
+        self.queue_blocks = queue_blocks
+        self.spool_memory = spool_memory
+        self.cancelled = threading.Event()
+
+    def iter_archive(self, entries):
+        entries = list(entries)
+        remaining_uses = Counter(entry.content_key for entry in entries)
+        first_indices = {}
+        for index, entry in enumerate(entries):
+            first_indices.setdefault(entry.content_key, index)
+        fetched_indices = sorted(first_indices.values())
+
+        executor = ThreadPoolExecutor(max_workers=self.prefetch_depth, thread_name_prefix='zip-prefetch')
+        pending = {}
+        spools = {}
+        next_fetch = 0
+        sink = _ArchiveBuffer()
+        try:
+            with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+                for index, entry in enumerate(entries):
+                    while next_fetch < len(fetched_indices) and len(pending) < self.prefetch_depth:
+                        fetch_index = fetched_indices[next_fetch]
+                        blocks = queue.Queue(maxsize=self.queue_blocks)
+                        executor.submit(self._fetch, entries[fetch_index].source, blocks)
+                        pending[fetch_index] = blocks
+                        next_fetch += 1
+
+                    zip_info = zipfile.ZipInfo(entry.arcname, date_time=self._date_time(entry.last_modified))
+                    zip_info.compress_type = zipfile.ZIP_STORED
+                    zip_info.file_size = entry.size
+                    remaining_uses[entry.content_key] -= 1
+
+                    with archive.open(zip_info, mode='w') as member:
+                        if index in pending:
+                            spool = None
+                            if remaining_uses[entry.content_key]:
+                                spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+                                spools[entry.content_key] = spool
+                            for block in self._drain_queue(pending.pop(index)):
+                                member.write(block)
+                                if spool is not None:
+                                    spool.write(block)
+                                yield from self._flush(sink)
+                        else:
+                            spool = spools[entry.content_key]
+                            spool.seek(0)
+                            for block in iter(lambda: spool.read(256 * 1024), b''):
+                                member.write(block)
+                                yield from self._flush(sink)
+                            if not remaining_uses[entry.content_key]:
+                                spools.pop(entry.content_key).close()
+                    yield from self._flush(sink)
+            yield from self._flush(sink)
+        finally:
+            self.cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            for spool in spools.values():
+                spool.close()
+
+    @staticmethod
+    def _flush(sink):
+        data = sink.drain()
+        if data:
+            yield data
+
+    @staticmethod
+    def _date_time(last_modified):
+        if last_modified is None or last_modified.year < 1980:
+            return 1980, 1, 1, 0, 0, 0
+        return last_modified.timetuple()[:6]
+
+    def _fetch(self, source, blocks):
+        try:
+            for block in self.open_source(source):
+                if not self._put(blocks, block):
+                    return
+            self._put(blocks, _END)
+        except Exception as e:
+            self._put(blocks, e)
+
+    def _put(self, blocks, item):
+        # A bounded queue keeps prefetching from buffering whole objects; the timeout lets a worker notice
+        # that the client went away instead of blocking forever.
+        while not self.cancelled.is_set():
+            try:
+                blocks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _drain_queue(blocks):
+        while True:
+            block = blocks.get()
+            if block is _END:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block